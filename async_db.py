@@ -0,0 +1,280 @@
+# async_db.py
+#
+# Асинхронный фасад над database.py для обработчиков aiogram.
+# Все обращения к SQLite выполняются вне event loop:
+# - записи идут через один выделенный поток-писатель, который группирует их (group commit):
+#   всё, что накопилось за WRITE_BATCH_WINDOW секунд (но не больше WRITE_BATCH_SIZE операций),
+#   фиксируется одной транзакцией (одна блокировка записи и одна запись COMMIT в WAL; при
+#   synchronous=NORMAL коммит не делает fsync — см. database.py). Каждая операция — в своём SAVEPOINT,
+#   поэтому ошибка одной записи не откатывает соседние;
+# - чтения — через небольшой пул потоков (в режиме WAL они не блокируются записью).
+# У каждого потока своё постоянное соединение из пула database.get_connection().
+
+import asyncio
+import functools
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+
+READER_THREADS = 4
+WRITE_BATCH_SIZE = 100
+WRITE_BATCH_WINDOW = 0.002  # секунды
+
+_readers = ThreadPoolExecutor(max_workers=READER_THREADS, thread_name_prefix="db-reader")
+# Долгие фоновые задачи обслуживания (архивация) — в своём потоке, чтобы не занимать писателя
+_maintenance = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-maintenance")
+
+
+class WriteCoalescer:
+    """
+    Очередь записей с групповым коммитом.
+    submit() возвращает asyncio.Future, который завершается только после COMMIT
+    транзакции, в которую попала запись (или с исключением, если запись не удалась).
+    """
+
+    def __init__(self, batch_size=WRITE_BATCH_SIZE, batch_window=WRITE_BATCH_WINDOW):
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.writes = 0
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        self._ensure_started()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((functools.partial(func, *args, **kwargs), future, loop))
+        return future
+
+    def stop(self):
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _collect_batch(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)  # Вернём сигнал остановки для основного цикла
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._commit_batch(self._collect_batch(item))
+
+    def _commit_batch(self, batch):
+        outcomes = []
+        try:
+            with database.transaction():
+                for call, future, loop in batch:
+                    try:
+                        # Вложенная транзакция = SAVEPOINT внутри общей
+                        with database.transaction():
+                            outcomes.append((True, call()))
+                    except Exception as e:
+                        outcomes.append((False, e))
+        except Exception as commit_error:
+            # Транзакция не зафиксировалась: ни одна запись пакета не сохранена
+            database.invalidate_pending_cache()
+            outcomes = [(False, commit_error)] * len(batch)
+
+        self.batches += 1
+        self.writes += len(batch)
+
+        for (call, future, loop), (ok, value) in zip(batch, outcomes):
+            loop.call_soon_threadsafe(_resolve, future, ok, value)
+
+
+def _resolve(future, ok, value):
+    if future.done():
+        return
+    if ok:
+        future.set_result(value)
+    else:
+        future.set_exception(value)
+
+
+_writer = WriteCoalescer()
+
+
+async def run_write(func, *args, **kwargs):
+    """Ставит синхронную функцию записи в очередь группового коммита и ждёт фиксации."""
+    return await _writer.submit(func, *args, **kwargs)
+
+
+async def run_read(func, *args, **kwargs):
+    """Выполняет синхронную функцию чтения в пуле потоков-читателей."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_readers, functools.partial(func, *args, **kwargs))
+
+
+async def run_maintenance(func, *args, **kwargs):
+    """Выполняет фоновую задачу обслуживания базы в отдельном потоке."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_maintenance, functools.partial(func, *args, **kwargs))
+
+
+def shutdown():
+    """Дожидается завершения поставленных операций и закрывает соединения."""
+    _writer.stop()
+    _readers.shutdown(wait=True)
+    _maintenance.shutdown(wait=True)
+    database.close_connections()
+
+
+# ✅ Tasks
+async def add_task(task, effects=()):
+    return await run_write(database.add_task, task, effects)
+
+async def get_active_tasks(user_id=None, deadline=None, columns=database.TASK_LIST_COLUMNS):
+    return await run_read(database.get_active_tasks, user_id, deadline, columns)
+
+async def get_active_tasks_page(user_id, after_cursor=None, limit=3, before_cursor=None,
+                                columns=database.TASK_LIST_COLUMNS):
+    return await run_read(database.get_active_tasks_page, user_id, after_cursor, limit, before_cursor, columns)
+
+async def count_active_tasks(user_id):
+    return await run_read(database.count_active_tasks, user_id)
+
+async def complete_task(task_id, hours_spent, effects=()):
+    return await run_write(database.complete_task, task_id, hours_spent, effects)
+
+async def update_task_deadline(task_id, new_deadline, new_time=None, effects=()):
+    return await run_write(database.update_task_deadline, task_id, new_deadline, new_time, effects)
+
+async def update_task_status(task_id, status):
+    return await run_write(database.update_task_status, task_id, status)
+
+async def get_tasks_due_on_by_user(deadline, columns=database.TASK_LIST_COLUMNS, timezone=None):
+    return await run_read(database.get_tasks_due_on_by_user, deadline, columns, timezone)
+
+async def get_tasks_by_ids(task_ids, columns=database.TASK_LIST_COLUMNS):
+    return await run_read(database.get_tasks_by_ids, list(task_ids), columns)
+
+async def get_upcoming_due_tasks(after_epoch, user_id=None):
+    return await run_read(database.get_upcoming_due_tasks, after_epoch, user_id)
+
+async def get_missed_hour_reminders(since_epoch, until_epoch, limit, columns=database.TASK_LIST_COLUMNS):
+    return await run_read(database.get_missed_hour_reminders, since_epoch, until_epoch, limit, columns)
+
+async def get_task_by_id(task_id, columns=database.TASK_COLUMNS):
+    return await run_read(database.get_task_by_id, task_id, columns)
+
+async def update_calendar_event(task_id, event_id, etag):
+    return await run_write(database.update_calendar_event, task_id, event_id, etag)
+
+async def update_sheet_row(task_id, sheet_row):
+    return await run_write(database.update_sheet_row, task_id, sheet_row)
+
+async def add_completion_comment(task_id, comment):
+    return await run_write(database.add_completion_comment, task_id, comment)
+
+async def claim_reminders(kind, items):
+    return await run_write(database.claim_reminders, kind, list(items))
+
+async def release_reminders(kind, items):
+    return await run_write(database.release_reminders, kind, list(items))
+
+async def archive_completed_tasks(older_than_days):
+    return await run_maintenance(database.archive_completed_tasks, older_than_days)
+
+
+# 👑 Leases
+async def acquire_lease(name, holder, ttl):
+    return await run_write(database.acquire_lease, name, holder, ttl)
+
+async def release_lease(name, holder):
+    return await run_write(database.release_lease, name, holder)
+
+
+# 🌍 User settings
+async def get_user_timezone(user_id):
+    return await run_read(database.get_user_timezone, user_id)
+
+async def set_user_timezone(user_id, timezone, effects=()):
+    return await run_write(database.set_user_timezone, user_id, timezone, effects)
+
+async def get_timezone_buckets():
+    return await run_read(database.get_timezone_buckets)
+
+async def set_user_active(user_id, active):
+    return await run_write(database.set_user_active, user_id, active)
+
+
+# 📮 Send retries
+async def add_send_retry(chat_id, payload, priority, attempts, next_attempt_at, error):
+    return await run_write(database.add_send_retry, chat_id, payload, priority, attempts, next_attempt_at, error)
+
+async def claim_due_send_retries(now, limit, lease_seconds):
+    return await run_write(database.claim_due_send_retries, now, limit, lease_seconds)
+
+async def extend_send_retries(retry_ids, until):
+    return await run_write(database.extend_send_retries, list(retry_ids), until)
+
+async def reschedule_send_retry(retry_id, attempts, next_attempt_at, error):
+    return await run_write(database.reschedule_send_retry, retry_id, attempts, next_attempt_at, error)
+
+async def delete_send_retry(retry_id):
+    return await run_write(database.delete_send_retry, retry_id)
+
+
+# 📤 Outbox
+async def claim_outbox(channel, now, limit, lease_seconds):
+    return await run_write(database.claim_outbox, channel, now, limit, lease_seconds)
+
+async def complete_outbox(outbox_id):
+    return await run_write(database.complete_outbox, outbox_id)
+
+async def reschedule_outbox(outbox_id, attempts, next_attempt_at, error):
+    return await run_write(database.reschedule_outbox, outbox_id, attempts, next_attempt_at, error)
+
+async def fail_outbox(outbox_id, attempts, error):
+    return await run_write(database.fail_outbox, outbox_id, attempts, error)
+
+
+# ⏳ Pending tasks
+async def add_pending_task(user_id, data: dict):
+    return await run_write(database.add_pending_task, user_id, data)
+
+async def get_pending_task(user_id):
+    return await run_read(database.get_pending_task, user_id)
+
+async def update_pending_task(user_id, updates: dict):
+    return await run_write(database.update_pending_task, user_id, updates)
+
+async def delete_pending_task(user_id):
+    return await run_write(database.delete_pending_task, user_id)
+
+async def clear_pending_tasks():
+    return await run_write(database.clear_pending_tasks)
+
+async def add_pending_fragment(user_id, text=None, file_name=None, forwarded_from=None):
+    return await run_write(database.add_pending_fragment, user_id, text, file_name, forwarded_from)
+
+async def consolidate_pending_fragments(user_id):
+    return await run_write(database.consolidate_pending_fragments, user_id)
@@ -0,0 +1,98 @@
+# benchmarks/handler_latency.py
+#
+# Сравнивает задержку обработчиков при конкурентной нагрузке:
+# синхронные вызовы database.py прямо в event loop против асинхронного фасада async_db.py.
+#
+# Каждый «пользователь» выполняет типичный шаг диалога (get_pending_task + update_pending_task),
+# параллельно с этим «пинг»-корутина измеряет, насколько event loop занят блокирующим вводом-выводом.
+#
+# Запуск из корня репозитория:
+#     python benchmarks/handler_latency.py --users 200 --rounds 20
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+async def sync_step(user_id, i):
+    pending = database.get_pending_task(user_id)
+    database.update_pending_task(user_id, {"step": f"step_{i}", "messages": pending["messages"] + [str(i)]})
+    await asyncio.sleep(0)  # Имитация отправки ответа в Telegram
+
+
+async def async_step(user_id, i):
+    import async_db
+    pending = await async_db.get_pending_task(user_id)
+    await async_db.update_pending_task(user_id, {"step": f"step_{i}", "messages": pending["messages"] + [str(i)]})
+    await asyncio.sleep(0)
+
+
+async def run(step, users, rounds):
+    handler_latencies = []
+    loop_lag = []
+    stop = asyncio.Event()
+
+    async def ping():
+        # Корутина «другого чата»: должна просыпаться каждые 5 мс
+        while not stop.is_set():
+            planned = time.perf_counter() + 0.005
+            await asyncio.sleep(0.005)
+            loop_lag.append(time.perf_counter() - planned)
+
+    async def user(user_id):
+        for i in range(rounds):
+            started = time.perf_counter()
+            await step(user_id, i)
+            handler_latencies.append(time.perf_counter() - started)
+
+    pinger = asyncio.create_task(ping())
+    await asyncio.gather(*(user(uid) for uid in range(users)))
+    stop.set()
+    await pinger
+    return handler_latencies, loop_lag
+
+
+def report(name, handler_latencies, loop_lag):
+    ms = lambda v: f"{v * 1000:.2f} мс"
+    print(
+        f"{name:>6}: обработчик p50={ms(statistics.median(handler_latencies))} "
+        f"p99={ms(percentile(handler_latencies, 99))} | "
+        f"задержка event loop p99={ms(percentile(loop_lag, 99))} max={ms(max(loop_lag))} (замеров: {len(loop_lag)})"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_FILE = os.path.join(tmp, "bench.sqlite3")
+        database.create_tables()
+        for uid in range(args.users):
+            database.add_pending_task(uid, {"step": "collecting", "messages": []})
+
+        report("sync", *asyncio.run(run(sync_step, args.users, args.rounds)))
+        report("async", *asyncio.run(run(async_step, args.users, args.rounds)))
+
+        import async_db
+        async_db.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,84 +1,242 @@
 import sqlite3
 import json
+import os
+import threading
+from collections import OrderedDict
+from itertools import groupby
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 DB_FILE = "db.sqlite3"
 
+# 🔌 Пул соединений: одно долгоживущее соединение на поток
+# Параметры подобраны под бота: WAL позволяет читать во время записи,
+# synchronous=NORMAL убирает fsync на каждый коммит: в WAL база при этом не повреждается,
+# но последние коммиты могут пропасть при отключении питания (не при падении процесса),
+# fsync выполняется только при checkpoint;
+# mmap ускоряет чтение, кэш подготовленных запросов избавляет от повторного парсинга SQL.
+CACHED_STATEMENTS = 256
+MMAP_SIZE = 64 * 1024 * 1024
+BUSY_TIMEOUT_MS = 5000
+
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_generation = 0
+
+
+def _open_connection():
+    conn = sqlite3.connect(DB_FILE, cached_statements=CACHED_STATEMENTS, check_same_thread=False)
+    # Новая база сразу создаётся с auto_vacuum=INCREMENTAL (режим можно задать только до первой
+    # таблицы и до перехода в WAL); на существующей базе прагма ничего не меняет,
+    # см. enable_incremental_vacuum()
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    # Строки доступны и по имени колонки (row["title"]), и по индексу
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
 def get_connection():
-    return sqlite3.connect(DB_FILE)
+    """
+    Возвращает открытое соединение текущего потока.
+    Соединение создаётся один раз и переиспользуется, закрывать его не нужно —
+    транзакции оформляются через `with transaction(conn):`.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "generation", None) != _generation:
+        conn = _open_connection()
+        _local.conn = conn
+        _local.generation = _generation
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+
+def close_connections():
+    """Закрывает все открытые соединения (вызывается при остановке бота)."""
+    global _generation
+    with _connections_lock:
+        for conn in _connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _connections.clear()
+        _generation += 1
+
+
+@contextmanager
+def transaction(conn=None):
+    """
+    Транзакция с поддержкой вложенности.
+    Внешний уровень делает BEGIN IMMEDIATE/COMMIT (или ROLLBACK при ошибке). Вложенные уровни
+    оформляются через SAVEPOINT: ошибка внутри откатывает только свою часть, а фиксация
+    происходит вместе с внешней транзакцией. Так несколько записей можно объединить
+    в один коммит (см. группировку записей в async_db.py).
+    Блокировка записи берётся сразу (IMMEDIATE): многие записи сначала читают (часовой пояс,
+    текущий срок, черновик). В отложенной транзакции, если между этим чтением и первой записью
+    базу изменит другое соединение (поток обслуживания, хранилище APScheduler, другой экземпляр),
+    SQLite сразу вернёт SQLITE_BUSY_SNAPSHOT, и busy_timeout не поможет. С IMMEDIATE
+    соединение ждёт блокировку до busy_timeout, а читает уже свежий снимок.
+    """
+    conn = conn or get_connection()
+    depth = getattr(_local, "tx_depth", 0)
+
+    if depth == 0:
+        _local.tx_depth = 1
+        try:
+            with conn:
+                if not conn.in_transaction:
+                    conn.execute("BEGIN IMMEDIATE")
+                yield conn
+        finally:
+            _local.tx_depth = 0
+        return
+
+    savepoint = f"sp_{depth}"
+    conn.execute(f"SAVEPOINT {savepoint}")
+    _local.tx_depth = depth + 1
+    try:
+        yield conn
+    except BaseException:
+        conn.execute(f"ROLLBACK TO {savepoint}")
+        conn.execute(f"RELEASE {savepoint}")
+        raise
+    else:
+        conn.execute(f"RELEASE {savepoint}")
+    finally:
+        _local.tx_depth = depth
+
+# 📋 Колонки для выборок: каждый запрос берёт только то, что нужно вызывающему коду
+# (при добавлении колонки в tasks её нужно добавить и в tasks_archive — см. migrations.py)
+TASK_COLUMNS = (
+    "id", "user_id", "title", "deadline", "time", "calendar_event_id", "sheet_row",
+    "status", "msg_id", "created_at", "completed_at", "hours_spent", "comment", "due_at",
+    "calendar_etag",
+)
+# Список задач и напоминания
+TASK_LIST_COLUMNS = ("id", "user_id", "title", "deadline", "time")
+PENDING_COLUMNS = (
+    "user_id", "title", "deadline", "time", "assigned_by", "comment",
+    "step", "messages", "files", "forwarded_from",
+)
+
+def _columns_sql(columns):
+    """Собирает список колонок для SELECT, допуская только известные колонки tasks."""
+    unknown = set(columns) - set(TASK_COLUMNS)
+    if unknown:
+        raise ValueError(f"Неизвестные колонки tasks: {', '.join(sorted(unknown))}")
+    return ", ".join(columns)
+
+# Пользователи, заблокировавшие бота, помечаются неактивными (user_settings.active = 0)
+# и пропускаются всеми выборками напоминаний
+_ACTIVE_USER_SQL = "NOT EXISTS (SELECT 1 FROM user_settings s WHERE s.user_id = tasks.user_id AND s.active = 0)"
+
+# ⏱ Момент дедлайна в секундах UTC (колонка due_at)
+DEFAULT_TASK_TIME = "10:00"
+# Часовой пояс пользователей, которые его не выбирали (раньше был зашит в календаре)
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Asia/Yekaterinburg")
+
+def get_zone(tz=None):
+    """ZoneInfo для названия пояса IANA; неизвестное название заменяется поясом по умолчанию."""
+    try:
+        return ZoneInfo(tz or DEFAULT_TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo(DEFAULT_TIMEZONE)
+
+def is_valid_timezone(tz):
+    try:
+        ZoneInfo(tz)
+        return True
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+
+def compute_due_at(deadline, time=None, tz=None):
+    """
+    Переводит дату YYYY-MM-DD и время HH:MM (по умолчанию 10:00) в часовом поясе tz
+    в Unix-время. От часового пояса сервера результат не зависит.
+    Возвращает None, если дату не удалось разобрать.
+    """
+    if not deadline:
+        return None
+    try:
+        due = datetime.strptime(f"{deadline} {time or DEFAULT_TASK_TIME}", "%Y-%m-%d %H:%M")
+    except ValueError:
+        return None
+    return int(due.replace(tzinfo=get_zone(tz)).timestamp())
 
 # 🧱 Создание таблиц
 def create_tables():
+    """
+    Создаёт таблицы и применяет недостающие миграции схемы (см. migrations.py).
+    """
+    from migrations import migrate
+    migrate()
+    if get_connection().execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        print("auto_vacuum=INCREMENTAL не включён, место после архивации не возвращается: "
+              "остановите бота и выполните python database.py --incremental-vacuum")
+
+
+def enable_incremental_vacuum():
+    """
+    Однократное обслуживание базы, созданной до auto_vacuum=INCREMENTAL: переводит её в этот режим,
+    чтобы место после архивации возвращалось по частям (PRAGMA incremental_vacuum).
+    На существующей базе режим вступает в силу только после полного VACUUM — он переписывает
+    весь файл и держит блокировку записи всё это время, поэтому запускается вручную при
+    остановленном боте, а не при каждом старте.
+    """
     conn = get_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS tasks (
-        id TEXT PRIMARY KEY,
-        user_id INTEGER,
-        title TEXT,
-        deadline TEXT,
-        time TEXT,
-        calendar_event_id TEXT,
-        sheet_row INTEGER,
-        status TEXT,
-        msg_id INTEGER,
-        created_at TEXT,
-        completed_at TEXT,
-        hours_spent REAL
-    );
-    """)
-
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS pending_tasks (
-        user_id INTEGER PRIMARY KEY,
-        title TEXT,
-        deadline TEXT,
-        time TEXT,
-        assigned_by TEXT,
-        comment TEXT,
-        step TEXT,
-        messages TEXT,
-        files TEXT,
-        forwarded_from TEXT
-    );
-    """)
-
-    conn.commit()
-    conn.close()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        print("Режим auto_vacuum=INCREMENTAL уже включён")
+        return
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    print("Включён режим auto_vacuum=INCREMENTAL")
 
 # ✅ Tasks (основные задачи)
-def add_task(task):
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("""
-    INSERT INTO tasks (id, user_id, title, deadline, time, calendar_event_id, sheet_row,
-        status, msg_id, created_at, completed_at, hours_spent)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        task["id"],
-        task["user_id"],
-        task["title"],
-        task["deadline"],
-        task.get("time", "10:00"),
-        task["calendar_event_id"],
-        task["sheet_row"],
-        task["status"],
-        task["msg_id"],
-        task["created_at"],
-        task["completed_at"],
-        task["hours_spent"]
-    ))
-
-    conn.commit()
-    conn.close()
-
-def get_active_tasks(user_id=None, deadline=None):
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    query = "SELECT * FROM tasks WHERE status = 'active'"
+# effects — записи outbox (channel, kind, payload), которые фиксируются в той же транзакции,
+# что и изменение задачи (см. outbox.py)
+def add_task(task, effects=()):
+    """Сохраняет задачу и возвращает её due_at (для таймера напоминаний)."""
+    conn = get_connection()
+
+    with transaction(conn):
+        due_at = compute_due_at(
+            task["deadline"], task.get("time", DEFAULT_TASK_TIME), _user_timezone(conn, task["user_id"])
+        )
+        conn.execute("""
+        INSERT INTO tasks (id, user_id, title, deadline, time, calendar_event_id, sheet_row,
+            status, msg_id, created_at, completed_at, hours_spent, due_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            task["id"],
+            task["user_id"],
+            task["title"],
+            task["deadline"],
+            task.get("time", DEFAULT_TASK_TIME),
+            task["calendar_event_id"],
+            task["sheet_row"],
+            task["status"],
+            task["msg_id"],
+            task["created_at"],
+            task["completed_at"],
+            task["hours_spent"],
+            due_at
+        ))
+        _add_outbox(conn, task["id"], effects)
+
+    return due_at
+
+def get_active_tasks(user_id=None, deadline=None, columns=TASK_LIST_COLUMNS):
+    conn = get_connection()
+
+    query = f"SELECT {_columns_sql(columns)} FROM tasks WHERE status = 'active'"
     params = []
 
     if user_id:
@@ -86,218 +244,635 @@ def get_active_tasks(user_id=None, deadline=None):
         params.append(user_id)
 
     if deadline == "tomorrow":
-        tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
+        deadline = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
+
+    if deadline:
+        # Конкретная дата в формате YYYY-MM-DD
         query += " AND deadline = ?"
-        params.append(tomorrow)
+        params.append(deadline)
 
     # Добавляем сортировку по дате дедлайна и времени
-    query += " ORDER BY date(deadline), time"
+    # (deadline хранится как YYYY-MM-DD, поэтому сортировка по строке совпадает с сортировкой по дате
+    # и может обслуживаться индексом idx_tasks_status_deadline_time)
+    query += " ORDER BY deadline, time"
+
+    return conn.execute(query, params).fetchall()
+
+# 📄 Постраничный список активных задач пользователя (keyset-пагинация по (deadline, time, id))
+def get_active_tasks_page(user_id, after_cursor=None, limit=3, before_cursor=None, columns=TASK_LIST_COLUMNS):
+    """
+    Возвращает не более limit активных задач пользователя, отсортированных по (deadline, time, id).
+    after_cursor — id последней задачи предыдущей страницы (листаем вперёд),
+    before_cursor — id первой задачи следующей страницы (листаем назад).
+    Если задача-курсор уже не найдена, возвращается первая страница.
+    """
+    conn = get_connection()
+
+    cursor_id = before_cursor or after_cursor
+    key = None
+    if cursor_id:
+        key = conn.execute("SELECT deadline, time, id FROM tasks WHERE id = ?", (cursor_id,)).fetchone()
 
-    cursor.execute(query, params)
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    query = f"SELECT {_columns_sql(columns)} FROM tasks WHERE user_id = ? AND status = 'active'"
+    params = [user_id]
+
+    if key and before_cursor:
+        query += " AND (deadline, time, id) < (?, ?, ?) ORDER BY deadline DESC, time DESC, id DESC LIMIT ?"
+        rows = conn.execute(query, params + list(key) + [limit]).fetchall()
+        return rows[::-1]
+
+    if key:
+        query += " AND (deadline, time, id) > (?, ?, ?)"
+        params += list(key)
+
+    query += " ORDER BY deadline, time, id LIMIT ?"
+    return conn.execute(query, params + [limit]).fetchall()
+
+def count_active_tasks(user_id):
+    conn = get_connection()
+    row = conn.execute(
+        "SELECT COUNT(*) FROM tasks WHERE user_id = ? AND status = 'active'", (user_id,)
+    ).fetchone()
+    return row[0]
 
 # Обновленная функция для файла database.py
 
-def complete_task(task_id, hours_spent):
+def complete_task(task_id, hours_spent, effects=()):
     conn = get_connection()
-    cursor = conn.cursor()
     
     current_time = datetime.now().isoformat()
     
-    cursor.execute("""
-    UPDATE tasks
-    SET status = 'done',
-        completed_at = ?,
-        hours_spent = ?
-    WHERE id = ?
-    """, (current_time, hours_spent, task_id))
-
-    conn.commit()
-    conn.close()
+    with transaction(conn):
+        conn.execute("""
+        UPDATE tasks
+        SET status = 'done',
+            completed_at = ?,
+            hours_spent = ?
+        WHERE id = ?
+        """, (current_time, hours_spent, task_id))
+        _add_outbox(conn, task_id, effects)
     
     return current_time  # Возвращаем время завершения для использования в других функциях
 
-def update_task_deadline(task_id, new_deadline):
+def update_task_deadline(task_id, new_deadline, new_time=None, effects=()):
+    """
+    Переносит срок задачи. Если передано новое время — обновляет и его.
+    Возвращает новый due_at (None, если задача не найдена).
+    """
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-    UPDATE tasks SET deadline = ? WHERE id = ?
-    """, (new_deadline, task_id))
-    conn.commit()
-    conn.close()
+    with transaction(conn):
+        row = conn.execute("SELECT user_id, time FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        if row is None:
+            return None
+        if new_time is None:
+            new_time = row["time"]
+        due_at = compute_due_at(new_deadline, new_time, _user_timezone(conn, row["user_id"]))
+        conn.execute("""
+        UPDATE tasks SET deadline = ?, time = ?, due_at = ? WHERE id = ?
+        """, (new_deadline, new_time, due_at, task_id))
+        _add_outbox(conn, task_id, effects)
+    return due_at
 
 def update_task_status(task_id, status):
     conn = get_connection()
-    cursor = conn.cursor()
 
-    cursor.execute("""
-    UPDATE tasks 
-    SET status = ? 
-    WHERE id = ?
-    """, (status, task_id))
+    with transaction(conn):
+        conn.execute("""
+        UPDATE tasks 
+        SET status = ? 
+        WHERE id = ?
+        """, (status, task_id))
 
-    conn.commit()
-    conn.close()
     print(f"Статус задачи {task_id} обновлён на {status}")
 
-# 🔔 Задачи с дедлайном через 1 час
-# Улучшенная функция для database.py
-def get_tasks_due_in_one_hour():
+def get_tasks_due_on_by_user(deadline, columns=TASK_LIST_COLUMNS, timezone=None):
     """
-    Получает задачи, до дедлайна которых осталось примерно 1-1.5 часа.
-    Использует диапазон времени для более надежного обнаружения.
+    Активные задачи со сроком deadline (YYYY-MM-DD), сгруппированные по пользователю:
+    возвращает список пар (user_id, [задачи по времени]). Один запрос на всех пользователей.
+    Если передан timezone — только пользователи этого часового пояса.
     """
+    if "user_id" not in columns:
+        columns = ("user_id",) + tuple(columns)
     conn = get_connection()
-    cursor = conn.cursor()
+    query = f"""
+        SELECT {_columns_sql(columns)} FROM tasks
+        WHERE status = 'active' AND deadline = ?
+        AND {_ACTIVE_USER_SQL}
+    """
+    params = [deadline]
+    if timezone:
+        query += """
+        AND COALESCE((SELECT timezone FROM user_settings s WHERE s.user_id = tasks.user_id), ?) = ?
+        """
+        params += [DEFAULT_TIMEZONE, timezone]
+    query += " ORDER BY user_id, time"
+    rows = conn.execute(query, params)
+    return [(user_id, list(tasks)) for user_id, tasks in groupby(rows, key=lambda row: row["user_id"])]
+
+def get_tasks_by_ids(task_ids, columns=TASK_LIST_COLUMNS):
+    """
+    Возвращает задачи с указанными id одним запросом (порядок не гарантируется) — для напоминаний,
+    поэтому задачи неактивных пользователей (заблокировавших бота после загрузки таймера) пропускаются.
+    """
+    task_ids = list(task_ids)
+    if not task_ids:
+        return []
+    conn = get_connection()
+    placeholders = ", ".join("?" * len(task_ids))
+    return conn.execute(
+        f"SELECT {_columns_sql(columns)} FROM tasks WHERE id IN ({placeholders}) AND {_ACTIVE_USER_SQL}", task_ids
+    ).fetchall()
 
-    now = datetime.now()
-    
-    # Верхняя граница: задачи с дедлайном через 45-90 минут
-    min_time = now + timedelta(minutes=45)
-    max_time = now + timedelta(minutes=90)
-    
-    min_str = min_time.strftime("%Y-%m-%d %H:%M")
-    max_str = max_time.strftime("%Y-%m-%d %H:%M")
-    
-    print(f"Ищу задачи с дедлайном между {min_str} и {max_str}")
+def get_upcoming_due_tasks(after_epoch, user_id=None):
+    """
+    Активные задачи с дедлайном позже after_epoch — для заполнения таймера напоминаний.
+    Если передан user_id — только задачи этого пользователя.
+    """
+    conn = get_connection()
+    query = f"""
+        SELECT id, due_at FROM tasks
+        WHERE status = 'active' AND due_at > ?
+        AND {_ACTIVE_USER_SQL}
+    """
+    params = [after_epoch]
+    if user_id is not None:
+        query += " AND user_id = ?"
+        params.append(user_id)
+    return conn.execute(query + " ORDER BY due_at", params).fetchall()
 
-    cursor.execute("""
-        SELECT * FROM tasks
+def get_missed_hour_reminders(since_epoch, until_epoch, limit, columns=TASK_LIST_COLUMNS):
+    """
+    Активные задачи, дедлайн которых наступил в промежутке [since_epoch, until_epoch],
+    а напоминание за час так и не было отправлено (бот был остановлен).
+    Один запрос с ограничением limit — для догоняющего прохода при старте.
+    """
+    conn = get_connection()
+    return conn.execute(f"""
+        SELECT {_columns_sql(columns)} FROM tasks
         WHERE status = 'active'
-        AND datetime(deadline || ' ' || COALESCE(time, '10:00')) BETWEEN ? AND ?
-    """, (min_str, max_str))
+        AND due_at BETWEEN ? AND ?
+        AND NOT EXISTS (
+            SELECT 1 FROM notifications_sent n
+            WHERE n.task_id = tasks.id AND n.reminder_kind = ? AND n.due_at = tasks.due_at
+        )
+        AND {_ACTIVE_USER_SQL}
+        ORDER BY due_at DESC
+        LIMIT ?
+    """, (since_epoch, until_epoch, REMINDER_HOUR, limit)).fetchall()
+
+# 🔔 Журнал напоминаний
+# Ключ (task_id, reminder_kind, due_at): после переноса срока due_at меняется,
+# и напоминание по новому сроку снова можно отправить.
+REMINDER_HOUR = "hour"
+REMINDER_DAY = "day"
+# Не больше 999 параметров на запрос (3 на строку)
+LEDGER_CHUNK = 300
+
+def claim_reminders(kind, items):
+    """
+    Атомарно отмечает напоминания как отправляемые и возвращает только те пары
+    (task_id, due_at), которые ещё не были отмечены. Вызывается до отправки, поэтому
+    повторный запуск (или второй экземпляр бота) не отправит то же напоминание ещё раз.
+    """
+    items = list(items)
+    claimed = []
+    conn = get_connection()
+    with transaction(conn):
+        for start in range(0, len(items), LEDGER_CHUNK):
+            chunk = items[start:start + LEDGER_CHUNK]
+            values = ", ".join("(?, ?, ?)" for _ in chunk)
+            params = [value for task_id, due_at in chunk for value in (task_id, kind, due_at)]
+            claimed += [
+                (row[0], row[1]) for row in conn.execute(
+                    f"INSERT OR IGNORE INTO notifications_sent (task_id, reminder_kind, due_at) "
+                    f"VALUES {values} RETURNING task_id, due_at",
+                    params
+                ).fetchall()
+            ]
+    return claimed
+
+def release_reminders(kind, items):
+    """Снимает отметку с напоминаний, которые не удалось отправить (их можно отправить снова)."""
+    conn = get_connection()
+    with transaction(conn):
+        conn.executemany(
+            "DELETE FROM notifications_sent WHERE task_id = ? AND reminder_kind = ? AND due_at = ?",
+            [(task_id, kind, due_at) for task_id, due_at in items]
+        )
+
+# 👑 Аренда ведущего экземпляра
+def acquire_lease(name, holder, ttl):
+    """
+    Берёт или продлевает аренду name на ttl секунд. Удаётся, если аренды нет, она истекла
+    или уже принадлежит holder. Одна атомарная команда, поэтому два экземпляра
+    не могут получить аренду одновременно.
+    """
+    now = datetime.now().timestamp()
+    conn = get_connection()
+    with transaction(conn):
+        row = conn.execute("""
+        INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+        WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+        RETURNING holder
+        """, (name, holder, now + ttl, now)).fetchone()
+    return row is not None
+
+def release_lease(name, holder):
+    conn = get_connection()
+    with transaction(conn):
+        conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
 
-    rows = cursor.fetchall()
-    conn.close()
-    
-    if rows:
-        print(f"Найдено {len(rows)} задач с приближающимся дедлайном")
-    
-    return rows
+# 🌍 Настройки пользователя: часовой пояс
+def _user_timezone(conn, user_id):
+    row = conn.execute("SELECT timezone FROM user_settings WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else DEFAULT_TIMEZONE
 
-# ⏳ Pending tasks (в процессе заполнения)
-def add_pending_task(user_id, data: dict):
-    conn = get_connection()
-    cursor = conn.cursor()
+def get_user_timezone(user_id):
+    return _user_timezone(get_connection(), user_id)
 
-    cursor.execute("REPLACE INTO pending_tasks (user_id, step, messages, files, forwarded_from) VALUES (?, ?, ?, ?, ?)", (
-        user_id,
-        data.get("step"),
-        json.dumps(data.get("messages", [])),
-        json.dumps(data.get("files", [])),
-        data.get("forwarded_from")
-    ))
+def set_user_timezone(user_id, timezone, effects=()):
+    """
+    Сохраняет часовой пояс пользователя и пересчитывает due_at его активных задач
+    (срок задаётся в местном времени). Записи outbox effects добавляются для каждой из них.
+    Возвращает пары (task_id, due_at) для таймера напоминаний.
+    """
+    conn = get_connection()
+    with transaction(conn):
+        conn.execute("""
+        INSERT INTO user_settings (user_id, timezone) VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET timezone = excluded.timezone
+        """, (user_id, timezone))
+        rows = conn.execute(
+            "SELECT id, deadline, time FROM tasks WHERE user_id = ? AND status = 'active'", (user_id,)
+        ).fetchall()
+        updated = [(compute_due_at(deadline, time, timezone), task_id) for task_id, deadline, time in rows]
+        conn.executemany("UPDATE tasks SET due_at = ? WHERE id = ?", updated)
+        for _, task_id in updated:
+            _add_outbox(conn, task_id, effects)
+    return [(task_id, due_at) for due_at, task_id in updated]
+
+def get_timezone_buckets():
+    """Часовые пояса, в которых есть пользователи (пояс по умолчанию — всегда)."""
+    conn = get_connection()
+    rows = conn.execute("SELECT DISTINCT timezone FROM user_settings WHERE active = 1").fetchall()
+    return sorted({DEFAULT_TIMEZONE} | {row[0] for row in rows})
 
-    conn.commit()
-    conn.close()
+def set_user_active(user_id, active):
+    """
+    Помечает пользователя активным или неактивным (бот заблокирован, чат не найден).
+    Возвращает True, если признак изменился.
+    """
+    conn = get_connection()
+    with transaction(conn):
+        row = conn.execute("""
+        INSERT INTO user_settings (user_id, timezone, active) VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET active = excluded.active
+        WHERE user_settings.active != excluded.active
+        RETURNING user_id
+        """, (user_id, DEFAULT_TIMEZONE, int(active))).fetchone()
+    return row is not None
+
+# 📮 Очередь повторной отправки сообщений
+# Сообщение, которое не удалось отправить из-за временной ошибки, сохраняется в send_retries
+# и отправляется снова с экспоненциальной задержкой. Строки «забираются» сдвигом next_attempt_at,
+# поэтому несколько экземпляров бота не отправят одно сообщение дважды.
+def add_send_retry(chat_id, payload, priority, attempts, next_attempt_at, error):
+    conn = get_connection()
+    with transaction(conn):
+        cursor = conn.execute("""
+        INSERT INTO send_retries (chat_id, payload, priority, attempts, next_attempt_at, last_error)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """, (chat_id, payload, priority, attempts, next_attempt_at, error))
+    return cursor.lastrowid
+
+def claim_due_send_retries(now, limit, lease_seconds):
+    """
+    Забирает до limit сообщений, время повтора которых наступило: откладывает их на
+    lease_seconds (если экземпляр упадёт, их заберёт другой) и возвращает строки.
+    """
+    conn = get_connection()
+    with transaction(conn):
+        return conn.execute("""
+        UPDATE send_retries SET next_attempt_at = ?
+        WHERE id IN (
+            SELECT id FROM send_retries WHERE next_attempt_at <= ?
+            ORDER BY next_attempt_at LIMIT ?
+        )
+        RETURNING id, chat_id, payload, priority, attempts
+        """, (now + lease_seconds, now, limit)).fetchall()
+
+def extend_send_retries(retry_ids, until):
+    """Продлевает аренду забранных повторов, которые ещё ждут отправки."""
+    conn = get_connection()
+    with transaction(conn):
+        conn.executemany(
+            "UPDATE send_retries SET next_attempt_at = ? WHERE id = ?",
+            [(until, retry_id) for retry_id in retry_ids]
+        )
 
-def get_pending_task(user_id):
+def reschedule_send_retry(retry_id, attempts, next_attempt_at, error):
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM pending_tasks WHERE user_id = ?", (user_id,))
-    row = cursor.fetchone()
+    with transaction(conn):
+        conn.execute("""
+        UPDATE send_retries SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?
+        """, (attempts, next_attempt_at, error, retry_id))
 
-    if not row:
-        conn.close()
-        return None
+def delete_send_retry(retry_id):
+    conn = get_connection()
+    with transaction(conn):
+        conn.execute("DELETE FROM send_retries WHERE id = ?", (retry_id,))
+
+# 📤 Outbox: изменения задач, которые нужно доставить в Google
+# Записи одной задачи в одном канале (sheets, calendar) выполняются строго по порядку:
+# забрать можно только «голову» — самую раннюю ожидающую запись. Пока голова не доставлена
+# (или не признана безнадёжной — status = 'dead'), следующие записи задачи ждут.
+# Забранная запись откладывается на lease_seconds, как и в send_retries.
+def _add_outbox(conn, task_id, effects):
+    now = datetime.now().timestamp()
+    conn.executemany("""
+    INSERT INTO outbox (task_id, channel, kind, payload, next_attempt_at, created_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    """, [(task_id, channel, kind, json.dumps(payload, ensure_ascii=False), now, now)
+          for channel, kind, payload in effects])
+
+def claim_outbox(channel, now, limit, lease_seconds):
+    """
+    Забирает до limit записей канала channel, время которых наступило, — не больше одной
+    (головной) на задачу. Возвращает строки с id, task_id, kind, payload, attempts, created_at.
+    """
+    conn = get_connection()
+    with transaction(conn):
+        return conn.execute("""
+        UPDATE outbox SET next_attempt_at = ?
+        WHERE id IN (
+            SELECT o.id FROM (
+                SELECT MIN(id) AS id FROM outbox
+                WHERE channel = ? AND status = 'pending'
+                GROUP BY task_id
+            ) head
+            JOIN outbox o ON o.id = head.id
+            WHERE o.next_attempt_at <= ?
+            ORDER BY o.next_attempt_at LIMIT ?
+        )
+        RETURNING id, task_id, kind, payload, attempts, created_at
+        """, (now + lease_seconds, channel, now, limit)).fetchall()
+
+def complete_outbox(outbox_id):
+    conn = get_connection()
+    with transaction(conn):
+        conn.execute("DELETE FROM outbox WHERE id = ?", (outbox_id,))
 
-    columns = [column[0] for column in cursor.description]
-    result = dict(zip(columns, row))
-    conn.close()
+def reschedule_outbox(outbox_id, attempts, next_attempt_at, error):
+    conn = get_connection()
+    with transaction(conn):
+        conn.execute("""
+        UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?
+        """, (attempts, next_attempt_at, error, outbox_id))
 
-    # Преобразуем JSON-строки в списки
-    for key in ["messages", "files"]:
-        try:
-            result[key] = json.loads(result[key]) if result[key] else []
-        except:
-            result[key] = []
+def fail_outbox(outbox_id, attempts, error):
+    """Помечает запись безнадёжной: она остаётся в таблице для разбора и больше не блокирует очередь задачи."""
+    conn = get_connection()
+    with transaction(conn):
+        conn.execute("""
+        UPDATE outbox SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?
+        """, (attempts, error, outbox_id))
 
+# ⏳ Pending tasks (в процессе заполнения)
+#
+# Черновики читаются и меняются на каждом шаге диалога, поэтому они держатся в LRU-кэше в памяти.
+# Запись сквозная (write-through): база обновляется сразу, но только изменившимися колонками.
+# Отсутствие черновика тоже кэшируется, чтобы route_message не ходил в базу на каждое сообщение.
+# Кэш верен, пока черновики меняет один процесс: сообщения принимает только держатель аренды
+# polling (см. main.py), и, получив её, он очищает черновики вместе с кэшем (clear_pending_tasks).
+PENDING_CACHE_SIZE = 1024
+PENDING_JSON_COLUMNS = ("messages", "files")
+
+_pending_cache = OrderedDict()
+_pending_cache_lock = threading.RLock()
+_MISSING = object()
+
+
+def _pending_cache_put(user_id, value):
+    with _pending_cache_lock:
+        _pending_cache[user_id] = value
+        _pending_cache.move_to_end(user_id)
+        while len(_pending_cache) > PENDING_CACHE_SIZE:
+            _pending_cache.popitem(last=False)
+
+
+def _copy_pending(pending):
+    # Вызывающий код меняет словарь и списки на месте — отдаём копию, чтобы не портить кэш
+    result = dict(pending)
+    for key in PENDING_JSON_COLUMNS:
+        if isinstance(result.get(key), list):
+            result[key] = list(result[key])
     return result
 
-def update_pending_task(user_id, updates: dict):
+
+def _load_pending(user_id):
+    """Возвращает закэшированный черновик (без копирования) или None."""
+    # Промах тоже читается под блокировкой: иначе устаревшая строка могла бы
+    # перезаписать в кэше результат параллельного update_pending_task
+    with _pending_cache_lock:
+        cached = _pending_cache.get(user_id, None)
+        if cached is not None:
+            _pending_cache.move_to_end(user_id)
+            return None if cached is _MISSING else cached
+
+        conn = get_connection()
+        row = conn.execute(
+            f"SELECT {', '.join(PENDING_COLUMNS)} FROM pending_tasks WHERE user_id = ?", (user_id,)
+        ).fetchone()
+
+        if not row:
+            _pending_cache_put(user_id, _MISSING)
+            return None
+
+        result = dict(row)
+
+        # Преобразуем JSON-строки в списки
+        for key in PENDING_JSON_COLUMNS:
+            try:
+                result[key] = json.loads(result[key]) if result[key] else []
+            except:
+                result[key] = []
+
+        _pending_cache_put(user_id, result)
+        return result
+
+
+def add_pending_task(user_id, data: dict):
     conn = get_connection()
-    cursor = conn.cursor()
 
-    # Загружаем текущую задачу
-    cursor.execute("SELECT * FROM pending_tasks WHERE user_id = ?", (user_id,))
-    row = cursor.fetchone()
+    with _pending_cache_lock:
+        with transaction(conn):
+            # Новый черновик начинается с чистого листа — фрагменты прошлого удаляем
+            conn.execute("DELETE FROM pending_fragments WHERE user_id = ?", (user_id,))
+            conn.execute("REPLACE INTO pending_tasks (user_id, step, messages, files, forwarded_from) VALUES (?, ?, ?, ?, ?)", (
+                user_id,
+                data.get("step"),
+                json.dumps(data.get("messages", [])),
+                json.dumps(data.get("files", [])),
+                data.get("forwarded_from")
+            ))
+
+        pending = dict.fromkeys(PENDING_COLUMNS)
+        pending.update(
+            user_id=user_id,
+            step=data.get("step"),
+            messages=list(data.get("messages", [])),
+            files=list(data.get("files", [])),
+            forwarded_from=data.get("forwarded_from"),
+        )
+        _pending_cache_put(user_id, pending)
 
-    if not row:
-        conn.close()
-        return
+def get_pending_task(user_id):
+    pending = _load_pending(user_id)
+    return _copy_pending(pending) if pending is not None else None
+
+def update_pending_task(user_id, updates: dict):
+    with _pending_cache_lock:
+        existing = _load_pending(user_id)
+        if existing is None:
+            return
+
+        # Оставляем только реально изменившиеся колонки
+        changed = {}
+        for key, value in updates.items():
+            if key == "user_id" or key not in PENDING_COLUMNS:
+                continue
+            if existing.get(key) != value:
+                changed[key] = value
 
-    columns = [column[0] for column in cursor.description]
-    existing = dict(zip(columns, row))
-
-    # Обновляем поля
-    for key, value in updates.items():
-        if key in ["messages", "files"] and isinstance(value, list):
-            existing[key] = json.dumps(value)
-        else:
-            existing[key] = value
-
-    # Преобразуем JSON-списки обратно, если нужно
-    if isinstance(existing["messages"], list):
-        existing["messages"] = json.dumps(existing["messages"])
-    if isinstance(existing["files"], list):
-        existing["files"] = json.dumps(existing["files"])
-
-    # Записываем всё
-    cursor.execute("""
-        UPDATE pending_tasks SET
-            title = ?,
-            deadline = ?,
-            time = ?,
-            assigned_by = ?,
-            comment = ?,
-            step = ?,
-            messages = ?,
-            files = ?,
-            forwarded_from = ?
-        WHERE user_id = ?
-    """, (
-        existing.get("title"),
-        existing.get("deadline"),
-        existing.get("time"),
-        existing.get("assigned_by"),
-        existing.get("comment"),
-        existing.get("step"),
-        existing.get("messages"),
-        existing.get("files"),
-        existing.get("forwarded_from"),
-        user_id
-    ))
-
-    conn.commit()
-    conn.close()
+        if not changed:
+            return
+
+        params = [
+            json.dumps(value) if key in PENDING_JSON_COLUMNS and isinstance(value, list) else value
+            for key, value in changed.items()
+        ]
+        assignments = ", ".join(f"{key} = ?" for key in changed)
+
+        conn = get_connection()
+        with transaction(conn):
+            conn.execute(f"UPDATE pending_tasks SET {assignments} WHERE user_id = ?", params + [user_id])
+
+        updated = dict(existing)
+        for key, value in changed.items():
+            updated[key] = list(value) if isinstance(value, list) else value
+        _pending_cache_put(user_id, updated)
 
 
 
 def delete_pending_task(user_id):
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM pending_tasks WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    with _pending_cache_lock:
+        with transaction(conn):
+            conn.execute("DELETE FROM pending_fragments WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM pending_tasks WHERE user_id = ?", (user_id,))
+        _pending_cache_put(user_id, _MISSING)
+
+def invalidate_pending_cache():
+    """Сбрасывает кэш черновиков (например, если групповая транзакция не зафиксировалась)."""
+    with _pending_cache_lock:
+        _pending_cache.clear()
+
+def clear_pending_tasks():
+    """Удаляет все незавершённые черновики задач (при получении аренды приёма сообщений)."""
+    conn = get_connection()
+    with _pending_cache_lock:
+        with transaction(conn):
+            conn.execute("DELETE FROM pending_fragments")
+            conn.execute("DELETE FROM pending_tasks")
+        _pending_cache.clear()
+
+# 🧩 Фрагменты черновика
+# Во время сбора каждое сообщение дописывается отдельной строкой, а не перезаписью JSON-массива,
+# поэтому сбор n сообщений стоит O(n), а не O(n²). Списки messages/files собираются один раз — в
+# consolidate_pending_fragments, когда пользователь нажимает «Готово».
+def add_pending_fragment(user_id, text=None, file_name=None, forwarded_from=None):
+    conn = get_connection()
+    with transaction(conn):
+        conn.execute("""
+        INSERT INTO pending_fragments (user_id, seq, text, file_name, forwarded_from)
+        SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ? FROM pending_fragments WHERE user_id = ?
+        """, (user_id, text, file_name, forwarded_from, user_id))
+
+def consolidate_pending_fragments(user_id):
+    """
+    Переносит накопленные фрагменты в messages/files черновика (по порядку seq) и удаляет их.
+    Если отправитель черновика ещё не известен, берётся первый найденный во фрагментах.
+    Возвращает обновлённый черновик или None, если черновика нет.
+    """
+    conn = get_connection()
+    with _pending_cache_lock:
+        existing = _load_pending(user_id)
+        if existing is None:
+            return None
+
+        messages = list(existing.get("messages") or [])
+        files = list(existing.get("files") or [])
+        sender = existing.get("forwarded_from")
+
+        # Курсор читается построчно, без загрузки всех фрагментов в память разом
+        cursor = conn.execute(
+            "SELECT text, file_name, forwarded_from FROM pending_fragments WHERE user_id = ? ORDER BY seq",
+            (user_id,)
+        )
+        count = 0
+        for text, file_name, forwarded_from in cursor:
+            count += 1
+            messages.append(text)
+            if file_name:
+                files.append(file_name)
+            if not sender and forwarded_from:
+                sender = forwarded_from
+
+        if count:
+            with transaction(conn):
+                conn.execute(
+                    "UPDATE pending_tasks SET messages = ?, files = ?, forwarded_from = ? WHERE user_id = ?",
+                    (json.dumps(messages), json.dumps(files), sender, user_id)
+                )
+                conn.execute("DELETE FROM pending_fragments WHERE user_id = ?", (user_id,))
+
+            updated = dict(existing, messages=messages, files=files, forwarded_from=sender)
+            _pending_cache_put(user_id, updated)
+            existing = updated
+
+        return _copy_pending(existing)
 
 # Добавьте эту функцию в database.py, если она еще не существует
 
-def get_task_by_id(task_id):
+def get_task_by_id(task_id, columns=TASK_COLUMNS):
     """
     Получить задачу по её ID.
-    Возвращает кортеж с данными задачи или None, если задача не найдена.
+    Возвращает строку (sqlite3.Row) с запрошенными колонками или None, если задача не найдена.
     """
     conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT * FROM tasks WHERE id = ?", (task_id,))
-    task = cursor.fetchone()
-    
-    conn.close()
+    columns_sql = _columns_sql(columns)
+    task = conn.execute(f"SELECT {columns_sql} FROM tasks WHERE id = ?", (task_id,)).fetchone()
+    if task is None:
+        # Старые выполненные задачи переносятся в архив
+        task = conn.execute(f"SELECT {columns_sql} FROM tasks_archive WHERE id = ?", (task_id,)).fetchone()
     return task
 
+def update_calendar_event(task_id, event_id, etag):
+    """Сохраняет ID и ETag события календаря после его обновления (или пересоздания)."""
+    conn = get_connection()
+    with transaction(conn):
+        conn.execute(
+            "UPDATE tasks SET calendar_event_id = ?, calendar_etag = ? WHERE id = ?",
+            (event_id, etag, task_id)
+        )
+
+def update_sheet_row(task_id, sheet_row):
+    """Сохраняет номер строки задачи в Google Sheets."""
+    conn = get_connection()
+    with transaction(conn):
+        conn.execute("UPDATE tasks SET sheet_row = ? WHERE id = ?", (sheet_row, task_id))
+
 # Функция для сохранения комментария к выполненной задаче
 def add_completion_comment(task_id, comment):
     """
@@ -305,52 +880,72 @@ def add_completion_comment(task_id, comment):
     Обновляет поле comment в таблице tasks.
     """
     conn = get_connection()
-    cursor = conn.cursor()
     
-    cursor.execute("""
-    UPDATE tasks
-    SET comment = ?
-    WHERE id = ?
-    """, (comment, task_id))
-    
-    conn.commit()
-    conn.close()
+    with transaction(conn):
+        conn.execute("""
+        UPDATE tasks
+        SET comment = ?
+        WHERE id = ?
+        """, (comment, task_id))
     
     return True
 
-# Добавляем новую функцию в database.py для добавления колонки
+# 🗄 Архивация выполненных задач
+ARCHIVE_BATCH_SIZE = 500
+VACUUM_PAGES_PER_BATCH = 1000
 
-def add_comment_column():
+def archive_completed_tasks(older_than_days, batch_size=ARCHIVE_BATCH_SIZE):
     """
-    Добавляет колонку comment в таблицу tasks, если она еще не существует.
+    Переносит выполненные задачи, завершённые раньше чем older_than_days дней назад,
+    из tasks в tasks_archive. Работает пачками по batch_size строк (каждая — отдельная
+    короткая транзакция), после каждой пачки возвращает освободившиеся страницы.
+    Возвращает количество перенесённых задач.
     """
     conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Проверяем, существует ли уже колонка comment
-    cursor.execute("PRAGMA table_info(tasks)")
-    columns = cursor.fetchall()
-    column_names = [col[1] for col in columns]
-    
-    if "comment" not in column_names:
-        # Добавляем колонку comment
-        try:
-            cursor.execute("ALTER TABLE tasks ADD COLUMN comment TEXT")
-            print("Колонка comment успешно добавлена в таблицу tasks")
-        except sqlite3.OperationalError as e:
-            print(f"Ошибка при добавлении колонки: {e}")
-    else:
-        print("Колонка comment уже существует в таблице tasks")
-    
-    conn.commit()
-    conn.close()
-
-# Добавьте вызов этой функции в блок if __name__ == "__main__": в конце файла
-
-if __name__ == "__main__":
-    create_tables()
-    add_comment_column()  # Добавьте эту строку
+    cutoff = (datetime.now() - timedelta(days=older_than_days)).isoformat()
+    # sent_at заполняется CURRENT_TIMESTAMP, то есть в UTC, а completed_at — в локальном времени
+    sent_cutoff = (datetime.now(ZoneInfo("UTC")) - timedelta(days=older_than_days)).strftime("%Y-%m-%d %H:%M:%S")
+    columns = ", ".join(TASK_COLUMNS)
+    moved = 0
+
+    while True:
+        with transaction(conn):
+            ids = [row[0] for row in conn.execute("""
+                SELECT id FROM tasks
+                WHERE status = 'done' AND completed_at < ?
+                LIMIT ?
+            """, (cutoff, batch_size))]
+
+            if not ids:
+                break
+
+            placeholders = ", ".join("?" * len(ids))
+            conn.execute(
+                f"INSERT OR REPLACE INTO tasks_archive ({columns}) "
+                f"SELECT {columns} FROM tasks WHERE id IN ({placeholders})",
+                ids
+            )
+            conn.execute(f"DELETE FROM tasks WHERE id IN ({placeholders})", ids)
+
+        moved += len(ids)
+        conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_BATCH})").fetchall()
+
+        if len(ids) < batch_size:
+            break
+
+    # Старые записи журнала напоминаний больше не нужны
+    with transaction(conn):
+        conn.execute("DELETE FROM notifications_sent WHERE sent_at < ?", (sent_cutoff,))
+
+    if moved:
+        conn.execute("PRAGMA incremental_vacuum").fetchall()
+        print(f"Перенесено в архив {moved} выполненных задач")
+    return moved
 
 # 🛠 Инициализация таблиц при первом запуске
+# python database.py --incremental-vacuum — однократный перевод старой базы в auto_vacuum=INCREMENTAL
 if __name__ == "__main__":
+    import sys
     create_tables()
+    if "--incremental-vacuum" in sys.argv[1:]:
+        enable_incremental_vacuum()
@@ -0,0 +1,117 @@
+# google_async.py
+#
+# Асинхронный фасад над блокирующими клиентами Google (gspread, googleapiclient).
+# Каждый вызов API занимает от сотен миллисекунд до секунд, поэтому в event loop его делать нельзя:
+# - у каждого сервиса свой ограниченный пул потоков: медленные Sheets не занимают потоки Calendar
+#   и наоборот, а число одновременных запросов к одному API не превышает размер пула;
+# - вызов ждёт результата не дольше таймаута сервиса; если он ещё стоит в очереди, он снимается,
+#   если уже выполняется — поток дорабатывает, но обработчик больше его не ждёт;
+# - глубина очереди и число выполняемых запросов видны в metrics.snapshot(),
+#   время вызовов, таймауты и ошибки — в гистограммах и счётчиках.
+
+import asyncio
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import google_calendar
+import google_sheets
+import metrics
+
+SHEETS_THREADS = int(os.getenv("GOOGLE_SHEETS_THREADS", "2"))
+CALENDAR_THREADS = int(os.getenv("GOOGLE_CALENDAR_THREADS", "4"))
+SHEETS_TIMEOUT = float(os.getenv("GOOGLE_SHEETS_TIMEOUT", "30"))  # секунды
+CALENDAR_TIMEOUT = float(os.getenv("GOOGLE_CALENDAR_TIMEOUT", "30"))  # секунды
+
+
+class ServiceExecutor:
+    """Ограниченный пул потоков для одного внешнего сервиса."""
+
+    def __init__(self, name, max_workers, timeout):
+        self.name = name
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"google-{name}")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        metrics.register_gauge(f"google_queue_depth.{name}", lambda: self.queued)
+        metrics.register_gauge(f"google_inflight.{name}", lambda: self.running)
+
+    def _invoke(self, func, enqueued_at):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        metrics.observe(f"google_queue_wait_seconds.{self.name}", time.monotonic() - enqueued_at)
+        started = time.perf_counter()
+        try:
+            return func()
+        except Exception:
+            metrics.inc(f"google_errors_total.{self.name}")
+            raise
+        finally:
+            metrics.observe(f"google_call_seconds.{self.name}", time.perf_counter() - started)
+            with self._lock:
+                self.running -= 1
+
+    def _dequeue_cancelled(self, future):
+        # Вызов снят до начала выполнения: _invoke не запустится и счётчик не уменьшит
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    async def call(self, func, *args, timeout=None, **kwargs):
+        """Выполняет func(*args, **kwargs) в пуле сервиса и ждёт результата не дольше timeout секунд."""
+        with self._lock:
+            self.queued += 1
+        future = self._executor.submit(self._invoke, functools.partial(func, *args, **kwargs), time.monotonic())
+        future.add_done_callback(self._dequeue_cancelled)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            metrics.inc(f"google_timeouts_total.{self.name}")
+            raise
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+sheets = ServiceExecutor("sheets", SHEETS_THREADS, SHEETS_TIMEOUT)
+calendar = ServiceExecutor("calendar", CALENDAR_THREADS, CALENDAR_TIMEOUT)
+
+
+def shutdown():
+    """Снимает вызовы из очередей и дожидается выполняемых."""
+    sheets.shutdown()
+    calendar.shutdown()
+
+
+# 📊 Sheets
+async def add_task_to_sheet(task):
+    return await sheets.call(google_sheets.add_task_to_sheet, task)
+
+
+async def update_task_in_sheet(row, status, hours=None, comment=None):
+    return await sheets.call(google_sheets.update_task_in_sheet, row, status, hours, comment)
+
+
+async def update_deadline_in_sheet(row, new_deadline):
+    return await sheets.call(google_sheets.update_deadline_in_sheet, row, new_deadline)
+
+
+# 📅 Calendar
+async def ensure_event(task, event_id):
+    return await calendar.call(google_calendar.ensure_event, task, event_id)
+
+
+async def move_event(task, force_on_conflict=True):
+    return await calendar.call(google_calendar.move_event, task, force_on_conflict)
+
+
+async def remove_event(event_id):
+    return await calendar.call(google_calendar.remove_event, event_id)
+
+
+async def batch_calendar_operations(operations, max_rounds=google_calendar.BATCH_MAX_ROUNDS):
+    return await calendar.call(google_calendar.batch_calendar_operations, operations, None, max_rounds)
@@ -3,9 +3,12 @@ from googleapiclient.discovery import build
 from datetime import datetime, timedelta
 import os
 import logging
-import json
+import threading
+import time
 import traceback
 
+from database import DEFAULT_TIMEZONE
+
 # Настраиваем логирование для этого модуля
 logger = logging.getLogger('google_calendar')
 if not logger.handlers:
@@ -117,8 +120,25 @@ def normalize_date(date_str):
     return f"{year}-{month:02d}-{day:02d}"
 
 
-def get_calendar_service():
-    try:
+# 🔌 Сервис Calendar API
+# Учётные данные создаются один раз на процесс: обновлённый access token переиспользуется всеми
+# вызовами до истечения срока (google-auth обновляет его сам). Сервис строится по встроенному
+# (статическому) discovery-документу без HTTP-запроса и кэшируется на поток, потому что
+# httplib2, на котором он работает, не потокобезопасен. Проверка доступа к календарю
+# выполняется один раз при старте (probe_calendar), а не при каждом обращении.
+CALENDAR_SCOPES = ["https://www.googleapis.com/auth/calendar"]
+
+_credentials = None
+_credentials_lock = threading.Lock()
+_local = threading.local()
+
+
+def _get_credentials():
+    global _credentials
+    with _credentials_lock:
+        if _credentials is not None:
+            return _credentials
+
         refresh_token = os.getenv("GOOGLE_REFRESH_TOKEN")
         client_id = os.getenv("GOOGLE_CLIENT_ID")
         client_secret = os.getenv("GOOGLE_CLIENT_SECRET")
@@ -140,229 +160,319 @@ def get_calendar_service():
 
         logger.info(f"Данные для аутентификации: client_id={client_id[:5]}..., refresh_token={refresh_token[:5] if refresh_token else None}...")
 
-        try:
-            creds = Credentials(
-                token=None,
-                refresh_token=refresh_token,
-                token_uri="https://oauth2.googleapis.com/token",
-                client_id=client_id,
-                client_secret=client_secret,
-                scopes=["https://www.googleapis.com/auth/calendar"]
-            )
-            logger.debug("Объект учетных данных создан")
-
-            service = build("calendar", "v3", credentials=creds)
-            logger.info("Сервис календаря успешно создан")
-
-            # Проверим подключение, запросив список календарей
-            try:
-                calendar_list = service.calendarList().list().execute()
-                calendar_count = len(calendar_list.get('items', []))
-                logger.info(f"Успешное подключение к Google Calendar API. Доступно {calendar_count} календарей.")
-            except Exception as cal_error:
-                logger.error(f"Подключение создано, но при запросе календарей возникла ошибка: {cal_error}")
-                logger.debug(f"Подробности ошибки: {traceback.format_exc()}")
-
-            return service
-        except Exception as cred_error:
-            logger.error(f"Ошибка при создании учетных данных: {cred_error}")
-            logger.debug(f"Детали ошибки: {traceback.format_exc()}")
-            raise
+        _credentials = Credentials(
+            token=None,
+            refresh_token=refresh_token,
+            token_uri="https://oauth2.googleapis.com/token",
+            client_id=client_id,
+            client_secret=client_secret,
+            scopes=CALENDAR_SCOPES
+        )
+        logger.debug("Объект учетных данных создан")
+        return _credentials
+
+
+def get_calendar_service():
+    service = getattr(_local, "service", None)
+    if service is not None:
+        return service
+
+    try:
+        service = build(
+            "calendar", "v3",
+            credentials=_get_credentials(),
+            static_discovery=True,
+            cache_discovery=False
+        )
+        logger.info(f"Сервис календаря создан для потока {threading.current_thread().name}")
     except Exception as e:
         logger.error(f"ОШИБКА при создании сервиса календаря: {e}")
         logger.debug(f"Полная трассировка: {traceback.format_exc()}")
         raise
 
-def create_event(task):
-    try:
-        logger.info(f"Начинаю создание события календаря для задачи: {task['title']}")
-
-        # Проверяем наличие ID календаря
-        calendar_id = os.getenv("GOOGLE_CALENDAR_ID")
-        if not calendar_id:
-            logger.error("GOOGLE_CALENDAR_ID отсутствует или пустой")
-            raise ValueError("GOOGLE_CALENDAR_ID отсутствует или пустой")
-
-        logger.debug(f"ID календаря: {calendar_id}")
-
-        # Получаем сервис
-        service = get_calendar_service()
-        logger.info(f"Сервис календаря получен")
-
-        # Используем normalize_date для преобразования формата даты
-        iso_date = normalize_date(task['deadline'])
-        start_time_str = f"{iso_date}T{task['time']}:00"
-        logger.debug(f"Дата и время начала: {start_time_str}")
-
-        start_time = datetime.fromisoformat(start_time_str)
-        end_time = start_time + timedelta(hours=1)
-
-        event = {
-            "summary": task["title"],
-            "start": {
-                "dateTime": start_time.isoformat(),
-                "timeZone": "Asia/Yekaterinburg"
-            },
-            "end": {
-                "dateTime": end_time.isoformat(),
-                "timeZone": "Asia/Yekaterinburg"
-            },
-            "description": f"Задача из Telegram-бота",
-        }
-        logger.debug(f"Сформирован объект события: {event}")
-
-        # Попытка создать событие
-        try:
-            created_event = service.events().insert(
-                calendarId=calendar_id,
-                body=event
-        ).execute()
+    _local.service = service
+    return service
 
-            event_id = created_event.get("id")
-            logger.info(f"Событие успешно создано в календаре, ID: {event_id}")
-            return event_id
-        except Exception as insert_error:
-            logger.error(f"Ошибка при вставке события в календарь: {insert_error}")
 
-            # Проверим, действителен ли календарь
-            try:
-                service.calendars().get(calendarId=calendar_id).execute()
-                logger.info(f"Календарь с ID {calendar_id} существует и доступен")
-            except Exception as cal_error:
-                logger.error(f"Календарь с ID {calendar_id} не найден или недоступен: {cal_error}")
-
-            # Перебросим ошибку дальше
-            raise
+def probe_calendar():
+    """
+    Однократная проверка при запуске: учётные данные действительны и календарь
+    GOOGLE_CALENDAR_ID доступен. Заодно получает первый access token.
+    Возвращает True/False, ошибки только логирует — бот продолжает работу без календаря.
+    """
+    calendar_id = os.getenv("GOOGLE_CALENDAR_ID")
+    if not calendar_id:
+        logger.error("GOOGLE_CALENDAR_ID отсутствует или пустой")
+        return False
+    try:
+        calendar = get_calendar_service().calendars().get(calendarId=calendar_id).execute()
+        logger.info(f"Успешное подключение к Google Calendar API, календарь: {calendar.get('summary', calendar_id)}")
+        return True
     except Exception as e:
-        logger.error(f"ОШИБКА при создании события в календаре: {e}")
-        logger.debug(f"Трассировка: {traceback.format_exc()}")
+        logger.error(f"Календарь {calendar_id} недоступен: {e}")
+        logger.debug(f"Подробности ошибки: {traceback.format_exc()}")
+        return False
 
-        # Записываем всю доступную информацию
-        error_details = {
-            'error_type': type(e).__name__,
-            'error_message': str(e),
-            'task': task
-        }
-        logger.error(f"Детали ошибки: {json.dumps(error_details, ensure_ascii=False)}")
+def event_times(deadline, time_str, timezone=None):
+    """Поля start/end события: час начиная со срока задачи в часовом поясе timezone."""
+    iso_date = normalize_date(deadline)
+    start_time = datetime.fromisoformat(f"{iso_date}T{time_str}:00")
+    end_time = start_time + timedelta(hours=1)
+    timezone = timezone or DEFAULT_TIMEZONE
+    logger.debug(f"Дата и время начала: {start_time.isoformat()} ({timezone})")
+    return {
+        "start": {"dateTime": start_time.isoformat(), "timeZone": timezone},
+        "end": {"dateTime": end_time.isoformat(), "timeZone": timezone},
+    }
 
-        # В случае проблемы вернем None, чтобы бот мог продолжить работу
-        return None
 
+def event_id_for_task(task_id):
+    """
+    Постоянный ID события задачи. Календарь принимает ID клиента из символов base32hex
+    (0-9, a-v) длиной от 5 символов — шестнадцатеричный UUID задачи им подходит.
+    Повторная вставка с тем же ID не создаёт второе событие, а возвращает 409.
+    """
+    return task_id.replace("-", "").lower()
 
-def update_event(task):
-    try:
-        logger.info(f"Начинаю обновление события в календаре для задачи с ID: {task['calendar_event_id']}")
 
-        # Проверяем наличие ID календаря и ID события
-        calendar_id = os.getenv("GOOGLE_CALENDAR_ID")
-        if not calendar_id:
-            logger.error("GOOGLE_CALENDAR_ID отсутствует или пустой")
-            raise ValueError("GOOGLE_CALENDAR_ID отсутствует или пустой")
+def insert_event(task, event_id=None):
+    """
+    Создаёт событие задачи и возвращает ресурс события (с id и etag). Ошибки пробрасываются.
+    event_id — ID события, заданный клиентом (см. event_id_for_task).
+    """
+    # Проверяем наличие ID календаря
+    calendar_id = os.getenv("GOOGLE_CALENDAR_ID")
+    if not calendar_id:
+        logger.error("GOOGLE_CALENDAR_ID отсутствует или пустой")
+        raise ValueError("GOOGLE_CALENDAR_ID отсутствует или пустой")
 
-        if not task["calendar_event_id"]:
-            logger.error("ID события календаря отсутствует")
-            raise ValueError("ID события календаря отсутствует")
+    logger.debug(f"ID календаря: {calendar_id}")
 
-        logger.debug(f"ID календаря: {calendar_id}, ID события: {task['calendar_event_id']}")
+    service = get_calendar_service()
 
-        # Получаем сервис
-        service = get_calendar_service()
+    event = {
+        "summary": task["title"],
+        # Срок задачи — местное время пользователя
+        **event_times(task["deadline"], task["time"], task.get("timezone")),
+        "description": f"Задача из Telegram-бота",
+    }
+    if event_id:
+        event["id"] = event_id
+    logger.debug(f"Сформирован объект события: {event}")
 
-        iso_date = normalize_date(task['deadline'])
-        start_time_str = f"{iso_date}T{task['time']}:00"
-        logger.debug(f"Новая дата и время начала: {start_time_str}")
+    try:
+        return service.events().insert(calendarId=calendar_id, body=event).execute()
+    except Exception as insert_error:
+        # Доступность календаря проверяется при старте (probe_calendar), здесь — без лишних запросов
+        logger.error(f"Ошибка при вставке события в календарь {calendar_id}: {insert_error}")
+        raise
 
-        start_time = datetime.fromisoformat(start_time_str)
-        end_time = start_time + timedelta(hours=1)
 
-        # Получаем существующее событие
-        try:
-            event = service.events().get(
-                calendarId=calendar_id,
-                eventId=task["calendar_event_id"]
-            ).execute()
-            logger.debug(f"Получено существующее событие")
-        except Exception as get_error:
-            logger.error(f"Событие не найдено в календаре: {get_error}")
-            # Если событие не существует, создадим новое
-            logger.info("Создаю новое событие вместо обновления.")
-            new_task = {
-                "title": task.get("title", "Задача без названия"),
-                "deadline": task["deadline"],
-                "time": task["time"]
-            }
-            return create_event(new_task)
-
-        # Обновляем данные события
-        event["start"]["dateTime"] = start_time.isoformat()
-        event["end"]["dateTime"] = end_time.isoformat()
-
-        # Обновляем событие в календаре
-        try:
-            updated_event = service.events().update(
-                calendarId=calendar_id,
-                eventId=task["calendar_event_id"],
-                body=event
-            ).execute()
-
-            event_id = updated_event.get("id")
-            logger.info(f"Событие успешно обновлено в календаре, ID: {event_id}")
-            return event_id
-        except Exception as update_error:
-            logger.error(f"Ошибка при обновлении события в календаре: {update_error}")
-            raise
+def move_event(task, force_on_conflict=True):
+    """
+    Переносит событие задачи на новый срок одним запросом events().patch, в котором
+    передаются только поля start и end.
+    task — словарь с id задачи, calendar_event_id, deadline, time и необязательными timezone,
+    calendar_etag (ETag события, сохранённый при прошлом обновлении) и title.
+    Если ETag известен, запрос идёт с заголовком If-Match. Если событие с тех пор изменили
+    (412), при force_on_conflict срок всё равно переписывается (его перенёс сам пользователь),
+    иначе событие не трогается и возвращается None.
+    Если события больше нет (404/410), создаётся новое (ensure_event с ID из event_id_for_task).
+    Возвращает {"id", "etag"} обновлённого (или нового) события. Ошибки пробрасываются.
+    """
+    logger.info(f"Начинаю обновление события в календаре для задачи с ID: {task['calendar_event_id']}")
 
-    except Exception as e:
-        logger.error(f"ОШИБКА при обновлении события в календаре: {e}")
-        logger.debug(f"Трассировка: {traceback.format_exc()}")
+    # Проверяем наличие ID календаря и ID события
+    calendar_id = os.getenv("GOOGLE_CALENDAR_ID")
+    if not calendar_id:
+        logger.error("GOOGLE_CALENDAR_ID отсутствует или пустой")
+        raise ValueError("GOOGLE_CALENDAR_ID отсутствует или пустой")
+
+    if not task["calendar_event_id"]:
+        logger.error("ID события календаря отсутствует")
+        raise ValueError("ID события календаря отсутствует")
+
+    logger.debug(f"ID календаря: {calendar_id}, ID события: {task['calendar_event_id']}")
 
-        # Записываем детали ошибки
-        error_details = {
-            'error_type': type(e).__name__,
-            'error_message': str(e),
-            'task_id': task.get('calendar_event_id')
-        }
-        logger.error(f"Детали ошибки: {json.dumps(error_details, ensure_ascii=False)}")
+    service = get_calendar_service()
+    body = event_times(task["deadline"], task["time"], task.get("timezone"))
 
-        return None
+    def patch(etag):
+        request = service.events().patch(
+            calendarId=calendar_id,
+            eventId=task["calendar_event_id"],
+            body=body
+        )
+        if etag:
+            request.headers["If-Match"] = etag
+        return request.execute()
 
-def delete_event(event_id):
+    try:
+        try:
+            updated_event = patch(task.get("calendar_etag"))
+        except Exception as patch_error:
+            if _error_status(patch_error) != 412:
+                raise
+            logger.warning(f"Событие {task['calendar_event_id']} изменено в календаре после последней синхронизации")
+            if not force_on_conflict:
+                return None
+            updated_event = patch(None)
+    except Exception as patch_error:
+        if _error_status(patch_error) not in (404, 410):
+            logger.error(f"Ошибка при обновлении события в календаре: {patch_error}")
+            raise
+        # События больше нет — создаём новое (с тем же описанием, что и при создании задачи)
+        # с постоянным ID задачи: повтор после потерянного ответа не создаст второе событие
+        logger.info("Событие не найдено в календаре, создаю новое вместо обновления.")
+        created_event = ensure_event({
+            "title": task.get("title") or "Задача без названия",
+            "deadline": task["deadline"],
+            "time": task["time"],
+            "timezone": task.get("timezone")
+        }, event_id_for_task(task["id"]))
+        return {"id": created_event.get("id"), "etag": created_event.get("etag")}
+
+    event_id = updated_event.get("id")
+    logger.info(f"Событие успешно обновлено в календаре, ID: {event_id}")
+    return {"id": event_id, "etag": updated_event.get("etag")}
+
+
+def ensure_event(task, event_id):
     """
-    Удаляет событие из Google Calendar по его ID.
-    Корректно обрабатывает ситуации, когда событие не найдено.
+    Идемпотентное создание события: если событие с ID event_id уже есть (прошлая попытка
+    дошла до календаря, но ответ потерялся), возвращается оно. Ошибки пробрасываются.
     """
-    if not event_id or event_id == "generated_event_id" or event_id == "None":
-        print(f"Предупреждение: Попытка удалить событие с недопустимым ID: {event_id}")
-        return False
-        
     try:
-        service = get_calendar_service()
-        service.events().delete(
+        return insert_event(task, event_id)
+    except Exception as insert_error:
+        if _error_status(insert_error) != 409:
+            raise
+    logger.info(f"Событие {event_id} уже создано, использую существующее")
+    event = get_calendar_service().events().get(
+        calendarId=os.getenv("GOOGLE_CALENDAR_ID"),
+        eventId=event_id
+    ).execute()
+    if event.get("status") == "cancelled":
+        # Событие с этим ID было удалено — возвращаем его на место с актуальным сроком
+        event = get_calendar_service().events().patch(
             calendarId=os.getenv("GOOGLE_CALENDAR_ID"),
-            eventId=event_id
+            eventId=event_id,
+            body={"status": "confirmed", **event_times(task["deadline"], task["time"], task.get("timezone"))}
         ).execute()
-        print(f"Событие {event_id} успешно удалено из календаря")
-        return True
-    except Exception as e:
-        # Проверяем, является ли ошибка 404 Not Found
-        if hasattr(e, 'resp') and e.resp.status == 404:
-            print(f"Предупреждение: Событие {event_id} не найдено в календаре")
-        else:
-            print(f"Ошибка при удалении события из календаря: {e}")
-        return False
+    return event
 
 
-def add_task_to_calendar(title, date, time):
+def remove_event(event_id):
+    """Удаляет событие; уже удалённое (404/410) считается удалённым успешно. Прочие ошибки пробрасываются."""
     try:
-        print(f"Добавление задачи в календарь: '{title}', дата={date}, время={time}")
-        task = {
-            "title": title,
-            "deadline": date,
-            "time": time
-        }
-        return create_event(task)
+        get_calendar_service().events().delete(
+            calendarId=os.getenv("GOOGLE_CALENDAR_ID"),
+            eventId=event_id
+        ).execute()
+        logger.info(f"Событие {event_id} удалено из календаря")
     except Exception as e:
-        print(f"ОШИБКА при добавлении задачи в календарь: {e}")
-        import traceback
-        print(f"Трассировка: {traceback.format_exc()}")
-        return None
\ No newline at end of file
+        if _error_status(e) not in (404, 410):
+            raise
+        logger.info(f"Событие {event_id} уже отсутствует в календаре")
+
+
+# 📦 Пакетные операции
+# До BATCH_LIMIT операций уходят одним multipart-запросом (BatchHttpRequest). Результат
+# возвращается по каждой операции отдельно; повторяются только подзапросы, упавшие
+# с временной ошибкой (429, 5xx, превышение квоты), остальные сразу считаются неудачными.
+BATCH_LIMIT = 50
+BATCH_MAX_ROUNDS = 3
+BATCH_RETRY_DELAY = 1.0  # секунд, удваивается с каждым раундом
+
+# ⚠️ Ошибки API: временные (их стоит повторить) и признаки несозданного события
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RETRYABLE_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+# ID событий, которые на самом деле не были созданы
+INVALID_EVENT_IDS = {None, "", "None", "generated_event_id", "error_calendar_id"}
+
+
+def _error_status(error):
+    resp = getattr(error, "resp", None)
+    return getattr(resp, "status", None)
+
+
+def _is_retryable(error):
+    status = _error_status(error)
+    if status in RETRYABLE_STATUSES:
+        return True
+    if status == 403:
+        return any(reason in str(error) for reason in RETRYABLE_REASONS)
+    # Нет HTTP-статуса — сетевая ошибка, её тоже стоит повторить
+    return status is None
+
+
+def _build_operation(service, calendar_id, operation):
+    events = service.events()
+    kind = operation["op"]
+    if kind == "insert":
+        return events.insert(calendarId=calendar_id, body=operation["body"])
+    if kind == "patch":
+        return events.patch(calendarId=calendar_id, eventId=operation["event_id"], body=operation["body"])
+    if kind == "update":
+        return events.update(calendarId=calendar_id, eventId=operation["event_id"], body=operation["body"])
+    if kind == "delete":
+        return events.delete(calendarId=calendar_id, eventId=operation["event_id"])
+    raise ValueError(f"Неизвестная операция календаря: {kind}")
+
+
+def batch_calendar_operations(operations, calendar_id=None, max_rounds=BATCH_MAX_ROUNDS):
+    """
+    Выполняет операции с событиями пакетами по BATCH_LIMIT.
+    operations — список словарей {"key", "op": insert|patch|update|delete, "event_id", "body"};
+    key — любой хешируемый идентификатор операции (например, id задачи).
+    max_rounds — сколько раз повторять подзапросы с временной ошибкой (1 — без повторов,
+    если повторами управляет вызывающий, как outbox).
+    Возвращает {key: (True, ответ API) | (False, ошибка)}.
+    Удаление уже удалённого события (404/410) считается успешным.
+    """
+    calendar_id = calendar_id or os.getenv("GOOGLE_CALENDAR_ID")
+    if not calendar_id:
+        raise ValueError("GOOGLE_CALENDAR_ID отсутствует или пустой")
+
+    service = get_calendar_service()
+    results = {}
+    pending = list(operations)
+
+    for round_number in range(1, max_rounds + 1):
+        retry = []
+        for start in range(0, len(pending), BATCH_LIMIT):
+            chunk = dict(enumerate(pending[start:start + BATCH_LIMIT]))
+
+            def callback(request_id, response, exception, chunk=chunk):
+                operation = chunk[int(request_id)]
+                if exception is None:
+                    results[operation["key"]] = (True, response)
+                elif operation["op"] == "delete" and _error_status(exception) in (404, 410):
+                    results[operation["key"]] = (True, None)
+                else:
+                    results[operation["key"]] = (False, exception)
+                    if _is_retryable(exception):
+                        retry.append(operation)
+
+            batch = service.new_batch_http_request(callback=callback)
+            for request_id, operation in chunk.items():
+                batch.add(_build_operation(service, calendar_id, operation), request_id=str(request_id))
+            try:
+                batch.execute()
+            except Exception as e:
+                # Пакет не дошёл целиком (сеть, авторизация): все его операции повторяем
+                logger.error(f"Ошибка пакетного запроса к календарю ({len(chunk)} операций): {e}")
+                for operation in chunk.values():
+                    results[operation["key"]] = (False, e)
+                    retry.append(operation)
+
+        ok = sum(1 for operation in pending if results[operation["key"]][0])
+        logger.info(f"Пакет календаря, раунд {round_number}: успешно {ok} из {len(pending)}")
+
+        if not retry or round_number == max_rounds:
+            break
+        time.sleep(BATCH_RETRY_DELAY * 2 ** (round_number - 1))
+        pending = retry
+
+    return results
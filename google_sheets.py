@@ -1,6 +1,8 @@
 # google_sheets.py
 
 import os
+import re
+import threading
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from datetime import datetime
@@ -25,13 +27,43 @@ creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
 client = gspread.authorize(creds)
 
 
+# Поиск по Task ID и добавление строки выполняются под одной блокировкой: вызов, который
+# google_async перестал ждать по таймауту, продолжает работать в потоке, и повтор не должен
+# искать строку раньше, чем тот вызов её добавит
+_append_lock = threading.Lock()
+
+
 def add_task_to_sheet(task):
     sheet_id = os.getenv("GOOGLE_SHEET_ID")
     tab_name = os.getenv("GOOGLE_SHEET_TAB_NAME", "Катя Бачинина")
 
     sheet = client.open_by_key(sheet_id).worksheet(tab_name)
 
-    values = [
+    with _append_lock:
+        # Повторная попытка (ответ на прошлую потерялся) не добавляет вторую строку:
+        # строка задачи находится по Task ID в колонке I
+        existing = sheet.find(task.id, in_column=9)
+        if existing is not None:
+            return existing.row
+        return _append_row(sheet, _task_values(task))
+
+
+def _append_row(sheet, values):
+    """
+    Добавляет строку после таблицы и возвращает её номер из ответа API (updates.updatedRange).
+    Номер не вычисляется по длине колонки заранее: append выполняется на стороне Google атомарно,
+    и одновременные добавления не сдвигают чужие строки.
+    """
+    response = sheet.append_row(values, table_range="A1")
+    updated_range = response["updates"]["updatedRange"]  # например 'Tasks'!A17:J17
+    match = re.match(r"[A-Z]+(\d+)", updated_range.rsplit("!", 1)[-1])
+    if match is None:
+        raise ValueError(f"Не удалось определить номер добавленной строки: {updated_range}")
+    return int(match.group(1))
+
+
+def _task_values(task):
+    return [
         task.title or "—",                                # A — Задача
         datetime.now().strftime("%Y-%m-%d"),              # B — Дата постановки
         task.deadline or "—",                             # C — Дата окончания
@@ -44,13 +76,47 @@ def add_task_to_sheet(task):
         str(task.msg_id or ""),                           # J — Msg ID
     ]
 
-    col_a = sheet.col_values(1)
-    row = len(col_a) + 1 if col_a else 2
-
-    sheet.insert_row(values, index=row)
-    return row
-
 def format_links(links):
     if not links:
         return ""
     return "\n".join([f"- {link}" for link in links])
+
+
+# Обновление статуса задачи (при завершении — ещё трудозатраты, прогресс и комментарий)
+def update_task_in_sheet(row, status, hours=None, comment=None):
+    sheet_id = os.getenv("GOOGLE_SHEET_ID")
+    tab_name = os.getenv("GOOGLE_SHEET_TAB_NAME", "Tasks")
+
+    sheet = client.open_by_key(sheet_id).worksheet(tab_name)
+
+    # Обновляем статус
+    sheet.update_cell(row, 8, status)  # 8 - колонка H (Статус)
+
+    # Если задача выполнена, обновляем трудозатраты и прогресс
+    if status == "done" and hours is not None:
+        # Обновляем трудозатраты
+        sheet.update_cell(row, 7, str(hours))  # 7 - колонка G (Трудозатраты)
+
+        # Обновляем прогресс - колонка D
+        current_date = datetime.now().strftime("%Y-%m-%d")
+        progress_text = f"Выполнено {current_date}"
+
+        # Если есть комментарий, добавляем его в поле прогресса
+        if comment:
+            progress_text += f"\nКомментарий: {comment}"
+
+            # Обновляем также поле комментария (F - колонка 6)
+            sheet.update_cell(row, 6, comment)
+
+        sheet.update_cell(row, 4, progress_text)  # 4 - колонка D (Прогресс)
+
+
+# Обновление срока задачи
+def update_deadline_in_sheet(row, new_deadline):
+    sheet_id = os.getenv("GOOGLE_SHEET_ID")
+    tab_name = os.getenv("GOOGLE_SHEET_TAB_NAME", "Tasks")
+
+    sheet = client.open_by_key(sheet_id).worksheet(tab_name)
+
+    # Обновляем дату окончания
+    sheet.update_cell(row, 3, new_deadline)  # 3 - колонка C (Дата окончания)
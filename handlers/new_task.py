@@ -1,6 +1,7 @@
 from aiogram import types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery
-from database import add_pending_task, get_pending_task, update_pending_task, delete_pending_task
+from async_db import add_pending_task, get_pending_task, update_pending_task, delete_pending_task
+from async_db import add_pending_fragment
 from gpt_parser import parse_task
 from aiogram.fsm.storage.base import StorageKey
 
@@ -23,7 +24,7 @@ async def start_collecting_task(message: Message):
         "files": [],
         "forwarded_from": None
     }
-    add_pending_task(user_id, task_data)
+    await add_pending_task(user_id, task_data)
 
     await message.answer(
         "📂 Жду сообщения. Перешли фрагменты задачи или напиши текст. Нажми <b>Готово</b>, когда закончишь.",
@@ -33,37 +34,26 @@ async def start_collecting_task(message: Message):
 
 async def handle_collecting_messages(message: Message):
     user_id = message.from_user.id
-    pending = get_pending_task(user_id)
+    pending = await get_pending_task(user_id)
     if not pending:
         return
 
-    messages = pending.get("messages", [])
-    files = pending.get("files", [])
-    sender = pending.get("forwarded_from")
-
-    if message.text:
-        messages.append(message.text)
-    elif message.caption:
-        messages.append(message.caption)
-    else:
-        messages.append(None)
+    # Каждое сообщение дописывается отдельным фрагментом, без перезаписи всего черновика
+    text = message.text or message.caption
 
+    file_name = None
     if document := message.document:
-        files.append(document.file_name)
+        file_name = document.file_name
     elif photo := message.photo:
-        files.append("фотография")
-
-    if not sender:
-        if message.forward_from:
-            sender = message.forward_from.full_name
-        elif message.forward_sender_name:
-            sender = message.forward_sender_name
-
-    update_pending_task(user_id, {
-        "messages": messages,
-        "files": files,
-        "forwarded_from": sender,
-    })
+        file_name = "фотография"
+
+    sender = None
+    if message.forward_from:
+        sender = message.forward_from.full_name
+    elif message.forward_sender_name:
+        sender = message.forward_sender_name
+
+    await add_pending_fragment(user_id, text=text, file_name=file_name, forwarded_from=sender)
 
     await message.answer(
         "✅ Добавлено! Перешли ещё сообщения или нажми «Готово», когда закончишь.",
@@ -73,7 +63,7 @@ async def handle_collecting_messages(message: Message):
 
 async def handle_text_reply(message: Message):
     user_id = message.from_user.id
-    pending = get_pending_task(user_id)
+    pending = await get_pending_task(user_id)
 
     if not pending:
         return await message.answer("⚠️ Я не нашёл задачу, которую нужно уточнить. Напиши /задача, чтобы начать заново.")
@@ -86,17 +76,17 @@ async def handle_text_reply(message: Message):
             from google_calendar import normalize_date
             normalized_date = normalize_date(message.text.strip())
             pending["deadline"] = normalized_date
-            update_pending_task(user_id, pending)
+            await update_pending_task(user_id, pending)
 
             if step == "ask_deadline":
                 pending["step"] = "ask_time"
-                update_pending_task(user_id, pending)
+                await update_pending_task(user_id, pending)
                 return await message.answer("⏰ Во сколько выполнить задачу? (например, 10:00, 15:30 или просто '10')")
             else:
                 # Проверяем остальные обязательные поля после редактирования даты
                 if not pending.get("time") or pending["time"] in ["null", "-", "None", None]:
                     pending["step"] = "ask_time"
-                    update_pending_task(user_id, pending)
+                    await update_pending_task(user_id, pending)
                     return await message.answer("⏰ Во сколько выполнить задачу? (например, 10:00, 15:30 или просто '10')")
                 pending["step"] = "confirm"  # После редактирования переходим к подтверждению
         except ValueError as e:
@@ -108,7 +98,7 @@ async def handle_text_reply(message: Message):
             from handlers.task_actions import normalize_time
             normalized_time = normalize_time(message.text.strip())
             pending["time"] = normalized_time
-            update_pending_task(user_id, pending)
+            await update_pending_task(user_id, pending)
 
             if step == "ask_time":
                 # ✅ Автоматическая подстановка отправителя и подтверждение
@@ -120,7 +110,7 @@ async def handle_text_reply(message: Message):
                 else:
                     pending["step"] = "ask_assigned_by"
 
-                update_pending_task(user_id, pending)
+                await update_pending_task(user_id, pending)
 
                 if pending["step"] == "confirm_assigned_by":
                     return await message.answer(
@@ -140,7 +130,7 @@ async def handle_text_reply(message: Message):
                 # После редактирования времени проверяем отправителя
                 if not pending.get("assigned_by") or pending["assigned_by"] in ["null", "-", "None", None]:
                     pending["step"] = "ask_assigned_by"
-                    update_pending_task(user_id, pending)
+                    await update_pending_task(user_id, pending)
                     return await message.answer("👤 Кто поставил задачу?")
                 pending["step"] = "confirm"  # После редактирования переходим к подтверждению
         except ValueError as e:
@@ -148,11 +138,11 @@ async def handle_text_reply(message: Message):
 
     elif step in ["ask_assigned_by", "edit_assigned_by", "edit_assigned"]:
         pending["assigned_by"] = message.text.strip()
-        update_pending_task(user_id, pending)
+        await update_pending_task(user_id, pending)
         
         if step == "ask_assigned_by":
             pending["step"] = "ask_comment"
-            update_pending_task(user_id, pending)
+            await update_pending_task(user_id, pending)
             return await message.answer("💬 Хочешь оставить комментарий?")
         else:
             pending["step"] = "confirm"  # После редактирования переходим к подтверждению
@@ -170,18 +160,18 @@ async def handle_text_reply(message: Message):
             )
         else:
             pending["step"] = "ask_assigned_by"
-            update_pending_task(user_id, pending)
+            await update_pending_task(user_id, pending)
             return await message.answer("👤 Кто поставил задачу?")
 
     elif step in ["ask_comment", "edit_comment"]:
         pending["comment"] = message.text.strip()
         pending["step"] = "confirm"
-        update_pending_task(user_id, pending)
+        await update_pending_task(user_id, pending)
 
     elif step == "edit_title":
         pending["title"] = message.text.strip()
         pending["step"] = "confirm"
-        update_pending_task(user_id, pending)
+        await update_pending_task(user_id, pending)
 
     else:
         return await message.answer("⚠️ Я немного запутался. Давай начнём заново — напиши /задача.")
@@ -192,22 +182,22 @@ async def handle_text_reply(message: Message):
         # Проверка обязательных полей перед отображением карточки задачи
         if not pending.get("title"):
             pending["step"] = "edit_title"
-            update_pending_task(user_id, pending)
+            await update_pending_task(user_id, pending)
             return await message.answer("📝 Пожалуйста, введите название задачи:")
             
         if not pending.get("deadline") or pending["deadline"] in ["null", "-", "None", None]:
             pending["step"] = "ask_deadline"
-            update_pending_task(user_id, pending)
+            await update_pending_task(user_id, pending)
             return await message.answer("📅 До какого числа нужно сделать задачу?")
             
         if not pending.get("time") or pending["time"] in ["null", "-", "None", None]:
             pending["step"] = "ask_time"
-            update_pending_task(user_id, pending)
+            await update_pending_task(user_id, pending)
             return await message.answer("⏰ Во сколько выполнить задачу?")
             
         if not pending.get("assigned_by") or pending["assigned_by"] in ["null", "-", "None", None]:
             pending["step"] = "ask_assigned_by"
-            update_pending_task(user_id, pending)
+            await update_pending_task(user_id, pending)
             return await message.answer("👤 Кто поставил задачу?")
 
     # Если все проверки пройдены, отображаем карточку задачи для подтверждения
@@ -233,7 +223,7 @@ async def handle_text_reply(message: Message):
 
 async def route_message(message: Message):
     user_id = message.from_user.id
-    pending = get_pending_task(user_id)
+    pending = await get_pending_task(user_id)
 
     # Проверяем состояние FSM - если у нас есть активное состояние для комментария,
     # то не обрабатываем сообщение как новую задачу
@@ -269,7 +259,7 @@ async def route_message(message: Message):
         elif photo := message.photo:
             task_data["files"].append("фотография")
 
-        add_pending_task(user_id, task_data)
+        await add_pending_task(user_id, task_data)
 
         return await message.answer(
             "🆕️ Начал сбор новой задачи. Перешли ещё сообщения или нажми «Готово».",
@@ -301,7 +291,7 @@ async def route_message(message: Message):
     elif photo := message.photo:
         task_data["files"].append("фотография")
 
-    add_pending_task(user_id, task_data)
+    await add_pending_task(user_id, task_data)
 
     await message.answer(
         "📂 Начал сбор новой задачи. Перешли ещё сообщения или нажми «Готово».",
@@ -313,33 +303,33 @@ async def route_message(message: Message):
 
 async def handle_reset_task(callback: CallbackQuery):
     user_id = callback.from_user.id
-    delete_pending_task(user_id)
+    await delete_pending_task(user_id)
     await callback.message.answer("🔁 Задача сброшена. Можешь начать заново — напиши /задача.")
 
 
 async def handle_confirm_assigned_yes(callback: CallbackQuery):
     user_id = callback.from_user.id
-    pending = get_pending_task(user_id)
+    pending = await get_pending_task(user_id)
     if not pending:
         return await callback.message.answer("⚠️ Не удалось подтвердить имя.")
     
     # Проверяем наличие обязательных полей перед тем, как перейти к комментарию
     if not pending.get("deadline") or pending["deadline"] in ["null", "-", "None", None]:
-        update_pending_task(user_id, {"step": "ask_deadline"})
+        await update_pending_task(user_id, {"step": "ask_deadline"})
         return await callback.message.answer("📅 До какого числа нужно сделать задачу?")
         
     if not pending.get("time") or pending["time"] in ["null", "-", "None", None]:
-        update_pending_task(user_id, {"step": "ask_time"})
+        await update_pending_task(user_id, {"step": "ask_time"})
         return await callback.message.answer("⏰ Во сколько выполнить задачу?")
     
     # Если все обязательные поля заполнены, переходим к запросу комментария
-    update_pending_task(user_id, {"step": "ask_comment"})
+    await update_pending_task(user_id, {"step": "ask_comment"})
     await callback.message.answer("💬 Хочешь оставить комментарий?")
 
 
 async def handle_confirm_assigned_no(callback: CallbackQuery):
     user_id = callback.from_user.id
-    update_pending_task(user_id, {
+    await update_pending_task(user_id, {
         "assigned_by": None,
         "step": "ask_assigned_by"
     })
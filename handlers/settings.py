@@ -0,0 +1,39 @@
+from aiogram import types
+from aiogram.filters import CommandObject
+from async_db import get_user_timezone, set_user_timezone
+from database import is_valid_timezone
+from reminders import reminder_timer
+import outbox
+import scheduler
+
+async def handle_timezone(message: types.Message, command: CommandObject):
+    """
+    Обработка команды /часовой_пояс.
+    Без аргумента показывает текущий пояс, с аргументом (название IANA, например Europe/Moscow)
+    сохраняет новый: сроки задач, напоминания и ежедневный дайджест считаются в местном времени.
+    """
+    user_id = message.from_user.id
+    timezone = (command.args or "").strip()
+
+    if not timezone:
+        current = await get_user_timezone(user_id)
+        await message.answer(
+            f"🌍 Ваш часовой пояс: <b>{current}</b>\n"
+            f"Чтобы изменить, отправьте, например: /часовой_пояс Europe/Moscow"
+        )
+        return
+
+    if not is_valid_timezone(timezone):
+        await message.answer(
+            f"⚠️ Не знаю часовой пояс «{timezone}». Укажите его в формате Регион/Город, например Asia/Yekaterinburg."
+        )
+        return
+
+    # Сроки задач — местное время, поэтому моменты напоминаний пересчитываются.
+    # События календаря переносятся в новый пояс через outbox (в той же транзакции)
+    for task_id, due_at in await set_user_timezone(user_id, timezone, effects=outbox.timezone_changed()):
+        reminder_timer.schedule_at(task_id, due_at)
+    outbox.notify()
+    await scheduler.sync_digest_jobs()
+
+    await message.answer(f"✅ Часовой пояс изменён на <b>{timezone}</b>")
@@ -1,5 +1,7 @@
 from aiogram import types
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from async_db import set_user_active
+import scheduler
 
 # Создаем постоянную клавиатуру с кнопками
 main_keyboard = ReplyKeyboardMarkup(
@@ -16,6 +18,10 @@ async def handle_start(message: types.Message):
     Обработка команды /start
     Показывает приветственное сообщение и выводит клавиатуру
     """
+    # Пользователь мог раньше заблокировать бота — снова включаем ему напоминания.
+    # Его задачи не попали в таймер при загрузке, поэтому добавляем их сейчас
+    if await set_user_active(message.from_user.id, True):
+        await scheduler.reload_reminder_timer(message.from_user.id)
     await message.answer(
         "👋 Привет! Я помогу тебе управлять задачами.\n\n"
         "📝 Что я умею:\n"
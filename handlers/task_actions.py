@@ -3,16 +3,16 @@ from aiogram import F
 from aiogram.types import Message
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from database import get_pending_task, delete_pending_task, update_pending_task, add_task
-from database import complete_task, update_task_deadline, add_completion_comment
+from async_db import get_pending_task, delete_pending_task, update_pending_task, add_task
+from async_db import complete_task, update_task_deadline, add_completion_comment, get_task_by_id
+from async_db import consolidate_pending_fragments
 from gpt_parser import parse_task
 import re
 import uuid
 from datetime import datetime
-from google_sheets import add_task_to_sheet
-from google_calendar import add_task_to_calendar, update_event, delete_event
 from models.task_model import Task
-import sqlite3
+import outbox
+from reminders import reminder_timer
 
 # Добавьте этот класс для работы с состояниями
 class TaskStates(StatesGroup):
@@ -85,7 +85,7 @@ def format_task_card(pending):
 async def handle_show_final(callback_or_message, user_id=None):
     if not user_id:
         user_id = callback_or_message.from_user.id
-    pending = get_pending_task(user_id)
+    pending = await get_pending_task(user_id)
     if not pending:
         return await callback_or_message.answer("⚠️ Не найдено активной задачи.")
 
@@ -107,19 +107,21 @@ async def handle_edit_field_selection(callback: CallbackQuery):
         "edit_comment": ("comment", "💬 Новый комментарий?")
     }
     field, prompt = field_map[callback.data]
-    update_pending_task(user_id, {"step": f"edit_{field}"})
+    await update_pending_task(user_id, {"step": f"edit_{field}"})
     await callback.message.answer(prompt)
 
 
 # Модифицированная функция handle_collect_done, улучшенная обработка файлов
 async def handle_collect_done(callback: CallbackQuery):
     user_id = callback.from_user.id
-    pending = get_pending_task(user_id)
-    sender_name = pending.get("forwarded_from", None)
+    # Собираем накопленные фрагменты в черновик (по порядку поступления)
+    pending = await consolidate_pending_fragments(user_id)
 
     if not pending:
         return await callback.message.answer("⚠️ Нет активной задачи. Напиши текст задачи.")
 
+    sender_name = pending.get("forwarded_from", None)
+
     messages = pending.get("messages", [])
     files = pending.get("files", [])
 
@@ -148,23 +150,23 @@ async def handle_collect_done(callback: CallbackQuery):
         "files": files,  # Убедимся, что files всегда сохраняются в pending_task
     }
 
-    update_pending_task(user_id, update_fields)
+    await update_pending_task(user_id, update_fields)
 
     print("[DEBUG] assigned_by из GPT =", update_fields["assigned_by"])
     print("[DEBUG] forwarded_from из pending =", sender_name)
     print("[DEBUG] files =", files)
 
     if not update_fields["deadline"]:
-        update_pending_task(user_id, {**update_fields, "step": "ask_deadline"})
+        await update_pending_task(user_id, {**update_fields, "step": "ask_deadline"})
         return await callback.message.answer("📅 До какого числа нужно сделать задачу?")
 
     if not update_fields["time"]:
-        update_pending_task(user_id, {**update_fields, "step": "ask_time"})
+        await update_pending_task(user_id, {**update_fields, "step": "ask_time"})
         return await callback.message.answer("⏰ Во сколько выполнить задачу?")
 
     if not update_fields["assigned_by"] or update_fields["assigned_by"] in {"", "null", None}:
         if sender_name:
-            update_pending_task(user_id, {**update_fields, "step": "forwarded_confirm"})
+            await update_pending_task(user_id, {**update_fields, "step": "forwarded_confirm"})
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="✅ Да", callback_data="forwarded_yes"),
                  InlineKeyboardButton(text="❌ Нет", callback_data="forwarded_no")]
@@ -174,10 +176,10 @@ async def handle_collect_done(callback: CallbackQuery):
                 reply_markup=keyboard
             )
         else:
-            update_pending_task(user_id, {**update_fields, "step": "ask_assigned_by"})
+            await update_pending_task(user_id, {**update_fields, "step": "ask_assigned_by"})
             return await callback.message.answer("👤 Кто поставил задачу?")
     else:
-        update_pending_task(user_id, {**update_fields, "step": "confirm_assigned_by"})
+        await update_pending_task(user_id, {**update_fields, "step": "confirm_assigned_by"})
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="✅ Да", callback_data="confirm_assigned_yes"),
              InlineKeyboardButton(text="❌ Нет", callback_data="confirm_assigned_no")]
@@ -195,7 +197,7 @@ async def handle_confirm_add(callback: CallbackQuery):
     user_id = callback.from_user.id
     logger.info(f"Обработка подтверждения добавления задачи от пользователя {user_id}")
 
-    pending = get_pending_task(user_id)
+    pending = await get_pending_task(user_id)
 
     if not pending:
         logger.warning(f"Задача для подтверждения не найдена у пользователя {user_id}")
@@ -203,21 +205,21 @@ async def handle_confirm_add(callback: CallbackQuery):
 
     # Дополнительные проверки обязательных полей
     if not pending.get("title"):
-        update_pending_task(user_id, {"step": "edit_title"})
+        await update_pending_task(user_id, {"step": "edit_title"})
         return await callback.message.answer("📝 Пожалуйста, введите название задачи:")
 
     if not pending.get("deadline") or pending["deadline"] in ["null", "-", "None", None]:
-        update_pending_task(user_id, {"step": "ask_deadline"})
+        await update_pending_task(user_id, {"step": "ask_deadline"})
         return await callback.message.answer("📅 До какого числа нужно сделать задачу?")
 
     if not pending.get("time") or pending["time"] in ["null", "-", "None", None]:
-        update_pending_task(user_id, {"step": "ask_time"})
+        await update_pending_task(user_id, {"step": "ask_time"})
         return await callback.message.answer("⏰ Во сколько выполнить задачу?")
 
     if not pending.get("assigned_by") or pending["assigned_by"] in ["null", "-", "None", None]:
         if pending.get("forwarded_from"):
             # Если есть информация о пересланном сообщении, предлагаем её использовать
-            update_pending_task(user_id, {"step": "forwarded_confirm"})
+            await update_pending_task(user_id, {"step": "forwarded_confirm"})
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="✅ Да", callback_data="forwarded_yes"),
                  InlineKeyboardButton(text="❌ Нет", callback_data="forwarded_no")]
@@ -227,7 +229,7 @@ async def handle_confirm_add(callback: CallbackQuery):
                 reply_markup=keyboard
             )
         else:
-            update_pending_task(user_id, {"step": "ask_assigned_by"})
+            await update_pending_task(user_id, {"step": "ask_assigned_by"})
             return await callback.message.answer("👤 Кто поставил задачу?")
 
     # Если все проверки пройдены, продолжаем
@@ -255,36 +257,13 @@ async def handle_confirm_add(callback: CallbackQuery):
     try:
         logger.info(f"Начинаем добавление задачи: {task_obj.title}")
 
-        # Добавляем задачу в Google Sheet
-        logger.info("Добавление задачи в Google Sheets...")
-        sheet_row = add_task_to_sheet(task_obj)
-        task_obj.sheet_row = sheet_row
-        logger.info(f"Задача добавлена в Google Sheets, строка {sheet_row}")
-
-        # Добавляем задачу в Google Calendar
-        logger.info("Добавление задачи в Google Calendar...")
-        try:
-            calendar_event_id = add_task_to_calendar(
-                title=task_obj.title,
-                date=task_obj.deadline,
-                time=task_obj.time
-            )
-
-            if calendar_event_id:
-                task_obj.calendar_event_id = calendar_event_id
-                logger.info(f"Задача добавлена в Google Calendar, ID: {calendar_event_id}")
-            else:
-                logger.error("Не удалось получить ID события календаря")
-                task_obj.calendar_event_id = "error_calendar_id"  # Временный ID для отслеживания
-        except Exception as calendar_error:
-            logger.error(f"Ошибка при добавлении задачи в Google Calendar: {calendar_error}")
-            # Продолжаем выполнение даже при ошибке с календарем
-            task_obj.calendar_event_id = "error_calendar_id"
-
-        # Добавляем задачу в базу данных
+        # Задача и записи outbox для Google Sheets и Google Calendar сохраняются одной транзакцией;
+        # строку таблицы и событие календаря создадут фоновые обработчики (см. outbox.py)
         logger.info("Добавление задачи в локальную базу данных...")
-        add_task(task_obj.__dict__)
-        delete_pending_task(user_id)
+        due_at = await add_task(task_obj.__dict__, effects=outbox.task_added(task_obj))
+        outbox.notify()
+        await delete_pending_task(user_id)
+        reminder_timer.schedule_at(task_id, due_at)
         logger.info(f"Задача {task_id} успешно добавлена в базу данных")
 
         # Форматируем дату для отображения
@@ -301,10 +280,6 @@ async def handle_confirm_add(callback: CallbackQuery):
         result_message += f"📅 {formatted_date} в {task_obj.time}\n"
         result_message += f"👤 Поставил: {task_obj.assigned_by}\n"
 
-        # Если были проблемы с календарем, добавляем предупреждение
-        if task_obj.calendar_event_id == "error_calendar_id":
-            result_message += "\n⚠️ Задача добавлена в таблицу, но не добавлена в календарь. Администратор уведомлен о проблеме."
-
         # Показываем клавиатуру при подтверждении задачи
         from handlers.start import main_keyboard
         await callback.message.answer(result_message, reply_markup=main_keyboard)
@@ -316,33 +291,33 @@ async def handle_confirm_add(callback: CallbackQuery):
 
 async def handle_collect_cancel(callback: CallbackQuery):
     user_id = callback.from_user.id
-    delete_pending_task(user_id)
+    await delete_pending_task(user_id)
     await callback.message.answer("❌ Задача отменена.")
 
 
 async def handle_forwarded_yes(callback: CallbackQuery):
     user_id = callback.from_user.id
-    pending = get_pending_task(user_id)
+    pending = await get_pending_task(user_id)
 
     if not pending or not pending.get("forwarded_from"):
         return await callback.message.answer("⚠️ Нет информации о пересланном сообщении.")
 
-    update_pending_task(user_id, {
+    await update_pending_task(user_id, {
         "assigned_by": pending["forwarded_from"],
         "step": "confirm"  # Меняем шаг на "confirm" для перехода к проверке данных
     })
     
     # Проверяем все обязательные поля
     if not pending.get("deadline") or pending["deadline"] in ["null", "-", "None", None]:
-        update_pending_task(user_id, {"step": "ask_deadline"})
+        await update_pending_task(user_id, {"step": "ask_deadline"})
         return await callback.message.answer("📅 До какого числа нужно сделать задачу?")
         
     if not pending.get("time") or pending["time"] in ["null", "-", "None", None]:
-        update_pending_task(user_id, {"step": "ask_time"})
+        await update_pending_task(user_id, {"step": "ask_time"})
         return await callback.message.answer("⏰ Во сколько выполнить задачу?")
     
     # Если все поля заполнены, показываем карточку задачи для подтверждения
-    updated_pending = get_pending_task(user_id)  # Получаем обновленные данные
+    updated_pending = await get_pending_task(user_id)  # Получаем обновленные данные
     text = format_task_card(updated_pending) + "\n\nДобавить в таблицу и календарь?"
     await callback.message.answer(text, reply_markup=get_confirmation_keyboard())
 
@@ -350,7 +325,7 @@ async def handle_forwarded_yes(callback: CallbackQuery):
 async def handle_forwarded_no(callback: CallbackQuery):
     user_id = callback.from_user.id
 
-    update_pending_task(user_id, {
+    await update_pending_task(user_id, {
         "step": "ask_assigned_by"
     })
     return await callback.message.answer("👤 Кто поставил задачу?")
@@ -358,13 +333,13 @@ async def handle_forwarded_no(callback: CallbackQuery):
 
 async def handle_confirm_assigned_yes(callback: CallbackQuery):
     user_id = callback.from_user.id
-    update_pending_task(user_id, {"step": "ask_comment"})
+    await update_pending_task(user_id, {"step": "ask_comment"})
     await handle_show_final(callback)
 
 
 async def handle_confirm_assigned_no(callback: CallbackQuery):
     user_id = callback.from_user.id
-    update_pending_task(user_id, {
+    await update_pending_task(user_id, {
         "assigned_by": None,
         "step": "ask_assigned_by"
     })
@@ -372,23 +347,10 @@ async def handle_confirm_assigned_no(callback: CallbackQuery):
 
 
 
-# Функция для получения задачи по ID
-def get_task_by_id(task_id):
-    conn = sqlite3.connect("db.sqlite3")
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM tasks WHERE id = ?", (task_id,))
-    row = cursor.fetchone()
-    conn.close()
-    
-    if not row:
-        return None
-        
-    return row
-
 # Обработчик для кнопки "Выполнено"
 async def handle_mark_done(callback: CallbackQuery, state: FSMContext):
     task_id = callback.data.split('_')[-1]
-    task = get_task_by_id(task_id)
+    task = await get_task_by_id(task_id, columns=("id",))
     
     if not task:
         await callback.message.answer("⚠️ Задача не найдена.")
@@ -470,26 +432,21 @@ async def complete_task_with_data(message: Message, state: FSMContext, comment=N
     task_id = data.get("task_id")
     hours = data.get("hours_spent")
     
-    task = get_task_by_id(task_id)
+    task = await get_task_by_id(task_id, columns=("title",))
     if not task:
         await message.answer("⚠️ Задача не найдена.")
         await state.clear()
         return
     
-    # Обновляем статус задачи в базе данных
-    completion_time = complete_task(task_id, hours)
+    # Обновляем статус задачи в базе данных; отметка в Google Sheets и удаление события
+    # календаря записываются в outbox той же транзакцией
+    completion_time = await complete_task(task_id, hours, effects=outbox.task_completed(hours, comment))
+    outbox.notify()
+    reminder_timer.cancel(task_id)
     
     # Если есть комментарий, сохраняем его
     if comment:
-        add_completion_comment(task_id, comment)
-    
-    # Обновляем статус в Google Sheets
-    update_task_in_sheet(task[6], "done", hours, comment)  # task[6] - sheet_row
-    
-    # Удаляем событие из календаря
-    calendar_event_id = task[5]  # task[5] - calendar_event_id
-    if calendar_event_id and calendar_event_id != "None" and calendar_event_id != "generated_event_id":
-        delete_event(calendar_event_id)
+        await add_completion_comment(task_id, comment)
     
     # Форматируем дату для вывода пользователю
     from datetime import datetime
@@ -497,7 +454,7 @@ async def complete_task_with_data(message: Message, state: FSMContext, comment=N
     
     # Формируем сообщение с результатом
     completion_message = (
-        f"✅ Задача \"{task[2]}\" отмечена как выполненная!\n"
+        f"✅ Задача \"{task['title']}\" отмечена как выполненная!\n"
         f"⏱️ Трудозатраты: {hours} ч.\n"
         f"📅 Дата выполнения: {completion_date}"
     )
@@ -511,7 +468,7 @@ async def complete_task_with_data(message: Message, state: FSMContext, comment=N
 # Обработчик для кнопки "Продлить"
 async def handle_extend_deadline(callback: CallbackQuery, state: FSMContext):
     task_id = callback.data.split('_')[-1]
-    task = get_task_by_id(task_id)
+    task = await get_task_by_id(task_id, columns=("id",))
     
     if not task:
         await callback.message.answer("⚠️ Задача не найдена.")
@@ -622,38 +579,17 @@ async def handle_new_time_input(message: Message, state: FSMContext):
         task_id = data.get("task_id")
         new_deadline = data.get("new_deadline")
 
-        task = get_task_by_id(task_id)
+        task = await get_task_by_id(task_id, columns=("title",))
         if not task:
             await message.answer("⚠️ Задача не найдена.")
             await state.clear()
             return
 
-        # Обновляем срок в базе данных
-        conn = sqlite3.connect("db.sqlite3")
-        cursor = conn.cursor()
-        cursor.execute("UPDATE tasks SET deadline = ?, time = ? WHERE id = ?",
-                      (new_deadline, new_time, task_id))
-        conn.commit()
-        conn.close()
-
-        # Обновляем срок в Google Sheets
-        update_deadline_in_sheet(task[6], new_deadline)  # task[6] - sheet_row
-
-        # Обновляем событие в календаре
-        if task[5]:  # task[5] - calendar_event_id
-            task_obj = {
-                "calendar_event_id": task[5],
-                "deadline": new_deadline,
-                "time": new_time
-            }
-            try:
-                update_event(task_obj)
-                calendar_updated = "и календаре"
-            except Exception as e:
-                print(f"Ошибка при обновлении события в календаре: {e}")
-                calendar_updated = "(обновление в календаре не удалось)"
-        else:
-            calendar_updated = ""
+        # Обновляем срок в базе данных; перенос в Google Sheets и Google Calendar
+        # записывается в outbox той же транзакцией
+        due_at = await update_task_deadline(task_id, new_deadline, new_time, effects=outbox.deadline_moved(new_deadline))
+        outbox.notify()
+        reminder_timer.schedule_at(task_id, due_at)
 
         # Форматируем дату для отображения
         formatted_date = new_deadline
@@ -664,83 +600,8 @@ async def handle_new_time_input(message: Message, state: FSMContext):
         except:
             pass
 
-        await message.answer(f"⏳ Срок задачи \"{task[2]}\" продлен до {formatted_date} {new_time} в базе данных и таблице {calendar_updated}")
+        await message.answer(f"⏳ Срок задачи \"{task['title']}\" продлен до {formatted_date} {new_time}")
         await state.clear()
 
     except ValueError as e:
         await message.answer(f"⚠️ {str(e)}. Пожалуйста, введите время в удобном формате (например: 10 для 10:00, 15:30, 'утром', 'вечером' и т.д.)")
-
-# Функция для обновления статуса задачи в Google Sheets
-# Обновленная функция для файла task_actions.py
-
-def update_task_in_sheet(row, status, hours=None, comment=None):
-    import gspread
-    import json
-    from oauth2client.service_account import ServiceAccountCredentials
-    import os
-    from datetime import datetime
-    
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    
-    # Получаем JSON из переменной окружения
-    creds_json = os.getenv("GOOGLE_CREDENTIALS_JSON")
-    
-    # Преобразуем строку в словарь
-    creds_dict = json.loads(creds_json)
-    
-    # Авторизуемся с помощью словаря
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    client = gspread.authorize(creds)
-    
-    sheet_id = os.getenv("GOOGLE_SHEET_ID")
-    tab_name = os.getenv("GOOGLE_SHEET_TAB_NAME", "Tasks")
-    
-    sheet = client.open_by_key(sheet_id).worksheet(tab_name)
-    
-    # Обновляем статус
-    sheet.update_cell(row, 8, status)  # 8 - колонка H (Статус)
-    
-    # Если задача выполнена, обновляем трудозатраты и прогресс
-    if status == "done" and hours is not None:
-        # Обновляем трудозатраты
-        sheet.update_cell(row, 7, str(hours))  # 7 - колонка G (Трудозатраты)
-        
-        # Обновляем прогресс - колонка D
-        current_date = datetime.now().strftime("%Y-%m-%d")
-        progress_text = f"Выполнено {current_date}"
-        
-        # Если есть комментарий, добавляем его в поле прогресса
-        if comment:
-            progress_text += f"\nКомментарий: {comment}"
-            
-            # Обновляем также поле комментария (F - колонка 6)
-            sheet.update_cell(row, 6, comment)
-            
-        sheet.update_cell(row, 4, progress_text)  # 4 - колонка D (Прогресс)
-
-# Функция для обновления срока в Google Sheets
-def update_deadline_in_sheet(row, new_deadline):
-    import gspread
-    import json
-    from oauth2client.service_account import ServiceAccountCredentials
-    import os
-    
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    
-    # Получаем JSON из переменной окружения
-    creds_json = os.getenv("GOOGLE_CREDENTIALS_JSON")
-    
-    # Преобразуем строку в словарь
-    creds_dict = json.loads(creds_json)
-    
-    # Авторизуемся с помощью словаря
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    client = gspread.authorize(creds)
-    
-    sheet_id = os.getenv("GOOGLE_SHEET_ID")
-    tab_name = os.getenv("GOOGLE_SHEET_TAB_NAME", "Tasks")
-    
-    sheet = client.open_by_key(sheet_id).worksheet(tab_name)
-    
-    # Обновляем дату окончания
-    sheet.update_cell(row, 3, new_deadline)  # 3 - колонка C (Дата окончания)
\ No newline at end of file
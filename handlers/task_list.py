@@ -1,37 +1,43 @@
 from aiogram import types
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from database import get_active_tasks, get_connection
+from async_db import get_active_tasks_page, count_active_tasks
 import math
 
 # Количество задач на одной странице
 TASKS_PER_PAGE = 3
+# Колонки, которые нужны для строки списка
+LIST_COLUMNS = ("id", "title", "deadline", "time")
 
-async def handle_task_list(message: types.Message, page=0):
+async def handle_task_list(message: types.Message, page=0, user_id=None, after_cursor=None, before_cursor=None):
     """
     Обработка команды /мои_задачи.
-    Выводит список активных задач постранично с кнопками управления.
+    Выводит список активных задач пользователя постранично с кнопками управления.
+    Страницы листаются по курсору (id крайней задачи соседней страницы), поэтому
+    каждая страница загружается одним запросом по индексу, сколько бы задач ни было.
     """
-    # Получаем все активные задачи
-    tasks = get_active_tasks()
+    # Для callback-ов message.from_user — это бот, поэтому user_id передаётся явно
+    if user_id is None:
+        user_id = message.from_user.id
 
-    if not tasks:
+    total_tasks = await count_active_tasks(user_id)
+
+    if not total_tasks:
         # Просто выводим сообщение без дополнительных параметров
         await message.answer("У вас нет активных задач.")
         return
 
-    # Сортируем задачи по дате и времени
-    # Преобразуем None в "23:59" для сортировки заданий без времени в конец дня
-    sorted_tasks = sorted(tasks, key=lambda task: (task[3] or "9999-12-31", task[4] or "23:59"))
+    current_tasks = await get_active_tasks_page(
+        user_id, after_cursor=after_cursor, limit=TASKS_PER_PAGE, before_cursor=before_cursor,
+        columns=LIST_COLUMNS
+    )
 
-    total_pages = math.ceil(len(sorted_tasks) / TASKS_PER_PAGE)
-    # Убедимся, что запрошенная страница существует
+    total_pages = math.ceil(total_tasks / TASKS_PER_PAGE)
+    # Если курсор устарел (задачи закрыли), показываем первую страницу
+    if not current_tasks:
+        page = 0
+        current_tasks = await get_active_tasks_page(user_id, limit=TASKS_PER_PAGE, columns=LIST_COLUMNS)
     page = max(0, min(page, total_pages - 1))
 
-    # Выбираем задачи для текущей страницы
-    start_idx = page * TASKS_PER_PAGE
-    end_idx = min(start_idx + TASKS_PER_PAGE, len(sorted_tasks))
-    current_tasks = sorted_tasks[start_idx:end_idx]
-
     # Формируем сообщение со списком задач
     response = f"📋 <b>Ваши активные задачи</b> (страница {page+1}/{total_pages}):\n\n"
 
@@ -39,10 +45,10 @@ async def handle_task_list(message: types.Message, page=0):
     keyboard = []
 
     for i, task in enumerate(current_tasks):
-        task_id = task[0]    # id
-        title = task[2]      # title
-        deadline = task[3]   # deadline
-        time = task[4] if task[4] else "—"  # time
+        task_id = task["id"]
+        title = task["title"]
+        deadline = task["deadline"]
+        time = task["time"] or "—"
 
         # Форматируем дату для отображения (ДД.ММ)
         try:
@@ -74,13 +80,17 @@ async def handle_task_list(message: types.Message, page=0):
     if total_pages > 1:
         nav_row = []
         if page > 0:
-            nav_row.append(types.InlineKeyboardButton(text="◀️", callback_data=f"task_page_{page-1}"))
+            nav_row.append(types.InlineKeyboardButton(
+                text="◀️", callback_data=f"task_page_p_{page-1}_{current_tasks[0]['id']}"
+            ))
 
         # Добавляем номер текущей страницы
         nav_row.append(types.InlineKeyboardButton(text=f"{page+1}/{total_pages}", callback_data=f"none"))
 
         if page < total_pages - 1:
-            nav_row.append(types.InlineKeyboardButton(text="▶️", callback_data=f"task_page_{page+1}"))
+            nav_row.append(types.InlineKeyboardButton(
+                text="▶️", callback_data=f"task_page_n_{page+1}_{current_tasks[-1]['id']}"
+            ))
 
         if nav_row:
             keyboard.append(nav_row)
@@ -101,17 +111,17 @@ async def handle_view_task(callback: types.CallbackQuery):
     task_id = callback.data.split('_')[-1]
 
     # Получаем информацию о задаче из базы данных
-    from database import get_task_by_id
-    task = get_task_by_id(task_id)
+    from async_db import get_task_by_id
+    task = await get_task_by_id(task_id, columns=("title", "deadline", "time", "created_at"))
 
     if not task:
         await callback.message.answer("⚠️ Задача не найдена.")
         return
 
     # Формируем детальную информацию о задаче
-    title = task[2]        # title
-    deadline = task[3]     # deadline
-    time = task[4] if task[4] else "—" # time
+    title = task["title"]
+    deadline = task["deadline"]
+    time = task["time"] or "—"
 
     # Форматируем дату для удобного отображения
     formatted_date = deadline
@@ -135,9 +145,9 @@ async def handle_view_task(callback: types.CallbackQuery):
     )
 
     # Добавляем информацию о создании задачи, если она есть
-    if task[9]:  # created_at
+    if task["created_at"]:
         try:
-            created_at = datetime.fromisoformat(task[9])
+            created_at = datetime.fromisoformat(task["created_at"])
             created_date = created_at.strftime("%d.%m.%Y")
             task_details += f"🆕 Создана: {created_date}\n"
         except:
@@ -169,11 +179,15 @@ async def handle_task_page_navigation(callback: types.CallbackQuery):
     """
     Обработчик навигации по страницам списка задач
     """
-    page = int(callback.data.split('_')[-1])
-    await handle_task_list(callback.message, page=page)
+    # Формат: task_page_<n|p>_<номер страницы>_<id крайней задачи>
+    _, _, direction, page, cursor = callback.data.split('_', 4)
+    if direction == "n":
+        await handle_task_list(callback.message, page=int(page), user_id=callback.from_user.id, after_cursor=cursor)
+    else:
+        await handle_task_list(callback.message, page=int(page), user_id=callback.from_user.id, before_cursor=cursor)
 
 async def handle_task_list_menu(callback: types.CallbackQuery):
     """
     Обработчик для возврата к списку задач
     """
-    await handle_task_list(callback.message)
\ No newline at end of file
+    await handle_task_list(callback.message, user_id=callback.from_user.id)
\ No newline at end of file
@@ -0,0 +1,105 @@
+# leader.py
+#
+# Выбор ведущего экземпляра бота через аренду (lease) в SQLite.
+# Когда запущено несколько экземпляров, плановые задания (ежедневный дайджест, архивация,
+# догоняющий проход) должен выполнять только один — держатель аренды.
+# - аренда — строка таблицы leases: имя, идентификатор держателя и момент истечения;
+# - держатель продлевает её каждые HEARTBEAT_INTERVAL секунд;
+# - если держатель упал, аренда истекает через LEASE_TTL секунд и её забирает другой экземпляр;
+# - при штатной остановке аренда освобождается сразу, поэтому передача мгновенная.
+# Второй экземпляр аренды (POLLING_LEASE_NAME) выбирает единственного получателя сообщений
+# (см. main.py): черновики задач живут в кэше процесса, поэтому их ведёт один экземпляр.
+
+import asyncio
+import os
+import socket
+import time
+import uuid
+
+from async_db import acquire_lease, release_lease
+
+LEASE_NAME = "scheduler"
+POLLING_LEASE_NAME = "polling"
+LEASE_TTL = int(os.getenv("LEASE_TTL", "30"))
+HEARTBEAT_INTERVAL = max(1, LEASE_TTL // 3)
+
+
+class LeaderLease:
+    def __init__(self, name=LEASE_NAME, ttl=LEASE_TTL, heartbeat=HEARTBEAT_INTERVAL):
+        self.name = name
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # Локальный срок действия аренды (по monotonic): если продление зависло,
+        # экземпляр перестаёт считать себя ведущим раньше, чем аренду заберёт другой
+        self._valid_until = 0.0
+        self._runner = None
+        self._on_elected = None
+        self._on_lost = None
+
+    @property
+    def is_leader(self):
+        return time.monotonic() < self._valid_until
+
+    async def start(self, on_elected=None, on_lost=None):
+        """
+        Делает первую попытку взять аренду (до возврата управления) и запускает продление.
+        on_elected() — корутина, вызываемая каждый раз, когда экземпляр становится ведущим,
+        on_lost() — когда он перестаёт им быть (продление не удалось).
+        """
+        self._on_elected = on_elected
+        self._on_lost = on_lost
+        await self._renew()
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            await asyncio.gather(self._runner, return_exceptions=True)
+            self._runner = None
+        if self.is_leader:
+            self._valid_until = 0.0
+            try:
+                await release_lease(self.name, self.holder)
+            except Exception as e:
+                print(f"Не удалось освободить аренду {self.name}: {e}")
+
+    async def _renew(self):
+        was_leader = self.is_leader
+        started = time.monotonic()
+        try:
+            acquired = await acquire_lease(self.name, self.holder, self.ttl)
+        except Exception as e:
+            print(f"Ошибка продления аренды {self.name}: {e}")
+            acquired = False
+
+        if acquired:
+            # Отсчёт от момента запроса: база могла ответить с задержкой
+            self._valid_until = started + self.ttl - self.heartbeat
+        else:
+            self._valid_until = 0.0
+
+        if acquired and not was_leader:
+            print(f"Экземпляр {self.holder} стал ведущим ({self.name})")
+            if self._on_elected is not None:
+                try:
+                    await self._on_elected()
+                except Exception as e:
+                    print(f"Ошибка при переходе в ведущие: {e}")
+        elif was_leader and not acquired:
+            print(f"Экземпляр {self.holder} потерял аренду {self.name}")
+            if self._on_lost is not None:
+                try:
+                    await self._on_lost()
+                except Exception as e:
+                    print(f"Ошибка при потере аренды: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            await self._renew()
+
+
+leader = LeaderLease()
+polling_leader = LeaderLease(POLLING_LEASE_NAME)
@@ -45,26 +45,24 @@ logger.info("================================")
 logger.info("Запуск бота с расширенным логированием")
 logger.info("================================")
 
-# Эта функция предотвратит запуск нескольких экземпляров бота на Render
-def ensure_single_instance():
-    # Создаем переменную окружения, которая будет индикатором запущенного бота
-    if os.environ.get("BOT_ALREADY_RUNNING") == "True":
-        logger.error("Бот уже запущен! Завершение работы.")
-        sys.exit(1)
-    
-    # Устанавливаем флаг запущенного бота
-    os.environ["BOT_ALREADY_RUNNING"] = "True"
-    logger.info("Инициализация экземпляра бота. Установлен флаг BOT_ALREADY_RUNNING=True")
-
-# Проверяем, запущен ли уже бот
-ensure_single_instance()
+# Несколько экземпляров бота допустимы: плановые задания выполняет только ведущий
+# (аренда в базе, см. leader.py), а напоминания не дублируются благодаря журналу notifications_sent.
+# Сообщения принимает только держатель аренды polling: getUpdates допускает одного получателя,
+# а черновики задач кэшируются в памяти процесса. Остальные экземпляры ждут в резерве.
 
-from database import create_tables, get_pending_task, add_comment_column
+from database import create_tables
+import async_db
 import scheduler
 import handlers.start as start_handler
 import handlers.new_task as new_task_handler
 import handlers.task_actions as task_actions_handler
 import handlers.task_list as task_list_handler
+import handlers.settings as settings_handler
+import google_calendar
+import google_async
+import outbox
+import metrics
+from leader import polling_leader
 
 load_dotenv()
 logger.info("Загрузка переменных окружения")
@@ -74,16 +72,6 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 bot = Bot(token=BOT_TOKEN, parse_mode="HTML")
 
 
-def clear_pending_tasks():
-    import sqlite3
-    conn = sqlite3.connect("db.sqlite3")
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM pending_tasks")
-    conn.commit()
-    conn.close()
-    logger.info("Очищены незавершенные задачи")
-
-
 async def handle_keyboard_tasks(message: types.Message):
     """Обработчик кнопки 'Мои задачи' с клавиатуры"""
     await task_list_handler.handle_task_list(message)
@@ -93,6 +81,24 @@ async def handle_keyboard_new_task(message: types.Message):
     await new_task_handler.start_collecting_task(message)
 
 
+async def on_startup(bot: Bot):
+    # Планировщик использует того же бота (одна сессия); плановые задания выполняет только
+    # держатель аренды scheduler, таймер напоминаний работает и на резервных экземплярах
+    await scheduler.start_scheduler(bot)
+    logger.info("Планировщик запущен")
+    # Доставка изменений задач в Google Sheets и Calendar (включая оставшиеся с прошлого запуска)
+    outbox.start()
+    # Метрики процесса периодически пишутся в лог «metrics» (см. metrics.py)
+    metrics.start()
+
+
+async def on_shutdown(bot: Bot):
+    await outbox.stop()
+    await metrics.stop()
+    await scheduler.stop_scheduler()
+    logger.info("Планировщик остановлен")
+
+
 async def main():
     logger.info("Запуск бота")
     storage = MemoryStorage()
@@ -102,6 +108,7 @@ async def main():
     dp.message.register(start_handler.handle_start, Command("start"))
     dp.message.register(task_list_handler.handle_task_list, Command("мои_задачи"))
     dp.message.register(new_task_handler.start_collecting_task, Command("задача"))
+    dp.message.register(settings_handler.handle_timezone, Command("часовой_пояс", "timezone"))
 
     # Обработчики кнопок клавиатуры
     dp.message.register(handle_keyboard_tasks, F.text == "📋 Мои задачи")
@@ -141,32 +148,53 @@ async def main():
     # В конце регистрируем самый общий обработчик
     dp.message.register(new_task_handler.route_message)
 
-    # Запускаем планировщик задач
-    scheduler.start_scheduler()
-    
+    elected = asyncio.Event()
+
+    async def on_polling_elected():
+        elected.set()
+
+    async def on_polling_lost():
+        # Аренду мог забрать другой экземпляр — прекращаем приём сообщений, процесс завершится
+        logger.error("Аренда приёма сообщений потеряна, поллинг останавливается")
+        try:
+            await dp.stop_polling()
+        except RuntimeError:
+            pass
+
     try:
+        await on_startup(bot)
+        await polling_leader.start(on_elected=on_polling_elected, on_lost=on_polling_lost)
+        if not elected.is_set():
+            logger.info("Сообщения принимает другой экземпляр, ожидание в резерве")
+        await elected.wait()
+
+        # Черновики прежнего получателя (упавшего или остановленного) больше не продолжить
+        await async_db.clear_pending_tasks()
+        logger.info("Очищены незавершенные задачи")
+
         logger.info("Запуск поллинга бота")
         await dp.start_polling(bot)
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {e}")
     finally:
         logger.info("Бот остановлен")
-        # Сбрасываем флаг запущенного бота при выходе
-        os.environ["BOT_ALREADY_RUNNING"] = "False"
+        await polling_leader.stop()
+        await on_shutdown(bot)
+        # Единственная HTTP-сессия бота (её же использует планировщик)
+        await bot.session.close()
+        google_async.shutdown()
+        async_db.shutdown()
 
 
 if __name__ == "__main__":
     try:
-        create_tables()
-        add_comment_column()
-        clear_pending_tasks()
+        create_tables()  # Применяет миграции схемы, если они ещё не применены
+        # Проверка доступа к Google Calendar — один раз при запуске, а не при каждой операции
+        google_calendar.probe_calendar()
         asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Бот остановлен вручную!")
-        os.environ["BOT_ALREADY_RUNNING"] = "False"
     except SystemExit:
         logger.info("Выход из программы")
-        os.environ["BOT_ALREADY_RUNNING"] = "False"
     except Exception as e:
-        logger.error(f"Необработанное исключение: {e}")
-        os.environ["BOT_ALREADY_RUNNING"] = "False"
\ No newline at end of file
+        logger.error(f"Необработанное исключение: {e}")
\ No newline at end of file
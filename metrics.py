@@ -0,0 +1,243 @@
+# metrics.py
+#
+# Метрики планировщика и отправки уведомлений в памяти процесса.
+# - счётчики и гистограммы с фиксированными границами (секунды);
+# - job_run() оборачивает запуск задания: задержка старта относительно плана, длительность,
+#   время запросов к базе, число кандидатов, отправленных и неудачных сообщений;
+# - каждый запуск пишется структурированной строкой (JSON) в лог «metrics»;
+# - snapshot() отдаёт текущее состояние всех метрик словарём (для команды, экспорта, тестов);
+# - start() раз в SNAPSHOT_LOG_INTERVAL секунд пишет snapshot() строкой JSON в тот же лог.
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logger = logging.getLogger("metrics")
+
+# Как часто писать снимок всех метрик в лог (секунды); 0 — не писать
+SNAPSHOT_LOG_INTERVAL = int(os.getenv("METRICS_LOG_INTERVAL", "300"))
+
+# Границы корзин гистограмм задержек (секунды)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # последняя корзина — +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Оценка квантиля по корзинам (верхняя граница корзины)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (self.max,), self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "max": round(self.max, 6),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": {str(bound): count for bound, count in zip(self.buckets + ("+Inf",), self.counts)},
+        }
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._last_runs = {}
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def register_gauge(self, name, func):
+        """func() вызывается при каждом snapshot() — для значений вроде глубины очереди."""
+        with self._lock:
+            self._gauges[name] = func
+
+    def record_run(self, run):
+        with self._lock:
+            self._last_runs[run.job] = run.as_dict()
+
+    def snapshot(self):
+        with self._lock:
+            gauges = dict(self._gauges)
+            result = {
+                "counters": dict(self._counters),
+                "histograms": {name: h.snapshot() for name, h in self._histograms.items()},
+                "last_runs": dict(self._last_runs),
+            }
+        values = {}
+        for name, func in gauges.items():
+            try:
+                values[name] = func()
+            except Exception:
+                values[name] = None
+        result["gauges"] = values
+        return result
+
+
+class JobRun:
+    """Показатели одного запуска задания; заполняются внутри job_run()."""
+
+    def __init__(self, job, scheduled_at=None):
+        self.job = job
+        self.started_at = time.time()
+        # Плановое время можно задать и позже, если оно известно только после запроса
+        self.scheduled_at = scheduled_at
+        self.duration = None
+        self.query_time = 0.0
+        self.candidates = 0
+        self.sent = 0
+        self.failed = 0
+        self.deferred = 0
+        self.error = None
+
+    @property
+    def lag(self):
+        if not self.scheduled_at:
+            return None
+        return max(0.0, self.started_at - self.scheduled_at)
+
+    @contextmanager
+    def query(self):
+        """Засекает время запроса к базе: with run.query(): rows = await ..."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.query_time += time.perf_counter() - started
+
+    def add_sends(self, outcome):
+        """outcome — словарь с ключами sent/failed/deferred (см. scheduler.wait_for_sends)."""
+        self.sent += outcome.get("sent", 0)
+        self.failed += outcome.get("failed", 0)
+        self.deferred += outcome.get("deferred", 0)
+
+    def as_dict(self):
+        return {
+            "job": self.job,
+            "started_at": round(self.started_at, 3),
+            "lag": None if self.lag is None else round(self.lag, 3),
+            "duration": None if self.duration is None else round(self.duration, 3),
+            "query_time": round(self.query_time, 3),
+            "candidates": self.candidates,
+            "sent": self.sent,
+            "failed": self.failed,
+            "deferred": self.deferred,
+            "error": self.error,
+        }
+
+
+registry = Registry()
+
+
+@contextmanager
+def job_run(job, scheduled_at=None):
+    """
+    Оборачивает запуск задания job. scheduled_at — плановое время запуска (Unix-время),
+    по нему считается задержка старта.
+    """
+    run = JobRun(job, scheduled_at)
+    started = time.perf_counter()
+    try:
+        yield run
+    except Exception as e:
+        run.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        run.duration = time.perf_counter() - started
+        registry.inc(f"job_runs_total.{job}")
+        if run.error:
+            registry.inc(f"job_errors_total.{job}")
+        registry.inc(f"job_candidates_total.{job}", run.candidates)
+        registry.inc(f"job_sent_total.{job}", run.sent)
+        registry.inc(f"job_failed_total.{job}", run.failed)
+        registry.inc(f"job_deferred_total.{job}", run.deferred)
+        registry.observe(f"job_duration_seconds.{job}", run.duration)
+        registry.observe(f"job_query_seconds.{job}", run.query_time)
+        if run.lag is not None:
+            registry.observe(f"job_lag_seconds.{job}", run.lag)
+        registry.record_run(run)
+        logger.info(json.dumps({"event": "job_run", **run.as_dict()}, ensure_ascii=False))
+
+
+def inc(name, value=1):
+    registry.inc(name, value)
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS):
+    registry.observe(name, value, buckets)
+
+
+def register_gauge(name, func):
+    registry.register_gauge(name, func)
+
+
+def snapshot():
+    return registry.snapshot()
+
+
+def log_snapshot():
+    logger.info(json.dumps({"event": "metrics_snapshot", **snapshot()}, ensure_ascii=False, default=str))
+
+
+async def _log_snapshots(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            log_snapshot()
+        except Exception as e:
+            logger.error(f"Не удалось записать снимок метрик: {e}")
+
+
+_snapshot_logger = None
+
+
+def start(interval=SNAPSHOT_LOG_INTERVAL):
+    """Запускает периодическую запись snapshot() в лог (в event loop вызывающего)."""
+    global _snapshot_logger
+    if interval > 0 and (_snapshot_logger is None or _snapshot_logger.done()):
+        _snapshot_logger = asyncio.create_task(_log_snapshots(interval))
+
+
+async def stop():
+    """Останавливает периодическую запись и пишет последний снимок."""
+    global _snapshot_logger
+    if _snapshot_logger is not None:
+        _snapshot_logger.cancel()
+        await asyncio.gather(_snapshot_logger, return_exceptions=True)
+        _snapshot_logger = None
+        log_snapshot()
@@ -0,0 +1,319 @@
+# migrations.py
+#
+# Версионированные миграции схемы базы данных.
+# Каждая миграция — функция, принимающая соединение; номер версии задаётся порядком в MIGRATIONS.
+# Применённые версии записываются в таблицу schema_version, поэтому при обычном старте
+# выполняется только один SELECT.
+
+from database import get_connection, compute_due_at
+
+
+def _column_names(conn, table):
+    return [col[1] for col in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+# 🧱 1. Базовые таблицы
+def _create_base_tables(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS tasks (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        title TEXT,
+        deadline TEXT,
+        time TEXT,
+        calendar_event_id TEXT,
+        sheet_row INTEGER,
+        status TEXT,
+        msg_id INTEGER,
+        created_at TEXT,
+        completed_at TEXT,
+        hours_spent REAL
+    );
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS pending_tasks (
+        user_id INTEGER PRIMARY KEY,
+        title TEXT,
+        deadline TEXT,
+        time TEXT,
+        assigned_by TEXT,
+        comment TEXT,
+        step TEXT,
+        messages TEXT,
+        files TEXT,
+        forwarded_from TEXT
+    );
+    """)
+
+
+# 💬 2. Колонка comment (в старых базах могла быть добавлена вручную через add_comment_column)
+def _add_comment_column(conn):
+    if "comment" not in _column_names(conn, "tasks"):
+        conn.execute("ALTER TABLE tasks ADD COLUMN comment TEXT")
+
+
+# 🔎 3. Индексы под реальные запросы
+def _create_task_indexes(conn):
+    # get_active_tasks, напоминания: WHERE status = ? ... ORDER BY deadline, time
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status_deadline_time ON tasks (status, deadline, time)")
+    # Список задач пользователя: WHERE user_id = ? AND status = ? ORDER BY deadline
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_user_status_deadline ON tasks (user_id, status, deadline)")
+    # Отчёты по выполненным задачам: WHERE status = 'done' AND completed_at < ?
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status_completed_at ON tasks (status, completed_at)")
+
+
+# ⏱ 4. Материализованный момент дедлайна due_at (Unix-время) для поиска по диапазону
+def _add_due_at_column(conn):
+    if "due_at" not in _column_names(conn, "tasks"):
+        conn.execute("ALTER TABLE tasks ADD COLUMN due_at INTEGER")
+
+    rows = conn.execute("SELECT id, deadline, time FROM tasks WHERE due_at IS NULL").fetchall()
+    conn.executemany(
+        "UPDATE tasks SET due_at = ? WHERE id = ?",
+        [(compute_due_at(deadline, time), task_id) for task_id, deadline, time in rows]
+    )
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status_due_at ON tasks (status, due_at)")
+
+
+# 📄 5. Индекс для keyset-пагинации списка задач пользователя по (deadline, time, id)
+def _create_task_page_index(conn):
+    conn.execute("DROP INDEX IF EXISTS idx_tasks_user_status_deadline")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_tasks_user_status_deadline_time_id "
+        "ON tasks (user_id, status, deadline, time, id)"
+    )
+
+
+# 🧩 6. Фрагменты черновика: каждое пересланное сообщение — отдельная строка (добавление за O(1))
+def _create_pending_fragments(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS pending_fragments (
+        user_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        text TEXT,
+        file_name TEXT,
+        forwarded_from TEXT,
+        PRIMARY KEY (user_id, seq)
+    ) WITHOUT ROWID;
+    """)
+
+
+# 🗄 7. Архив выполненных задач (те же колонки, что у tasks) и общее представление для отчётов
+# Список колонок зафиксирован на момент миграции: database.TASK_COLUMNS растёт вместе со схемой
+# (calendar_etag появляется только в миграции 12), а представление должно строиться по тем колонкам,
+# которые есть у таблиц именно сейчас
+ARCHIVE_COLUMNS_V7 = (
+    "id", "user_id", "title", "deadline", "time", "calendar_event_id", "sheet_row", "status",
+    "msg_id", "created_at", "completed_at", "hours_spent", "comment", "due_at",
+)
+
+def _create_tasks_archive(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS tasks_archive (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        title TEXT,
+        deadline TEXT,
+        time TEXT,
+        calendar_event_id TEXT,
+        sheet_row INTEGER,
+        status TEXT,
+        msg_id INTEGER,
+        created_at TEXT,
+        completed_at TEXT,
+        hours_spent REAL,
+        comment TEXT,
+        due_at INTEGER
+    );
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_archive_completed_at ON tasks_archive (completed_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_archive_user_completed_at ON tasks_archive (user_id, completed_at)")
+
+    columns = ", ".join(ARCHIVE_COLUMNS_V7)
+    conn.execute(f"""
+    CREATE VIEW IF NOT EXISTS all_tasks AS
+        SELECT {columns} FROM tasks
+        UNION ALL
+        SELECT {columns} FROM tasks_archive
+    """)
+
+
+# 🔔 8. Журнал отправленных напоминаний: каждое напоминание уходит ровно один раз
+def _create_notifications_sent(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS notifications_sent (
+        task_id TEXT NOT NULL,
+        reminder_kind TEXT NOT NULL,
+        due_at INTEGER NOT NULL,
+        sent_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (task_id, reminder_kind, due_at)
+    ) WITHOUT ROWID;
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_sent_sent_at ON notifications_sent (sent_at)")
+
+
+# 🌍 9. Часовой пояс пользователя; due_at пересчитывается из местного времени пояса по умолчанию
+# (раньше он считался в поясе сервера)
+def _create_user_settings(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS user_settings (
+        user_id INTEGER PRIMARY KEY,
+        timezone TEXT NOT NULL
+    );
+    """)
+
+    rows = conn.execute("SELECT id, deadline, time FROM tasks WHERE status = 'active'").fetchall()
+    conn.executemany(
+        "UPDATE tasks SET due_at = ? WHERE id = ?",
+        [(compute_due_at(deadline, time), task_id) for task_id, deadline, time in rows]
+    )
+
+
+# 👑 10. Аренда для выбора ведущего экземпляра (см. leader.py)
+def _create_leases(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        holder TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    );
+    """)
+
+
+# 📮 11. Очередь повторной отправки сообщений и признак неактивного пользователя
+def _create_send_retries(conn):
+    if "active" not in _column_names(conn, "user_settings"):
+        conn.execute("ALTER TABLE user_settings ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS send_retries (
+        id INTEGER PRIMARY KEY,
+        chat_id INTEGER NOT NULL,
+        payload TEXT NOT NULL,
+        priority INTEGER NOT NULL,
+        attempts INTEGER NOT NULL,
+        next_attempt_at REAL NOT NULL,
+        last_error TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_send_retries_next_attempt_at ON send_retries (next_attempt_at)")
+
+
+# 🏷 12. ETag события календаря: перенос срока идёт PATCH-запросом с If-Match
+ARCHIVE_COLUMNS_V12 = ARCHIVE_COLUMNS_V7 + ("calendar_etag",)
+
+def _add_calendar_etag(conn):
+    for table in ("tasks", "tasks_archive"):
+        if "calendar_etag" not in _column_names(conn, table):
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN calendar_etag TEXT")
+
+    # Представление пересоздаётся с новым списком колонок
+    columns = ", ".join(ARCHIVE_COLUMNS_V12)
+    conn.execute("DROP VIEW IF EXISTS all_tasks")
+    conn.execute(f"""
+    CREATE VIEW all_tasks AS
+        SELECT {columns} FROM tasks
+        UNION ALL
+        SELECT {columns} FROM tasks_archive
+    """)
+
+
+# 📤 13. Outbox: побочные эффекты задач в Google (Sheets, Calendar) пишутся в одной транзакции
+# с самой задачей и доставляются фоновыми обработчиками (см. outbox.py)
+def _create_outbox(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY,
+        task_id TEXT NOT NULL,
+        channel TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        last_error TEXT,
+        created_at REAL NOT NULL
+    );
+    """)
+    # Голова очереди задачи в канале — минимальный id среди ожидающих записей
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_outbox_pending
+    ON outbox (channel, task_id, id) WHERE status = 'pending'
+    """)
+
+
+# Порядок важен: номер версии = позиция в списке (начиная с 1)
+MIGRATIONS = [
+    ("Базовые таблицы tasks и pending_tasks", _create_base_tables),
+    ("Колонка tasks.comment", _add_comment_column),
+    ("Индексы по status/deadline/user_id/completed_at", _create_task_indexes),
+    ("Колонка tasks.due_at с индексом", _add_due_at_column),
+    ("Индекс (user_id, status, deadline, time, id) для постраничного списка", _create_task_page_index),
+    ("Таблица pending_fragments", _create_pending_fragments),
+    ("Архив tasks_archive и представление all_tasks", _create_tasks_archive),
+    ("Журнал отправленных напоминаний notifications_sent", _create_notifications_sent),
+    ("Таблица user_settings (часовой пояс) и пересчёт due_at", _create_user_settings),
+    ("Таблица leases для выбора ведущего экземпляра", _create_leases),
+    ("Очередь send_retries и колонка user_settings.active", _create_send_retries),
+    ("Колонка calendar_etag в tasks и tasks_archive", _add_calendar_etag),
+    ("Таблица outbox для доставки изменений в Google", _create_outbox),
+]
+
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(conn=None):
+    conn = conn or get_connection()
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate():
+    """
+    Применяет недостающие миграции. Если схема актуальна — ничего не делает.
+    Каждая миграция выполняется в отдельной транзакции вместе с записью в schema_version.
+    """
+    conn = get_connection()
+    current = get_schema_version(conn)
+
+    if current >= LATEST_VERSION:
+        return current
+
+    for version, (description, step) in enumerate(MIGRATIONS, start=1):
+        if version <= current:
+            continue
+
+        # BEGIN IMMEDIATE сразу берёт блокировку записи, поэтому два процесса не применят миграцию дважды
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            step(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description)
+            )
+            conn.commit()
+            print(f"Применена миграция {version}: {description}")
+        except BaseException:
+            # Любая ошибка шага (не только sqlite3.Error) должна закрыть транзакцию: иначе
+            # открытый BEGIN остался бы на соединении потока и следующий transaction() к нему присоединился бы
+            conn.rollback()
+            raise
+
+    return LATEST_VERSION
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,299 @@
+# notifier.py
+#
+# Диспетчер исходящих уведомлений в Telegram.
+# - отправка идёт несколькими воркерами параллельно (MAX_CONCURRENCY);
+# - общий token bucket ограничивает поток ~30 сообщений в секунду (лимит Bot API);
+# - на один чат — не чаще одного сообщения в PER_CHAT_INTERVAL секунд;
+# - при TelegramRetryAfter отправка приостанавливается на указанное время, сообщение
+#   возвращается в очередь;
+# - очередь приоритетная: напоминания за час уходят раньше ежедневных;
+# - временные ошибки (таймауты, 5xx) не теряют сообщение: оно сохраняется в таблицу
+#   send_retries и отправляется снова с экспоненциальной задержкой и джиттером,
+#   не больше RETRY_MAX_ATTEMPTS попыток;
+# - постоянные ошибки (бот заблокирован, чат не найден) помечают пользователя неактивным,
+#   и выборки напоминаний его больше не видят.
+
+import asyncio
+import itertools
+import json
+import random
+import time
+
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramNetworkError, TelegramServerError,
+    TelegramForbiddenError, TelegramBadRequest,
+)
+from aiogram.types import InlineKeyboardMarkup
+
+from async_db import add_send_retry, claim_due_send_retries, reschedule_send_retry, delete_send_retry
+from async_db import extend_send_retries
+from async_db import set_user_active
+import metrics
+
+# Приоритеты (меньше — важнее)
+PRIORITY_HOURLY = 0
+PRIORITY_DAILY = 1
+PRIORITY_BROADCAST = 2
+
+GLOBAL_RATE = 30          # сообщений в секунду на всего бота
+PER_CHAT_INTERVAL = 1.0   # секунд между сообщениями в один чат
+MAX_CONCURRENCY = 10
+
+# Повторная отправка: задержка base * 2^(попытка-1), не больше max, со случайным разбросом
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 30       # секунд
+RETRY_MAX_DELAY = 60 * 60   # секунд
+RETRY_POLL_INTERVAL = 15    # как часто проверять очередь повторов
+RETRY_BATCH = 50            # сколько повторов забирать за раз
+RETRY_LEASE = 5 * 60        # на сколько откладывать забранные повторы (защита от падения)
+
+# Классы ошибок отправки
+ERROR_RETRYABLE = "retryable"   # стоит повторить позже
+ERROR_BLOCKED = "blocked"       # пользователь недоступен навсегда
+ERROR_PERMANENT = "permanent"   # это сообщение отправить нельзя (например, ошибка разметки)
+
+# Тексты ошибок Bot API, означающие, что чат недоступен
+BLOCKED_MESSAGES = ("chat not found", "user is deactivated", "bot was blocked", "bot was kicked")
+
+
+class SendDeferred(Exception):
+    """Сообщение не отправлено сразу, но сохранено в очередь повторов."""
+
+
+class ChatUnavailable(Exception):
+    """Чат недоступен (бот заблокирован, чат не найден): пользователь помечен неактивным."""
+
+
+def classify_error(error):
+    if isinstance(error, (TelegramRetryAfter, TelegramNetworkError, TelegramServerError, asyncio.TimeoutError)):
+        return ERROR_RETRYABLE
+    # «chat not found» приходит как 400 (TelegramBadRequest, см. ниже). 404 (TelegramNotFound)
+    # означает неверный метод или токен — из-за него нельзя отключать всех получателей
+    if isinstance(error, TelegramForbiddenError):
+        return ERROR_BLOCKED
+    if isinstance(error, TelegramBadRequest):
+        text = str(error).lower()
+        if any(marker in text for marker in BLOCKED_MESSAGES):
+            return ERROR_BLOCKED
+        return ERROR_PERMANENT
+    # Ошибки соединения aiohttp и прочие OSError — временные
+    if isinstance(error, OSError):
+        return ERROR_RETRYABLE
+    return ERROR_PERMANENT
+
+
+def retry_delay(attempt):
+    """Экспоненциальная задержка перед попыткой attempt + 1 с «равным» джиттером."""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _dump_message(message):
+    data = dict(message)
+    if data.get("reply_markup") is not None:
+        data["reply_markup"] = data["reply_markup"].model_dump(exclude_none=True)
+    return json.dumps(data, ensure_ascii=False)
+
+
+def _load_message(payload):
+    data = json.loads(payload)
+    if data.get("reply_markup") is not None:
+        data["reply_markup"] = InlineKeyboardMarkup.model_validate(data["reply_markup"])
+    return data
+
+
+class TokenBucket:
+    """Простой асинхронный token bucket с возможностью глобальной паузы (для RetryAfter)."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class NotificationDispatcher:
+    def __init__(self, bot, concurrency=MAX_CONCURRENCY, rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.per_chat_interval = per_chat_interval
+        self._bucket = TokenBucket(rate)
+        self._queue = None
+        self._workers = []
+        self._counter = itertools.count()  # Сохраняет порядок FIFO внутри одного приоритета
+        self._chat_next_send = {}
+        self._retry_poller = None
+        # Повторы, которые уже стоят в очереди в памяти: их аренда продлевается при каждом опросе,
+        # а повторно забранная строка не ставится в очередь второй раз (иначе двойная отправка)
+        self._queued_retries = set()
+
+    def start(self):
+        if self._workers:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        self._retry_poller = asyncio.create_task(self._poll_retries())
+
+    async def stop(self):
+        tasks = self._workers + ([self._retry_poller] if self._retry_poller else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._retry_poller = None
+        self._queued_retries.clear()
+
+        # Всё, что не успели отправить, отменяем, чтобы ожидающие не зависли.
+        # Повторы остаются в send_retries и будут отправлены после перезапуска.
+        while self._queue is not None and not self._queue.empty():
+            _, _, _, future, _, _ = self._queue.get_nowait()
+            if future is not None:
+                future.cancel()
+
+    @property
+    def queue_size(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def enqueue(self, chat_id, text, reply_markup=None, priority=PRIORITY_BROADCAST, **kwargs):
+        """
+        Ставит сообщение в очередь и возвращает Future с результатом bot.send_message
+        (или с исключением, если отправить не удалось).
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        message = {"chat_id": chat_id, "text": text, "reply_markup": reply_markup, **kwargs}
+        self._queue.put_nowait((priority, next(self._counter), message, future, None, time.monotonic()))
+        return future
+
+    async def send(self, chat_id, text, reply_markup=None, priority=PRIORITY_BROADCAST, **kwargs):
+        return await self.enqueue(chat_id, text, reply_markup=reply_markup, priority=priority, **kwargs)
+
+    async def _wait_for_chat(self, chat_id):
+        # Резервируем слот для чата до первого await, поэтому два воркера не попадут в один слот
+        now = time.monotonic()
+        slot = max(now, self._chat_next_send.get(chat_id, 0.0))
+        self._chat_next_send[chat_id] = slot + self.per_chat_interval
+
+        if len(self._chat_next_send) > 10000:
+            self._chat_next_send = {c: t for c, t in self._chat_next_send.items() if t > now}
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _worker(self):
+        while True:
+            priority, order, message, future, retry, enqueued_at = await self._queue.get()
+            requeued = False
+            try:
+                if future is not None and future.cancelled():
+                    continue
+
+                await self._wait_for_chat(message["chat_id"])
+                await self._bucket.acquire()
+                started = time.monotonic()
+                try:
+                    result = await self.bot.send_message(**message)
+                except TelegramRetryAfter as e:
+                    # Telegram просит подождать: ставим на паузу все отправки и повторяем позже
+                    print(f"Flood control: пауза {e.retry_after} с, сообщение в чат {message['chat_id']} будет повторено")
+                    metrics.inc("send_retry_after_total")
+                    self._bucket.pause(e.retry_after)
+                    self._queue.put_nowait((priority, order, message, future, retry, enqueued_at))
+                    requeued = True
+                    continue
+                except Exception as e:
+                    metrics.inc(f"send_errors_total.{classify_error(e)}")
+                    outcome = await self._handle_failure(priority, message, retry, e)
+                    if future is not None and not future.done():
+                        future.set_exception(outcome)
+                    continue
+
+                # Время вызова Bot API и полное время от постановки в очередь до доставки
+                finished = time.monotonic()
+                metrics.observe("send_api_seconds", finished - started)
+                metrics.observe(f"send_latency_seconds.p{priority}", finished - enqueued_at)
+                metrics.inc("sends_total")
+
+                if retry is not None:
+                    await delete_send_retry(retry["id"])
+                if future is not None and not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                print(f"Ошибка в воркере отправки (чат {message['chat_id']}): {e}")
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            finally:
+                if retry is not None and not requeued:
+                    self._queued_retries.discard(retry["id"])
+                self._queue.task_done()
+
+    async def _handle_failure(self, priority, message, retry, error):
+        """
+        Решает судьбу неотправленного сообщения и возвращает исключение для ожидающего:
+        SendDeferred — сохранено для повтора, ChatUnavailable — пользователь отключён,
+        иначе — исходная ошибка.
+        """
+        kind = classify_error(error)
+        chat_id = message["chat_id"]
+        attempts = (retry["attempts"] if retry else 0) + 1
+
+        if kind == ERROR_BLOCKED:
+            if retry is not None:
+                await delete_send_retry(retry["id"])
+            if await set_user_active(chat_id, False):
+                print(f"Чат {chat_id} недоступен ({error}), пользователь помечен неактивным")
+            return ChatUnavailable(str(error))
+
+        if kind == ERROR_RETRYABLE and attempts < RETRY_MAX_ATTEMPTS:
+            next_attempt_at = time.time() + retry_delay(attempts)
+            if retry is None:
+                await add_send_retry(chat_id, _dump_message(message), priority, attempts, next_attempt_at, str(error))
+            else:
+                await reschedule_send_retry(retry["id"], attempts, next_attempt_at, str(error))
+            print(f"Временная ошибка отправки в чат {chat_id} ({error}), попытка {attempts}, повтор отложен")
+            return SendDeferred(str(error))
+
+        if retry is not None:
+            await delete_send_retry(retry["id"])
+        print(f"Сообщение в чат {chat_id} не отправлено ({kind}, попыток: {attempts}): {error}")
+        return error
+
+    async def _poll_retries(self):
+        """Периодически забирает из send_retries сообщения, время повтора которых наступило."""
+        while True:
+            try:
+                # Повтор может ждать в очереди дольше RETRY_LEASE (пауза flood control, большой дайджест):
+                # продлеваем аренду, чтобы его не забрал ни этот, ни другой экземпляр
+                if self._queued_retries:
+                    await extend_send_retries(list(self._queued_retries), time.time() + RETRY_LEASE)
+                rows = await claim_due_send_retries(time.time(), RETRY_BATCH, RETRY_LEASE)
+                for row in rows:
+                    if row["id"] in self._queued_retries:
+                        continue
+                    retry = {"id": row["id"], "attempts": row["attempts"]}
+                    message = _load_message(row["payload"])
+                    self._queued_retries.add(row["id"])
+                    self._queue.put_nowait((row["priority"], next(self._counter), message, None, retry, time.monotonic()))
+            except Exception as e:
+                print(f"Ошибка чтения очереди повторов: {e}")
+            await asyncio.sleep(RETRY_POLL_INTERVAL)
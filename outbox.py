@@ -0,0 +1,376 @@
+# outbox.py
+#
+# Доставка изменений задач в Google Sheets и Google Calendar через outbox.
+# Обработчик не ждёт Google: изменение задачи и записи outbox фиксируются в базе одной транзакцией
+# (add_task / complete_task / update_task_deadline / set_user_timezone с параметром effects), и пользователь сразу
+# получает ответ. Дальше записи доставляют фоновые обработчики — по одному на канал:
+# - записи одной задачи в одном канале выполняются строго по порядку (сначала строка в таблице,
+#   потом её обновления), каналы и разные задачи друг друга не ждут;
+# - временные ошибки (таймауты, сеть, 429, 5xx) повторяются с экспоненциальной задержкой,
+#   не больше MAX_ATTEMPTS попыток; после этого или при постоянной ошибке запись помечается
+#   безнадёжной (status = 'dead') и остаётся в таблице для разбора;
+# - каждая операция идемпотентна, поэтому повтор после потерянного ответа безопасен:
+#   строка таблицы ищется по Task ID, событие календаря создаётся с постоянным ID
+#   (event_id_for_task), обновления перезаписывают значения, удаление удалённого — успех;
+# - несколько экземпляров бота могут разбирать outbox одновременно: забранная запись
+#   откладывается на LEASE секунд (как в send_retries). Исключение — Sheets: номер строки
+#   задачи сохраняется в базе, поэтому строки добавляет только ведущий экземпляр (leader.py);
+# - переносы и удаления событий календаря, забранные вместе (например, все задачи пользователя
+#   после смены часового пояса), уходят пакетами по google_calendar.BATCH_LIMIT одним запросом,
+#   а результат каждой операции разбирается отдельно.
+
+import asyncio
+import json
+import random
+import time
+from dataclasses import asdict
+
+from async_db import claim_outbox, complete_outbox, reschedule_outbox, fail_outbox
+from async_db import get_task_by_id, get_user_timezone, update_sheet_row, update_calendar_event
+from database import DEFAULT_TASK_TIME
+from google_calendar import INVALID_EVENT_IDS, RETRYABLE_STATUSES, RETRYABLE_REASONS, event_id_for_task, event_times
+from models.task_model import Task
+from leader import leader
+import google_async
+import metrics
+
+SHEETS = "sheets"
+CALENDAR = "calendar"
+
+# Виды записей
+SHEET_APPEND = "sheet_append"
+SHEET_COMPLETE = "sheet_complete"
+SHEET_DEADLINE = "sheet_deadline"
+CALENDAR_CREATE = "calendar_create"
+CALENDAR_MOVE = "calendar_move"
+CALENDAR_DELETE = "calendar_delete"
+
+MAX_ATTEMPTS = 10
+BASE_DELAY = 30             # секунд
+MAX_DELAY = 60 * 60         # секунд
+POLL_INTERVAL = 15          # как часто проверять outbox без сигнала от обработчиков
+BATCH = 50                  # сколько записей забирать за раз
+LEASE = 5 * 60              # на сколько откладывать забранные записи (защита от падения)
+# Строки таблицы добавляются по одной (см. google_sheets.add_task_to_sheet)
+SHEETS_CONCURRENCY = 1
+CALENDAR_CONCURRENCY = google_async.CALENDAR_THREADS
+
+# Состояние задачи, по которому выполняются операции
+TASK_COLUMNS = ("id", "user_id", "title", "deadline", "time", "sheet_row", "calendar_event_id", "calendar_etag")
+
+
+# 🧾 Записи для транзакции изменения задачи
+def task_added(task):
+    """task — models.task_model.Task."""
+    return [
+        (SHEETS, SHEET_APPEND, asdict(task)),
+        (CALENDAR, CALENDAR_CREATE, {}),
+    ]
+
+
+def task_completed(hours, comment=None):
+    return [
+        (SHEETS, SHEET_COMPLETE, {"hours": hours, "comment": comment}),
+        (CALENDAR, CALENDAR_DELETE, {}),
+    ]
+
+
+def deadline_moved(deadline):
+    return [
+        (SHEETS, SHEET_DEADLINE, {"deadline": deadline}),
+        (CALENDAR, CALENDAR_MOVE, {}),
+    ]
+
+
+def timezone_changed():
+    """Для каждой активной задачи пользователя: событие переносится в новый пояс."""
+    return [(CALENDAR, CALENDAR_MOVE, {})]
+
+
+# 📊 Sheets
+async def _sheet_append(task, payload):
+    if task["sheet_row"]:
+        return
+    row = await google_async.add_task_to_sheet(Task(**payload))
+    await update_sheet_row(task["id"], row)
+
+
+async def _sheet_complete(task, payload):
+    if not task["sheet_row"]:
+        print(f"Задача {task['id']} не найдена в таблице, отметка о выполнении пропущена")
+        return
+    await google_async.update_task_in_sheet(task["sheet_row"], "done", payload["hours"], payload.get("comment"))
+
+
+async def _sheet_deadline(task, payload):
+    if not task["sheet_row"]:
+        print(f"Задача {task['id']} не найдена в таблице, перенос срока пропущен")
+        return
+    await google_async.update_deadline_in_sheet(task["sheet_row"], payload["deadline"])
+
+
+# 📅 Calendar
+# Срок события берётся из текущего состояния задачи, а не из записи outbox:
+# если срок успели перенести, событие сразу создаётся (или переносится) на новый
+async def _event_task(task):
+    return {
+        "id": task["id"],
+        "title": task["title"],
+        "deadline": task["deadline"],
+        "time": task["time"] or DEFAULT_TASK_TIME,
+        "timezone": await get_user_timezone(task["user_id"]),
+        "calendar_event_id": task["calendar_event_id"],
+        "calendar_etag": task["calendar_etag"],
+    }
+
+
+async def _calendar_create(task, payload):
+    if task["calendar_event_id"] not in INVALID_EVENT_IDS:
+        return
+    event = await google_async.ensure_event(await _event_task(task), event_id_for_task(task["id"]))
+    await update_calendar_event(task["id"], event.get("id"), event.get("etag"))
+
+
+async def _calendar_move(task, payload):
+    if task["calendar_event_id"] in INVALID_EVENT_IDS:
+        # События нет (задачи, созданные при недоступном календаре) — создаём его
+        await _calendar_create(task, payload)
+        return
+    event = await google_async.move_event(await _event_task(task))
+    if event:
+        await update_calendar_event(task["id"], event["id"], event["etag"])
+
+
+async def _calendar_delete(task, payload):
+    if task["calendar_event_id"] in INVALID_EVENT_IDS:
+        return
+    await google_async.remove_event(task["calendar_event_id"])
+
+
+# 📦 Пакет календаря: переносы и удаления существующих событий.
+# Создание события и перенос с пересозданием (события нет) идут по одной через обработчики выше.
+BATCHED_KINDS = {CALENDAR_MOVE, CALENDAR_DELETE}
+
+
+async def _calendar_operation(row, task):
+    if row["kind"] == CALENDAR_DELETE:
+        return {"key": row["id"], "op": "delete", "event_id": task["calendar_event_id"]}
+    # Без If-Match: как move_event с force_on_conflict, срок переписывается в любом случае
+    event_task = await _event_task(task)
+    return {
+        "key": row["id"],
+        "op": "patch",
+        "event_id": task["calendar_event_id"],
+        "body": event_times(event_task["deadline"], event_task["time"], event_task["timezone"]),
+    }
+
+
+async def _calendar_batch(worker, rows):
+    """
+    Отправляет переносы и удаления событий из rows пакетом и возвращает записи,
+    которые нужно обработать по одной. У каждой задачи в rows не больше одной записи
+    (claim_outbox выдаёт только голову очереди задачи), поэтому ключ операции — id записи.
+    """
+    batchable = [row for row in rows if row["kind"] in BATCHED_KINDS]
+    if len(batchable) < 2:
+        return rows
+    rest = [row for row in rows if row["kind"] not in BATCHED_KINDS]
+
+    tasks = await asyncio.gather(*(get_task_by_id(row["task_id"], columns=TASK_COLUMNS) for row in batchable))
+    batched = {}
+    operations = []
+    for row, task in zip(batchable, tasks):
+        if task is None or task["calendar_event_id"] in INVALID_EVENT_IDS:
+            rest.append(row)
+            continue
+        operations.append(await _calendar_operation(row, task))
+        batched[row["id"]] = (row, task)
+    if len(operations) < 2:
+        return rest + [row for row, _ in batched.values()]
+
+    worker.inflight += len(operations)
+    try:
+        try:
+            # Повторами управляет outbox, поэтому пакет отправляется один раз
+            results = await google_async.batch_calendar_operations(operations, max_rounds=1)
+        except Exception as e:
+            results = {key: (False, e) for key in batched}
+        metrics.inc(f"outbox_batches_total.{worker.channel}")
+
+        for key, (row, task) in batched.items():
+            ok, response = results[key]
+            try:
+                if ok:
+                    if row["kind"] == CALENDAR_MOVE and response:
+                        await update_calendar_event(task["id"], response["id"], response["etag"])
+                    await worker.delivered(row)
+                elif row["kind"] == CALENDAR_MOVE and _http_status(response) in (404, 410):
+                    # События больше нет — move_event создаст его заново
+                    rest.append(row)
+                else:
+                    await worker.handle_failure(row, response)
+            except Exception as e:
+                # Запись останется забранной до истечения LEASE и будет повторена
+                print(f"Ошибка обработки записи outbox {row['id']} ({row['kind']}): {e}")
+    finally:
+        worker.inflight -= len(operations)
+    return rest
+
+
+def _http_status(error):
+    # googleapiclient: HttpError.resp.status; gspread: APIError.response.status_code
+    status = getattr(getattr(error, "resp", None), "status", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return int(status) if status is not None else None
+
+
+def is_retryable(error):
+    if isinstance(error, (asyncio.TimeoutError, OSError)):
+        return True
+    status = _http_status(error)
+    if status is None:
+        # Ошибки конфигурации и данных повтор не исправит, прочие (сеть httplib2 и т.п.) — временные
+        return not isinstance(error, (ValueError, KeyError, TypeError, AttributeError))
+    if status in RETRYABLE_STATUSES:
+        return True
+    return status == 403 and any(reason in str(error) for reason in RETRYABLE_REASONS)
+
+
+def retry_delay(attempt):
+    """Экспоненциальная задержка перед попыткой attempt + 1 с «равным» джиттером."""
+    delay = min(MAX_DELAY, BASE_DELAY * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class OutboxWorker:
+    def __init__(self, channel, handlers, concurrency=1, lease=None, batch=None):
+        self.channel = channel
+        self.handlers = handlers
+        self.concurrency = concurrency
+        # Если задана аренда — записи разбираются, только пока экземпляр её держит
+        self.lease = lease
+        # batch(worker, rows) — корутина, которая доставляет часть записей одним запросом
+        # и возвращает остальные для обработки по одной
+        self.batch = batch
+        self._runner = None
+        self._wakeup = None
+        self.inflight = 0
+        metrics.register_gauge(f"outbox_inflight.{channel}", lambda: self.inflight)
+
+    def start(self):
+        if self._runner is None or self._runner.done():
+            self._wakeup = asyncio.Event()
+            self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Прерванные записи остаются в outbox и будут доставлены после истечения LEASE
+        if self._runner is not None:
+            self._runner.cancel()
+            await asyncio.gather(self._runner, return_exceptions=True)
+            self._runner = None
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def process(row):
+            async with semaphore:
+                await self._process(row)
+
+        while True:
+            self._wakeup.clear()
+            if self.lease is not None and not self.lease.is_leader:
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            try:
+                rows = await claim_outbox(self.channel, time.time(), BATCH, LEASE)
+            except Exception as e:
+                print(f"Ошибка чтения outbox ({self.channel}): {e}")
+                rows = []
+
+            if rows:
+                if self.batch is not None:
+                    try:
+                        rows = await self.batch(self, rows)
+                    except Exception as e:
+                        # Не отправленные пакетом записи доставляются по одной
+                        print(f"Ошибка пакетной обработки outbox ({self.channel}): {e}")
+                await asyncio.gather(*(process(row) for row in rows))
+                # Следом могут быть готовы следующие записи тех же задач
+                continue
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _process(self, row):
+        kind = row["kind"]
+        self.inflight += 1
+        try:
+            try:
+                task = await get_task_by_id(row["task_id"], columns=TASK_COLUMNS)
+                if task is None:
+                    print(f"Задача {row['task_id']} не найдена, запись outbox {kind} пропущена")
+                else:
+                    await self.handlers[kind](task, json.loads(row["payload"]))
+            except Exception as e:
+                await self.handle_failure(row, e)
+                return
+            await self.delivered(row)
+        except Exception as e:
+            # Запись останется забранной до истечения LEASE и будет повторена
+            print(f"Ошибка обработки записи outbox {row['id']} ({kind}): {e}")
+        finally:
+            self.inflight -= 1
+
+    async def delivered(self, row):
+        await complete_outbox(row["id"])
+        metrics.inc(f"outbox_delivered_total.{row['kind']}")
+        metrics.observe(f"outbox_delay_seconds.{self.channel}", time.time() - row["created_at"])
+
+    async def handle_failure(self, row, error):
+        kind = row["kind"]
+        attempts = row["attempts"] + 1
+        error_text = f"{type(error).__name__}: {error}"
+        if is_retryable(error) and attempts < MAX_ATTEMPTS:
+            await reschedule_outbox(row["id"], attempts, time.time() + retry_delay(attempts), error_text)
+            metrics.inc(f"outbox_retries_total.{kind}")
+            print(f"Временная ошибка {kind} для задачи {row['task_id']} ({error_text}), попытка {attempts}, повтор отложен")
+        else:
+            await fail_outbox(row["id"], attempts, error_text)
+            metrics.inc(f"outbox_failed_total.{kind}")
+            print(f"Запись outbox {kind} для задачи {row['task_id']} не доставлена (попыток: {attempts}): {error_text}")
+
+
+workers = [
+    OutboxWorker(SHEETS, {
+        SHEET_APPEND: _sheet_append,
+        SHEET_COMPLETE: _sheet_complete,
+        SHEET_DEADLINE: _sheet_deadline,
+    }, SHEETS_CONCURRENCY, lease=leader),
+    OutboxWorker(CALENDAR, {
+        CALENDAR_CREATE: _calendar_create,
+        CALENDAR_MOVE: _calendar_move,
+        CALENDAR_DELETE: _calendar_delete,
+    }, CALENDAR_CONCURRENCY, batch=_calendar_batch),
+]
+
+
+def start():
+    for worker in workers:
+        worker.start()
+
+
+async def stop():
+    await asyncio.gather(*(worker.stop() for worker in workers))
+
+
+def notify():
+    """Будит обработчики после фиксации новых записей, не дожидаясь POLL_INTERVAL."""
+    for worker in workers:
+        worker.wake()
@@ -0,0 +1,136 @@
+# reminders.py
+#
+# Точный таймер напоминаний «за час до дедлайна».
+# Моменты срабатывания хранятся в min-куче в памяти; одна asyncio-задача спит ровно
+# до ближайшего момента, поэтому напоминания приходят вовремя без периодического опроса базы.
+# Все моменты — Unix-время (UTC), поэтому от часового пояса сервера таймер не зависит.
+# Куча заполняется при старте (scheduler.start_scheduler) и обновляется обработчиками:
+# schedule_at() — при создании и переносе задачи (due_at возвращает база), cancel() — при выполнении.
+
+import asyncio
+import heapq
+import time
+
+# За сколько секунд до дедлайна отправлять напоминание
+REMINDER_LEAD = 60 * 60
+# Максимальный сон за один раз: страхует от перевода системных часов
+MAX_SLEEP = 60
+
+
+class ReminderTimer:
+    def __init__(self, lead=REMINDER_LEAD):
+        self.lead = lead
+        self._heap = []        # (fire_at, task_id, due_at)
+        self._scheduled = {}   # task_id -> due_at, актуальная запись; остальные в куче считаются устаревшими
+        self._wakeup = None
+        self._runner = None
+        self._on_due = None
+        self._inflight = set()  # отправки сработавших напоминаний (ссылки, чтобы их не собрал сборщик мусора)
+
+    @property
+    def pending(self):
+        """Сколько напоминаний сейчас запланировано."""
+        return len(self._scheduled)
+
+    @property
+    def running(self):
+        return self._runner is not None and not self._runner.done()
+
+    def load(self, items):
+        """Заполняет таймер парами (task_id, due_at)."""
+        for task_id, due_at in items:
+            self._push(task_id, due_at)
+        heapq.heapify(self._heap)
+        # Таймер может уже спать до более позднего момента
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self, on_due):
+        """on_due(task_ids) — корутина, которая отправляет напоминания по списку задач."""
+        self._on_due = on_due
+        self._wakeup = asyncio.Event()
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            await asyncio.gather(self._runner, return_exceptions=True)
+            self._runner = None
+        for task in self._inflight:
+            task.cancel()
+        await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    def schedule_at(self, task_id, due_at):
+        if due_at is None:
+            self.cancel(task_id)
+            return
+        previous_head = self._heap[0][0] if self._heap else None
+        self._push(task_id, due_at, keep_heap=True)
+        # Будим спящую задачу, только если новое напоминание раньше текущего ближайшего
+        if self._wakeup is not None and (previous_head is None or due_at - self.lead < previous_head):
+            self._wakeup.set()
+
+    def cancel(self, task_id):
+        # Запись в куче остаётся, но при извлечении будет пропущена
+        self._scheduled.pop(task_id, None)
+
+    def is_current(self, task_id, due_at):
+        return self._scheduled.get(task_id) == due_at
+
+    def _push(self, task_id, due_at, keep_heap=False):
+        self._scheduled[task_id] = due_at
+        entry = (due_at - self.lead, task_id, due_at)
+        if keep_heap:
+            heapq.heappush(self._heap, entry)
+        else:
+            self._heap.append(entry)
+
+    def _pop_due(self, now):
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            _, task_id, due_at = heapq.heappop(self._heap)
+            if self._scheduled.get(task_id) == due_at:
+                due[task_id] = due_at
+        return due
+
+    async def _run(self):
+        while True:
+            # Пропускаем устаревшие записи на вершине кучи
+            while self._heap and self._scheduled.get(self._heap[0][1]) != self._heap[0][2]:
+                heapq.heappop(self._heap)
+
+            now = time.time()
+            delay = self._heap[0][0] - now if self._heap else MAX_SLEEP
+
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=min(delay, MAX_SLEEP))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            fired = self._pop_due(now)
+            if not fired:
+                continue
+
+            # Отправку не ждём: on_due ждёт доставки через диспетчер (интервалы между сообщениями
+            # в чат, паузы RetryAfter), а следующие напоминания должны сработать вовремя
+            task = asyncio.create_task(self._fire(fired))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _fire(self, fired):
+        try:
+            await self._on_due(list(fired))
+        except Exception as e:
+            print(f"Ошибка при отправке напоминаний {list(fired)}: {e}")
+        finally:
+            # Напоминание отправлено — запись больше не нужна (если задачу не перенесли за это время)
+            for task_id, due_at in fired.items():
+                if self._scheduled.get(task_id) == due_at:
+                    del self._scheduled[task_id]
+
+
+reminder_timer = ReminderTimer()
@@ -1,86 +1,370 @@
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.events import EVENT_JOB_SUBMITTED
+from sqlalchemy import create_engine, event
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-import google_calendar
 import asyncio
-from database import get_tasks_due_in_one_hour, get_active_tasks
-from aiogram import Bot
+from async_db import archive_completed_tasks
+from async_db import get_tasks_by_ids, get_upcoming_due_tasks, claim_reminders, release_reminders
+from async_db import get_tasks_due_on_by_user, get_missed_hour_reminders, get_timezone_buckets
+from database import REMINDER_HOUR, REMINDER_DAY, BUSY_TIMEOUT_MS, DEFAULT_TIMEZONE, get_zone
+from reminders import reminder_timer
+from leader import leader
+import metrics
 import os
 from datetime import datetime, timedelta
+from notifier import NotificationDispatcher, PRIORITY_DAILY, PRIORITY_HOURLY
+from notifier import SendDeferred, ChatUnavailable
 
-from dotenv import load_dotenv
+# Бот приложения и диспетчер уведомлений передаются из main.py при старте (start_scheduler),
+# чтобы весь исходящий трафик шёл через одну HTTP-сессию и один ограничитель скорости
+bot = None
+dispatcher = None
 
-load_dotenv()
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-bot = Bot(token=BOT_TOKEN, parse_mode="HTML")
+# Колонки, нужные для напоминания за час
+REMINDER_COLUMNS = ("id", "user_id", "title", "deadline", "time", "status", "due_at")
 
-scheduler = AsyncIOScheduler()
+# Сколько задач показывать в ежедневном дайджесте (ограничение на размер клавиатуры)
+DIGEST_MAX_TASKS = 20
 
-def start_scheduler():
-    # Планирование ежедневной проверки задач с дедлайном на завтра
-    scheduler.add_job(daily_deadline_check, 'cron', hour=9)  # Запуск каждый день в 9:00
-    # Планирование проверки задач за час до дедлайна
-    scheduler.add_job(hourly_deadline_check, 'interval', minutes=60)
-    scheduler.start()
+# Через сколько дней после выполнения задача переносится в архив
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
 
-async def daily_deadline_check():
-    # Получаем список задач с дедлайном на завтра и отправляем уведомления
-    tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
-    tasks = get_active_tasks(deadline=tomorrow)
-    
-    for task in tasks:
-        user_id = task[1]  # user_id
-        task_id = task[0]  # task_id
-        title = task[2]    # title
-        deadline = task[3] # deadline
+# Задания планировщика хранятся в базе (JOBSTORE_FILE), поэтому после перезапуска APScheduler знает,
+# какие запуски были пропущены. coalesce схлопывает несколько пропущенных запусков в один,
+# misfire_grace_time — сколько секунд после назначенного времени запуск ещё имеет смысл.
+MISFIRE_GRACE_TIME = int(os.getenv("MISFIRE_GRACE_TIME", str(6 * 60 * 60)))
 
-        # Создаем клавиатуру с кнопками
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text="✅ Выполнено", callback_data=f"mark_done_{task_id}"),
-                InlineKeyboardButton(text="⏳ Продлить", callback_data=f"extend_deadline_{task_id}")
-            ]
-        ])
+# Догоняющий проход при старте: дедлайны, наступившие за последние CATCHUP_WINDOW секунд,
+# по которым не ушло напоминание. Не больше CATCHUP_LIMIT задач за один проход.
+CATCHUP_WINDOW = int(os.getenv("CATCHUP_WINDOW", str(6 * 60 * 60)))
+CATCHUP_LIMIT = 500
+
+# Фоновые корутины, запущенные без ожидания (чтобы их не собрал сборщик мусора)
+_background = set()
+
+DAILY_JOB_ID = "daily_deadline_check"
+# Ежедневный дайджест приходит в DIGEST_HOUR по местному времени пользователя:
+# одно задание на часовой пояс (id = DAILY_JOB_ID:<пояс>), а не на пользователя
+DIGEST_HOUR = 9
+ARCHIVE_JOB_ID = "archive_done_tasks"
+DIGEST_SYNC_JOB_ID = "sync_digest_jobs"
+DIGEST_SYNC_MINUTE = 5
+
+# Хранилище заданий APScheduler работает через SQLAlchemy со своим пулом соединений и пишет
+# синхронно из event loop (при каждом запуске задания обновляется next_run_time), поэтому через
+# database.py / async_db.py оно не идёт. Чтобы эти записи не конкурировали с ботом за блокировку
+# записи db.sqlite3, у хранилища отдельный файл. Задания из прежнего хранилища в db.sqlite3
+# не переносятся: ensure_job создаёт их заново, пропущенные напоминания догоняет catch_up_missed_reminders().
+JOBSTORE_FILE = os.getenv("SCHEDULER_DB_FILE", "jobs.sqlite3")
+
+jobstore_engine = create_engine(f"sqlite:///{JOBSTORE_FILE}")
+
+@event.listens_for(jobstore_engine, "connect")
+def _configure_jobstore_connection(dbapi_connection, connection_record):
+    # Те же настройки, что у соединений database.py: WAL и ожидание блокировки вместо SQLITE_BUSY
+    dbapi_connection.execute("PRAGMA journal_mode=WAL")
+    dbapi_connection.execute("PRAGMA synchronous=NORMAL")
+    dbapi_connection.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+
+scheduler = AsyncIOScheduler(
+    jobstores={"default": SQLAlchemyJobStore(engine=jobstore_engine)},
+    job_defaults={"coalesce": True, "misfire_grace_time": MISFIRE_GRACE_TIME, "max_instances": 1},
+)
+
+# Плановое время последнего запуска каждого задания (для метрики задержки старта)
+_planned_runs = {}
+
+def _on_job_submitted(event):
+    if event.scheduled_run_times:
+        _planned_runs[event.job_id] = event.scheduled_run_times[-1].timestamp()
+
+def planned_time(job_id):
+    return _planned_runs.pop(job_id, None)
+
+def ensure_job(func, trigger, job_id, args=None):
+    """
+    Добавляет задание в хранилище, только если его там ещё нет: пересоздание сбросило бы
+    сохранённое время следующего запуска, и пропущенный запуск был бы потерян.
+    Если расписание в коде изменилось — обновляет триггер.
+    """
+    job = scheduler.get_job(job_id)
+    if job is None:
+        scheduler.add_job(func, trigger, id=job_id, args=args)
+    elif repr(job.trigger) != repr(trigger):
+        scheduler.reschedule_job(job_id, trigger=trigger)
+
+async def sync_digest_jobs():
+    """
+    Сверяет задания ежедневного дайджеста с часовыми поясами пользователей:
+    добавляет задания для новых поясов и удаляет задания поясов, в которых никого не осталось.
+    """
+    # Хранилище заданий меняет только ведущий; остальные экземпляры ждут его ежечасной сверки
+    if not leader.is_leader:
+        return
+    timezones = await get_timezone_buckets()
+    wanted = {f"{DAILY_JOB_ID}:{tz}": tz for tz in timezones}
+
+    for job in scheduler.get_jobs():
+        # Старое задание без пояса (DAILY_JOB_ID) тоже удаляется
+        if job.id.split(":")[0] == DAILY_JOB_ID and job.id not in wanted:
+            scheduler.remove_job(job.id)
+
+    for job_id, tz in wanted.items():
+        ensure_job(daily_deadline_check, CronTrigger(hour=DIGEST_HOUR, timezone=get_zone(tz)), job_id, args=[tz])
+
+async def start_scheduler(app_bot):
+    """Запускает планировщик и таймер напоминаний с ботом приложения."""
+    global bot, dispatcher
+    bot = app_bot
+    # Все уведомления уходят через диспетчер с ограничением скорости
+    dispatcher = NotificationDispatcher(bot)
+    dispatcher.start()
+    metrics.register_gauge("dispatcher_queue_depth", lambda: dispatcher.queue_size)
+    metrics.register_gauge("reminder_timer_pending", lambda: reminder_timer.pending)
+    metrics.register_gauge("is_leader", lambda: leader.is_leader)
+    scheduler.add_listener(_on_job_submitted, EVENT_JOB_SUBMITTED)
+
+    # APScheduler 3 не поддерживает несколько планировщиков на одном хранилище: кто первым
+    # забрал задание, тот его и выполняет (и сдвигает next_run_time). Поэтому планировщик
+    # стоит на паузе во всех экземплярах, а работает только у держателя аренды (on_elected / on_lost)
+    scheduler.start(paused=True)
+    await leader.start(on_elected=on_elected, on_lost=on_lost)
+
+    # Напоминания за час до дедлайна: вместо ежечасного опроса базы — таймер на куче,
+    # который просыпается ровно в момент следующего напоминания.
+    # Таймер работает в каждом экземпляре (в него попадают задачи, созданные именно здесь);
+    # повторная отправка исключена журналом notifications_sent.
+    await reload_reminder_timer()
+    reminder_timer.start(send_due_reminders)
 
-        try:
-            await bot.send_message(
-                chat_id=user_id,
-                text=(
-                    f"⚠️ <b>Напоминание!</b>\n"
-                    f"Завтра дедлайн задачи:\n"
-                    f"📌 <b>{title}</b>\n"
-                    f"🗓 {deadline}"
-                ),
-                reply_markup=keyboard
-            )
-        except Exception as e:
-            print(f"Ошибка при отправке уведомления пользователю {user_id}: {e}")
-
-async def hourly_deadline_check():
-    """
-    Проверка задач: если до дедлайна остаётся примерно 1-1.5 часа, отправить напоминание пользователю.
-    """
-    print(f"Выполняю проверку задач с приближающимся дедлайном: {datetime.now().strftime('%Y-%m-%d %H:%M')}")
-    tasks = get_tasks_due_in_one_hour()
-    
+async def reload_reminder_timer(user_id=None):
+    """Загружает в таймер предстоящие напоминания (всех пользователей или только user_id)."""
+    upcoming = await get_upcoming_due_tasks(int(datetime.now().timestamp()), user_id)
+    reminder_timer.load((task["id"], task["due_at"]) for task in upcoming)
+
+async def on_elected():
+    """
+    Экземпляр стал ведущим (при старте или после падения прежнего): сверяет задания с хранилищем,
+    запускает планировщик, досылает пропущенное и подхватывает задачи, созданные в других экземплярах.
+    """
+    try:
+        # Ежедневная проверка задач с дедлайном на завтра — в 9:00 по местному времени каждого пояса
+        await sync_digest_jobs()
+        # Ночная архивация выполненных задач
+        ensure_job(archive_done_tasks, CronTrigger(hour=3), ARCHIVE_JOB_ID)
+        # Пояса, выбранные пользователями в других экземплярах, подхватываются раз в час
+        ensure_job(sync_digest_jobs, CronTrigger(minute=DIGEST_SYNC_MINUTE), DIGEST_SYNC_JOB_ID)
+    finally:
+        # Задания сверены: APScheduler выполняет пропущенные запуски (в пределах misfire_grace_time) по одному разу
+        scheduler.resume()
+    await catch_up_missed_reminders()
+    # При старте таймер ещё не запущен и заполняется в start_scheduler
+    if reminder_timer.running:
+        await reload_reminder_timer()
+
+async def on_lost():
+    """Аренду забрал другой экземпляр: плановые задания теперь выполняет он."""
+    scheduler.pause()
+
+def skip_unless_leader(job_name):
+    if leader.is_leader:
+        return False
+    print(f"{job_name}: пропуск, задание выполняет ведущий экземпляр")
+    return True
+
+async def catch_up_missed_reminders():
+    """
+    Напоминания, которые должны были уйти, пока бот был остановлен: одним запросом
+    с ограничением, а не повтором каждого пропущенного тика. Уже отправленные
+    отсекаются журналом notifications_sent.
+    """
+    now = int(datetime.now().timestamp())
+    tasks = await get_missed_hour_reminders(now - CATCHUP_WINDOW, now, CATCHUP_LIMIT, columns=REMINDER_COLUMNS)
     if not tasks:
-        print("Не найдено задач с приближающимся дедлайном")
         return
-        
+    print(f"Догоняющий проход: {len(tasks)} пропущенных напоминаний")
+    if len(tasks) == CATCHUP_LIMIT:
+        print(f"Достигнут лимит догоняющего прохода ({CATCHUP_LIMIT}), более старые напоминания пропущены")
+    # Отправку не ждём, чтобы не задерживать запуск бота; ссылку держим до завершения
+    task = asyncio.create_task(send_catch_up_reminders(tasks))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+async def send_catch_up_reminders(tasks):
+    with metrics.job_run("catch_up") as run:
+        run.candidates = len(tasks)
+        run.add_sends(await send_hour_reminders(tasks))
+
+async def stop_scheduler():
+    """Останавливает планировщик, таймер и диспетчер; неотправленные уведомления отменяются."""
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    # Освобождаем аренду сразу, чтобы другой экземпляр стал ведущим без ожидания LEASE_TTL
+    await leader.stop()
+    await reminder_timer.stop()
+    if dispatcher is not None:
+        await dispatcher.stop()
+
+async def archive_done_tasks():
+    if skip_unless_leader("Архивация"):
+        return
+    with metrics.job_run(ARCHIVE_JOB_ID, scheduled_at=planned_time(ARCHIVE_JOB_ID)) as run:
+        with run.query():
+            moved = await archive_completed_tasks(ARCHIVE_AFTER_DAYS)
+        run.candidates = moved
+    print(f"Архивация завершена, перенесено задач: {moved}")
+
+async def daily_deadline_check(timezone=DEFAULT_TIMEZONE):
+    """
+    Ежедневный дайджест для пользователей часового пояса timezone: одно сообщение
+    на пользователя со всеми его задачами, у которых дедлайн завтра по местному времени
+    (вместо отдельного сообщения на каждую задачу).
+    """
+    if skip_unless_leader(f"Ежедневный дайджест ({timezone})"):
+        return
+    job_id = f"{DAILY_JOB_ID}:{timezone}"
+    with metrics.job_run(job_id, scheduled_at=planned_time(job_id)) as run:
+        run.add_sends(await send_daily_digests(timezone, run))
+
+async def send_daily_digests(timezone, run):
+    tomorrow = (datetime.now(get_zone(timezone)) + timedelta(days=1)).strftime("%Y-%m-%d")
+    with run.query():
+        groups = await get_tasks_due_on_by_user(tomorrow, columns=REMINDER_COLUMNS, timezone=timezone)
+    run.candidates = sum(len(tasks) for _, tasks in groups)
+
+    # Журнал отмечается одним запросом на все задачи запуска
+    claimed = {reminder_key(task) for task in await claim_tasks(REMINDER_DAY, [t for _, ts in groups for t in ts])}
+
+    sends = []
+    for user_id, tasks in groups:
+        tasks = [task for task in tasks if reminder_key(task) in claimed]
+        if not tasks:
+            continue
+
+        text, keyboard = build_daily_digest(tasks, tomorrow)
+        future = dispatcher.enqueue(
+            chat_id=user_id,
+            text=text,
+            reply_markup=keyboard,
+            priority=PRIORITY_DAILY
+        )
+        sends.append((future, user_id, f"дайджест из {len(tasks)} задач", [reminder_key(task) for task in tasks]))
+
+    print(f"Ежедневный дайджест ({timezone}): {len(sends)} пользователей, {len(claimed)} задач")
+    return await wait_for_sends(sends, REMINDER_DAY)
+
+def build_daily_digest(tasks, deadline):
+    """Текст дайджеста и компактная клавиатура: по строке «✅ N / ⏳ N» на задачу."""
+    shown = tasks[:DIGEST_MAX_TASKS]
+
+    lines = [f"⚠️ <b>Напоминание!</b>", f"Завтра ({deadline}) дедлайн задач:"]
+    keyboard = []
+    for number, task in enumerate(shown, start=1):
+        time = task["time"] or "10:00"
+        lines.append(f"{number}. 📌 <b>{task['title']}</b> — {time}")
+        keyboard.append([
+            InlineKeyboardButton(text=f"✅ {number}", callback_data=f"mark_done_{task['id']}"),
+            InlineKeyboardButton(text=f"⏳ {number}", callback_data=f"extend_deadline_{task['id']}")
+        ])
+
+    if len(tasks) > len(shown):
+        lines.append(f"…и ещё {len(tasks) - len(shown)} — см. «📋 Мои задачи»")
+
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def reminder_key(task):
+    return task["id"], task["due_at"] or 0
+
+async def claim_tasks(kind, tasks):
+    """
+    Одним запросом отмечает напоминания в журнале и оставляет только задачи,
+    по которым напоминание этого вида ещё не отправлялось.
+    """
+    if not tasks:
+        return []
+    claimed = set(await claim_reminders(kind, [reminder_key(task) for task in tasks]))
+    skipped = len(tasks) - len(claimed)
+    if skipped:
+        print(f"Пропущено {skipped} уже отправленных напоминаний ({kind})")
+    return [task for task in tasks if reminder_key(task) in claimed]
+
+async def wait_for_sends(sends, kind):
+    """
+    Дожидается отправки уведомлений, поставленных в очередь диспетчера, и логирует результат.
+    Неотправленные напоминания снимаются с отметки в журнале, чтобы их можно было повторить.
+    Исключения — отложенные (их доставит очередь повторов) и адресованные недоступным чатам.
+    Возвращает счётчики {"sent", "failed", "deferred"} для метрик.
+    """
+    results = await asyncio.gather(*(future for future, _, _, _ in sends), return_exceptions=True)
+    outcome = {"sent": 0, "failed": 0, "deferred": 0}
+    failed = []
+    for (_, user_id, title, keys), result in zip(sends, results):
+        if isinstance(result, SendDeferred):
+            print(f"Напоминание пользователю {user_id} о задаче {title} отложено для повторной отправки")
+            outcome["deferred"] += 1
+        elif isinstance(result, ChatUnavailable):
+            print(f"Пользователь {user_id} недоступен, напоминание о задаче {title} пропущено")
+            outcome["failed"] += 1
+        elif isinstance(result, BaseException):
+            print(f"Ошибка при отправке уведомления пользователю {user_id}: {result}")
+            outcome["failed"] += 1
+            failed.extend(keys)
+        else:
+            print(f"Отправлено напоминание пользователю {user_id} о задаче {title}")
+            outcome["sent"] += 1
+    if failed:
+        await release_reminders(kind, failed)
+    return outcome
+
+async def send_due_reminders(task_ids):
+    """
+    Вызывается таймером напоминаний в момент «за час до дедлайна».
+    Перед отправкой перечитывает задачи: выполненные и перенесённые пропускаются.
+    """
+    with metrics.job_run("hour_reminders") as run:
+        with run.query():
+            tasks = await get_tasks_by_ids(task_ids, columns=REMINDER_COLUMNS)
+        now = int(datetime.now().timestamp())
+        tasks = [
+            task for task in tasks
+            if task["status"] == "active" and task["due_at"] and task["due_at"] > now
+            and reminder_timer.is_current(task["id"], task["due_at"])
+        ]
+        run.candidates = len(tasks)
+        if not tasks:
+            return
+
+        # Плановый момент — самое раннее «за час до дедлайна» среди сработавших задач
+        fire_times = [task["due_at"] - reminder_timer.lead for task in tasks]
+        run.scheduled_at = min(fire_times)
+        for fire_at in fire_times:
+            metrics.observe("reminder_lag_seconds", max(0.0, run.started_at - fire_at))
+
+        run.add_sends(await send_hour_reminders(tasks))
+
+async def send_hour_reminders(tasks):
+    tasks = await claim_tasks(REMINDER_HOUR, tasks)
+
+    sends = []
     for task in tasks:
-        user_id = task[1]  # user_id
-        task_id = task[0]  # task_id
-        title = task[2]    # title
-        deadline = task[3] # deadline date
-        time = task[4] or "10:00"  # deadline time (HH:MM)
+        user_id = task["user_id"]
+        task_id = task["id"]
+        title = task["title"]
+        deadline = task["deadline"]  # deadline date
+        time = task["time"] or "10:00"  # deadline time (HH:MM)
         
-        # Рассчитываем оставшееся время более точно
-        deadline_dt = datetime.strptime(f"{deadline} {time}", "%Y-%m-%d %H:%M")
-        now = datetime.now()
-        time_left = deadline_dt - now
-        minutes_left = int(time_left.total_seconds() / 60)
+        # Оставшееся время считаем по due_at (Unix-время), а не по местным строкам даты:
+        # так оно верно при любом часовом поясе сервера и пользователя
+        now = int(datetime.now().timestamp())
+        minutes_left = (task["due_at"] - now) // 60
         
         # Выбираем правильное сообщение в зависимости от оставшегося времени
-        if minutes_left <= 60:
+        if minutes_left <= 0:
+            # Бывает после простоя бота: напоминание досылается догоняющим проходом
+            time_msg = f"Дедлайн уже наступил!"
+        elif minutes_left <= 60:
             time_msg = f"До дедлайна осталось менее часа!"
         else:
             hours = minutes_left // 60
@@ -95,17 +379,17 @@ async def hourly_deadline_check():
             ]
         ])
 
-        try:
-            await bot.send_message(
-                chat_id=user_id,
-                text=(
-                    f"⏰ <b>Напоминание о задаче!</b>\n"
-                    f"{time_msg}\n"
-                    f"📌 <b>{title}</b>\n"
-                    f"🗓 {deadline} {time}"
-                ),
-                reply_markup=keyboard
-            )
-            print(f"Отправлено напоминание пользователю {user_id} о задаче {title}")
-        except Exception as e:
-            print(f"Ошибка при отправке уведомления пользователю {user_id}: {e}")
\ No newline at end of file
+        future = dispatcher.enqueue(
+            chat_id=user_id,
+            text=(
+                f"⏰ <b>Напоминание о задаче!</b>\n"
+                f"{time_msg}\n"
+                f"📌 <b>{title}</b>\n"
+                f"🗓 {deadline} {time}"
+            ),
+            reply_markup=keyboard,
+            priority=PRIORITY_HOURLY
+        )
+        sends.append((future, user_id, title, [reminder_key(task)]))
+
+    return await wait_for_sends(sends, REMINDER_HOUR)
\ No newline at end of file